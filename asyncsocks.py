@@ -0,0 +1,311 @@
+"""
+asyncio support for PySocks (Python 3.7+)
+
+Runs the same SOCKS4/SOCKS5/HTTP CONNECT handshakes as socks.socksocket,
+but on the event loop, and hands back standard asyncio streams:
+
+    reader, writer = await asyncsocks.open_connection(
+        ("example.com", 80), socks.SOCKS5, "localhost", 9050)
+"""
+import asyncio
+import functools
+import socket
+
+import socks
+
+__all__ = ["open_connection", "create_connection", "relay"]
+
+
+async def _recv_exactly(loop, sock, view):
+    """Receive EXACTLY len(view) bytes from a non-blocking socket."""
+    while view:
+        received = await loop.sock_recv_into(sock, view)
+        if not received:
+            raise socks.GeneralProxyError("Connection closed unexpectedly")
+        view = view[received:]
+
+
+async def _recv_headers(loop, sock, limit, data=b""):
+    """Receive an HTTP header block from a non-blocking socket, following
+    data already received.
+
+    Returns the headers (up to and including the blank line) and any bytes
+    that were received past them."""
+    while True:
+        end = data.find(b"\r\n\r\n")
+        if end >= 0:
+            return data[:end + 4], data[end + 4:]
+        if len(data) > limit:
+            raise socks.GeneralProxyError(
+                "HTTP proxy server sent oversized headers")
+        d = await loop.sock_recv(sock, 4096)
+        if not d:
+            return data, b""
+        data += d
+
+
+async def _run_handshake(loop, sock, handshake):
+    """Drives a handshake generator on the event loop.
+
+    Returns the handshake result and any tunnel data received early."""
+    buffer = memoryview(bytearray(262))  # Longest SOCKS5 reply
+    leftover = b""  # Received past an HTTP response's headers
+    try:
+        result = None
+        while True:
+            op, arg = handshake.send(result)
+            result = None
+            if op == socks._SEND:
+                await loop.sock_sendall(sock, arg)
+            elif op == socks._RECV:
+                if arg > len(buffer):
+                    buffer = memoryview(bytearray(arg))
+                result = buffer[:arg]
+                early = len(leftover[:arg])
+                result[:early] = leftover[:early]
+                leftover = leftover[early:]
+                await _recv_exactly(loop, sock, result[early:])
+            elif op == socks._RECV_HEADERS:
+                result, leftover = await _recv_headers(loop, sock, arg,
+                                                       leftover)
+                result = memoryview(result)
+            elif op == socks._PHASE:
+                pass
+            else:
+                return arg, leftover
+    finally:
+        handshake.close()
+
+
+async def _resolve(loop, proxy, host, port):
+    """Returns the destination address to send to the proxy: resolved
+    here, without blocking the loop, where the handshake would otherwise
+    resolve it locally with a blocking call."""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+        except OSError:
+            continue
+        return host
+    proxy_type, rdns = proxy[0], proxy[3]
+    if proxy_type == socks.SOCKS4:
+        local = not rdns or socks._capability(proxy, "socks4a") is False
+    else:
+        local = not rdns
+    if not local:
+        return host
+    if proxy_type == socks.SOCKS5:
+        infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM,
+                                       proto=socket.IPPROTO_TCP,
+                                       flags=socket.AI_ADDRCONFIG)
+    else:
+        # As gethostbyname()
+        infos = await loop.getaddrinfo(host, port, family=socket.AF_INET,
+                                       type=socket.SOCK_STREAM)
+    return infos[0][4][0]
+
+
+async def _connect(dest_pair, proxy_type=None, proxy_addr=None,
+                   proxy_port=None, proxy_rdns=True, proxy_username=None,
+                   proxy_password=None, proxy_pipeline=False):
+    """Connect to the proxy and negotiate a tunnel to dest_pair.
+
+    Returns the non-blocking socket and any tunnel data that arrived
+    together with the proxy's response."""
+    loop = asyncio.get_running_loop()
+    if isinstance(proxy_type, socks.Proxy):
+        (proxy_type, proxy_addr, proxy_port, proxy_rdns, proxy_username,
+         proxy_password) = proxy_type
+    remote_host, remote_port = dest_pair
+    if remote_host.startswith("["):
+        remote_host = remote_host.strip("[]")
+    if proxy_addr and proxy_addr.startswith("["):
+        proxy_addr = proxy_addr.strip("[]")
+
+    proxy_port = proxy_port or socks.DEFAULT_PORTS.get(proxy_type)
+    if not proxy_port:
+        raise socks.GeneralProxyError("Invalid proxy type")
+    if proxy_type == socks.HTTPS:
+        raise socks.GeneralProxyError(
+            "TLS to the proxy is not supported with asyncio")
+    proxy = socks._proxy_for(proxy_type, proxy_addr, proxy_port, proxy_rdns,
+                             proxy_username, proxy_password)
+    address = await _resolve(loop, proxy, remote_host, remote_port)
+    if proxy_type == socks.HTTP:
+        # The Host header still names the destination
+        make_handshake = functools.partial(socks._HTTP_handshake,
+                                           resolved=address)
+    else:
+        make_handshake = socks._handshakes[proxy_type]
+        remote_host = address
+
+    err = None
+
+    # Allow the SOCKS proxy to be on IPv4 or IPv6 addresses.
+    for r in await loop.getaddrinfo(proxy_addr, proxy_port,
+                                    type=socket.SOCK_STREAM):
+        family, socket_type, proto, canonname, sa = r
+        pipeline = proxy_pipeline
+        while True:
+            sock = socket.socket(family, socket_type, proto)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, sa)
+            except OSError as error:
+                sock.close()
+                proxy_server = "{}:{}".format(proxy_addr, proxy_port)
+                printable_type = socks.PRINTABLE_PROXY_TYPES[proxy_type]
+                msg = "Error connecting to {} proxy {}".format(
+                    printable_type, proxy_server)
+                socks.log.debug("%s due to: %s", msg, error)
+                err = socks.ProxyConnectionError(msg, error)
+                break
+
+            try:
+                handshake = make_handshake(proxy, remote_host, remote_port,
+                                           pipeline)
+                _, leftover = await _run_handshake(loop, sock, handshake)
+            except socks.SOCKS5PipelineError:
+                # The connection is unusable now; start over in lock-step.
+                sock.close()
+                pipeline = False
+                continue
+            except socks.HTTPAuthRetryError:
+                # Start over once, with the credentials up front
+                sock.close()
+                make_handshake = functools.partial(make_handshake,
+                                                   authorized=True)
+                continue
+            except socks.ProxyError:
+                sock.close()
+                raise
+            except OSError as error:
+                sock.close()
+                raise socks.GeneralProxyError("Socket error", error)
+            except BaseException:
+                sock.close()
+                raise
+            return sock, leftover
+
+    if err:
+        raise err
+
+    raise OSError("gai returned empty list.")
+
+
+async def create_connection(protocol_factory, dest_pair,
+                            proxy_type=None, proxy_addr=None,
+                            proxy_port=None, proxy_rdns=True,
+                            proxy_username=None, proxy_password=None,
+                            proxy_pipeline=False, **kwds):
+    """create_connection(protocol_factory, dest_pair, **proxy_args, **kwds)
+    -> (transport, protocol)
+
+    Like loop.create_connection(), but connects through the proxy first.
+    Extra keyword arguments (ssl, server_hostname, ...) are passed on to
+    loop.create_connection(). When ssl is requested, server_hostname
+    defaults to the destination host.
+    """
+    loop = asyncio.get_running_loop()
+
+    if proxy_type is None:
+        host, port = dest_pair
+        return await loop.create_connection(protocol_factory, host, port,
+                                            **kwds)
+
+    sock, leftover = await _connect(dest_pair, proxy_type, proxy_addr,
+                                    proxy_port, proxy_rdns, proxy_username,
+                                    proxy_password, proxy_pipeline)
+    try:
+        if kwds.get("ssl"):
+            if leftover:
+                raise socks.GeneralProxyError(
+                    "Proxy server sent data before the TLS handshake")
+            kwds.setdefault("server_hostname", dest_pair[0].strip("[]"))
+        transport, protocol = await loop.create_connection(
+            protocol_factory, sock=sock, **kwds)
+    except BaseException:
+        sock.close()
+        raise
+
+    if leftover:
+        # Bytes that arrived together with the proxy's response belong to
+        # the tunnel; deliver them before anything read by the transport.
+        protocol.data_received(leftover)
+    return transport, protocol
+
+
+async def open_connection(dest_pair, proxy_type=None, proxy_addr=None,
+                          proxy_port=None, proxy_rdns=True,
+                          proxy_username=None, proxy_password=None,
+                          proxy_pipeline=False, limit=2 ** 16, **kwds):
+    """open_connection(dest_pair, **proxy_args, **kwds)
+    -> (StreamReader, StreamWriter)
+
+    Like asyncio.open_connection(), but connects through the proxy first.
+    Accepts the same arguments as create_connection() above.
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=limit, loop=loop)
+    protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+    transport, _ = await create_connection(
+        lambda: protocol, dest_pair, proxy_type, proxy_addr, proxy_port,
+        proxy_rdns, proxy_username, proxy_password, proxy_pipeline, **kwds)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+async def _wait_ready(loop, readers, writers):
+    """Waits until any of the sockets is readable or writable, as asked."""
+    ready = loop.create_future()
+    readable, writable = [], []
+
+    def on_ready(sock, ready_list):
+        ready_list.append(sock)
+        if not ready.done():
+            ready.set_result(None)
+
+    for sock in readers:
+        loop.add_reader(sock, on_ready, sock, readable)
+    for sock in writers:
+        loop.add_writer(sock, on_ready, sock, writable)
+    try:
+        await ready
+    finally:
+        for sock in readers:
+            loop.remove_reader(sock)
+        for sock in writers:
+            loop.remove_writer(sock)
+    return readable, writable
+
+
+async def relay(sock_a, sock_b, buffer_size=65536):
+    """Coroutine. Copies data both ways between two connected stream
+    sockets on the event loop, as socks.relay() does, and returns the number
+    of bytes relayed each way: (a_to_b, b_to_a).
+
+    Uses os.splice() where available. The sockets must not belong to a
+    transport, since the relay reads and writes them directly; closing them
+    is left to the caller."""
+    loop = asyncio.get_running_loop()
+    timeouts = sock_a.gettimeout(), sock_b.gettimeout()
+    sock_a.settimeout(0.0)
+    sock_b.settimeout(0.0)
+    directions = socks._relay_directions(sock_a, sock_b, buffer_size)
+    try:
+        done = socks._relay_pump(directions)
+        while not done:
+            buffered = socks._relay_buffered(directions)
+            if buffered:
+                await asyncio.sleep(0)  # Let others run meanwhile
+                readable, writable = buffered, []
+            else:
+                readable, writable = await _wait_ready(
+                    loop, *socks._relay_waits(directions))
+            done = socks._relay_pump(directions, readable, writable)
+        return directions[0].count, directions[1].count
+    finally:
+        for direction in directions:
+            direction.close()
+        sock_a.settimeout(timeouts[0])
+        sock_b.settimeout(timeouts[1])
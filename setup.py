@@ -29,7 +29,7 @@ setup(
     author="Anorov",
     author_email="anorov.vorona@gmail.com",
     keywords=["socks", "proxy"],
-    py_modules=["socks", "sockshandler"],
+    py_modules=["socks", "sockshandler", "asyncsocks", "socksserver"],
     install_requires=requirements,
     python_requires=">=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*",
     classifiers=(
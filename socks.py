@@ -3,15 +3,28 @@ try:
     from collections.abc import Callable
 except ImportError:
     from collections import Callable
-from errno import EOPNOTSUPP, EINVAL, EAGAIN
+from collections import OrderedDict, deque
+from errno import (EOPNOTSUPP, EINVAL, EAGAIN, EINPROGRESS, EWOULDBLOCK,
+                   ENOTCONN, ECONNRESET, EPIPE, ECONNREFUSED, ETIMEDOUT,
+                   EHOSTUNREACH, ENETUNREACH)
 import functools
 from io import BytesIO
+import json
 import logging
+import math
 import os
-from os import SEEK_CUR
+import select
 import socket
 import struct
 import sys
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 __version__ = "1.7.1"
 
@@ -25,11 +38,15 @@ if os.name == "nt" and sys.version_info < (3, 0):
 
 log = logging.getLogger(__name__)
 
+_clock = getattr(time, "monotonic", time.time)  # Python 2 has no monotonic
+
 PROXY_TYPE_SOCKS4 = SOCKS4 = 1
 PROXY_TYPE_SOCKS5 = SOCKS5 = 2
 PROXY_TYPE_HTTP = HTTP = 3
+PROXY_TYPE_HTTPS = HTTPS = 4  # HTTP CONNECT over TLS to the proxy
 
-PROXY_TYPES = {"SOCKS4": SOCKS4, "SOCKS5": SOCKS5, "HTTP": HTTP}
+PROXY_TYPES = {"SOCKS4": SOCKS4, "SOCKS5": SOCKS5, "HTTP": HTTP,
+               "HTTPS": HTTPS}
 PRINTABLE_PROXY_TYPES = dict(zip(PROXY_TYPES.values(), PROXY_TYPES.keys()))
 
 _orgsocket = _orig_socket = socket.socket
@@ -79,6 +96,11 @@ class SOCKS5AuthError(ProxyError):
     pass
 
 
+class SOCKS5PipelineError(SOCKS5AuthError):
+    """The proxy rejected a pipelined handshake; retry without pipelining."""
+    pass
+
+
 class SOCKS5Error(ProxyError):
     pass
 
@@ -90,6 +112,12 @@ class SOCKS4Error(ProxyError):
 class HTTPError(ProxyError):
     pass
 
+
+class HTTPAuthRetryError(HTTPError):
+    """The proxy asked for credentials and closed the connection; retry on a
+    new one, which sends them up front."""
+    pass
+
 SOCKS4_ERRORS = {
     0x5B: "Request rejected or failed",
     0x5C: ("Request rejected because SOCKS server cannot connect to identd on"
@@ -109,18 +137,1858 @@ SOCKS5_ERRORS = {
     0x08: "Address type not supported"
 }
 
-DEFAULT_PORTS = {SOCKS4: 1080, SOCKS5: 1080, HTTP: 8080}
+DEFAULT_PORTS = {SOCKS4: 1080, SOCKS5: 1080, HTTP: 8080, HTTPS: 443}
+
+
+class DNSCache(object):
+    """Caches local name resolution (rdns=False) for all socksocket objects.
+
+    ttl -         Seconds to keep successful lookups.
+    negative_ttl - Seconds to remember failed lookups.
+    maxsize -     Number of lookups kept; the least recently used ones are
+                   evicted first.
+
+    The hits, misses and evictions attributes count cache activity. Install
+    with set_dns_cache()."""
+
+    def __init__(self, ttl=60.0, negative_ttl=5.0, maxsize=1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expiry, result, error)
+        self._lock = threading.Lock()
+
+    def _lookup(self, key, resolve, *args):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and entry[0] > _clock():
+                self._entries[key] = entry  # Most recently used last
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+
+        if entry is None:
+            # Resolve outside the lock, concurrent misses may both resolve
+            try:
+                entry = (_clock() + self.ttl, resolve(*args), None)
+            except socket.gaierror as error:
+                entry = (_clock() + self.negative_ttl, None, error)
+            with self._lock:
+                self._entries.pop(key, None)
+                self._entries[key] = entry
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+
+        _, result, error = entry
+        if error is not None:
+            raise socket.gaierror(*error.args)
+        return result
+
+    def gethostbyname(self, host):
+        """Cached socket.gethostbyname()."""
+        return self._lookup(("gethostbyname", host),
+                            socket.gethostbyname, host)
+
+    def getaddrinfo(self, *args):
+        """Cached socket.getaddrinfo(), positional arguments only."""
+        return self._lookup(("getaddrinfo",) + args,
+                            socket.getaddrinfo, *args)
+
+    def clear(self):
+        """Forget all cached lookups."""
+        with self._lock:
+            self._entries.clear()
+
+
+_dns_cache = None
+
+
+def set_dns_cache(cache):
+    """Sets the DNSCache used when resolving destinations locally.
+
+    Pass None to resolve every time, which is the default."""
+    global _dns_cache
+    _dns_cache = cache
+
+
+def get_dns_cache():
+    """Returns the DNSCache set by set_dns_cache, if any."""
+    return _dns_cache
+
+
+def _gethostbyname(host):
+    if _dns_cache is None:
+        return socket.gethostbyname(host)
+    return _dns_cache.gethostbyname(host)
+
+
+def _getaddrinfo(*args):
+    if _dns_cache is None:
+        return socket.getaddrinfo(*args)
+    return _dns_cache.getaddrinfo(*args)
+
+
+class ProxyAddressCache(object):
+    """Caches the addresses the proxies' host names resolve to, for all
+    connections through them.
+
+    ttl -         Seconds to use resolved addresses for.
+    refresh -     Optional fraction of ttl after which addresses still in
+                   use are resolved again in a background thread, so that
+                   connections through a busy proxy never wait for the
+                   resolver. By default they are resolved again when they
+                   have expired, by the connection that needs them.
+    maxsize -     Number of proxies kept; the least recently used ones are
+                   evicted first.
+
+    Addresses are forgotten as soon as connecting to the proxy fails. The
+    hits, misses and refreshes attributes count cache activity. Installed
+    by default; see set_proxy_address_cache()."""
+
+    def __init__(self, ttl=60.0, refresh=None, maxsize=256):
+        self.ttl = ttl
+        self.refresh = refresh
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        # (host, port, family, type) -> [resolved at, addrinfos, refreshing]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def getaddrinfo(self, host, port, family=0, type=0):
+        """Cached socket.getaddrinfo(). The list returned is shared, so
+        don't modify it."""
+        key = host, port, family, type
+        now = _clock()
+        refresh = False
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] + self.ttl > now:
+                self._entries[key] = entry  # Most recently used last
+                self.hits += 1
+                if (self.refresh is not None and not entry[2]
+                        and entry[0] + self.ttl * self.refresh <= now):
+                    refresh = entry[2] = True
+                    self.refreshes += 1
+            else:
+                entry = None
+                self.misses += 1
+
+        if entry is None:
+            return self._resolve(key)
+        if refresh:
+            th = threading.Thread(target=self._refresh, args=(key,),
+                                  name="socks-proxy-resolve")
+            th.daemon = True
+            th.start()
+        return entry[1]
+
+    def _resolve(self, key):
+        # Resolve outside the lock, concurrent misses may both resolve
+        addrinfos = socket.getaddrinfo(*key)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = [_clock(), addrinfos, False]
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return addrinfos
+
+    def _refresh(self, key):
+        try:
+            self._resolve(key)
+        except socket.error as e:
+            # Keep using the addresses we have until they expire
+            log.debug("Could not resolve proxy %s:%s again: %s",
+                      key[0], key[1], e)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry[2] = False
+
+    def invalidate(self, host, port):
+        """Forgets the addresses of the proxy at host:port."""
+        with self._lock:
+            for key in [key for key in self._entries
+                        if key[:2] == (host, port)]:
+                del self._entries[key]
+
+    def clear(self):
+        """Forget all cached addresses."""
+        with self._lock:
+            self._entries.clear()
+
+
+_proxy_address_cache = ProxyAddressCache()
+
+
+def set_proxy_address_cache(cache):
+    """Sets the ProxyAddressCache used to resolve the proxies' host names.
+
+    Pass None to resolve them on every connection."""
+    global _proxy_address_cache
+    _proxy_address_cache = cache
+
+
+def get_proxy_address_cache():
+    """Returns the ProxyAddressCache set by set_proxy_address_cache(), if
+    any."""
+    return _proxy_address_cache
+
+
+def _proxy_getaddrinfo(host, port, family=0):
+    cache = _proxy_address_cache
+    if cache is None:
+        return socket.getaddrinfo(host, port, family, socket.SOCK_STREAM)
+    return cache.getaddrinfo(host, port, family, socket.SOCK_STREAM)
+
+
+def _proxy_failed(host, port):
+    """Called when connecting to the proxy at host:port failed."""
+    cache = _proxy_address_cache
+    if cache is not None:
+        cache.invalidate(host, port)
+
+
+class CapabilityCache(object):
+    """Remembers what each proxy supports, so that connections to it don't
+    have to find out by failing first.
+
+    ttl -         Seconds to trust what was learnt about a proxy.
+    maxsize -     Number of proxies kept; the least recently used ones are
+                   evicted first.
+    path -        Optional JSON file to start out from and to save to
+                   whenever something new is learnt, so that freshly
+                   started processes don't have to learn it again.
+    save_delay -  Seconds after something new is learnt that path is
+                   written, by a background thread; what is learnt
+                   meanwhile goes into the same write. Connections never
+                   wait for it.
+
+    Capabilities are kept by proxy type, address and port:
+    "auth_method" - The SOCKS5 authentication method the proxy chose.
+                     Pipelined handshakes offer just that method.
+    "pipeline"    - False if the proxy failed a pipelined SOCKS5 handshake
+                     despite being offered the method it chose before;
+                     connections then negotiate in lock-step instead.
+    "socks4a"     - Whether a SOCKS4 proxy resolves names (SOCKS4a). If
+                     not, names are resolved locally.
+    "fast_open"   - True once the proxy took data in a SYN, False if it
+                     didn't take what it was sent; connections to it then
+                     skip TCP Fast Open.
+    "http_auth"   - True once an HTTP proxy asked for a username given
+                     without a password, which is then sent up front.
+
+    An in-memory cache is installed by default; see
+    set_capability_cache()."""
+
+    def __init__(self, ttl=3600.0, maxsize=1024, path=None, save_delay=1.0):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.path = path
+        self.save_delay = save_delay
+        self._entries = OrderedDict()  # key -> (expiry, {name: value})
+        self._lock = threading.Lock()
+        self._save_pid = None  # Process with a save scheduled
+        if path:
+            self.load()
+
+    @staticmethod
+    def _key(proxy):
+        proxy_type, addr, port = tuple(proxy[:3])
+        return proxy_type, addr, port or DEFAULT_PORTS.get(proxy_type)
+
+    def get(self, proxy, name, default=None):
+        """Returns what was learnt about proxy, a tuple of set_proxy()
+        arguments, or default if nothing (or nothing recent)."""
+        key = self._key(proxy)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                return default
+            self._entries[key] = entry  # Most recently used last
+            return entry[1].get(name, default)
+
+    def set(self, proxy, name, value):
+        """Records a capability of proxy."""
+        self._update(proxy, name, value)
+
+    def discard(self, proxy, name):
+        """Forgets a capability of proxy."""
+        self._update(proxy, name, None, discard=True)
+
+    def _update(self, proxy, name, value, discard=False):
+        key = self._key(proxy)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            capabilities = {}
+            if entry is not None and entry[0] > now:
+                capabilities = entry[1]
+            if discard:
+                changed = name in capabilities
+                capabilities.pop(name, None)
+            else:
+                changed = (name not in capabilities
+                           or capabilities[name] != value)
+                capabilities[name] = value
+            self._entries[key] = (now + self.ttl, capabilities)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        # Confirmations only extend the expiry in memory
+        if changed and self.path:
+            self._schedule_save()
+
+    def clear(self):
+        """Forget everything learnt."""
+        with self._lock:
+            self._entries.clear()
+        if self.path:
+            self.save()
+
+    def save(self, path=None):
+        """Writes the cache to path, by default the one it was created
+        with. The file is replaced atomically."""
+        path = path or self.path
+        with self._lock:
+            entries = [{"proxy": list(key), "expires": expiry,
+                        "capabilities": capabilities}
+                       for key, (expiry, capabilities)
+                       in self._entries.items()]
+        temp = None
+        try:
+            # A file of its own, as other threads may be saving too
+            fd, temp = tempfile.mkstemp(".tmp", os.path.basename(path) + ".",
+                                        os.path.dirname(path) or ".")
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            getattr(os, "replace", os.rename)(temp, path)
+        except (IOError, OSError) as e:
+            log.debug("Could not save proxy capabilities to %s: %s", path, e)
+            if temp:
+                try:
+                    os.remove(temp)
+                except OSError:
+                    pass
+
+    def _schedule_save(self):
+        pid = os.getpid()
+        with self._lock:
+            # A forked child has no thread saving for it, whatever its
+            # parent had scheduled
+            if self._save_pid == pid:
+                return
+            self._save_pid = pid
+        timer = threading.Timer(self.save_delay, self._scheduled_save)
+        timer.daemon = True
+        timer.start()
+
+    def _scheduled_save(self):
+        with self._lock:
+            self._save_pid = None
+        self.save()
+
+    def load(self, path=None):
+        """Adds what a file written by save() holds. A missing or broken
+        file is ignored."""
+        path = path or self.path
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+            now = time.time()
+            loaded = [(tuple(entry["proxy"]), entry["expires"],
+                       dict(entry["capabilities"])) for entry in entries]
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            log.debug("Could not load proxy capabilities from %s: %s",
+                      path, e)
+            return
+        with self._lock:
+            for key, expiry, capabilities in loaded:
+                if expiry > now:
+                    self._entries[key] = (expiry, capabilities)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+_capability_cache = CapabilityCache()
+
+
+def set_capability_cache(cache):
+    """Sets the CapabilityCache consulted and taught by all connections.
+
+    Pass None to learn nothing and always start from scratch."""
+    global _capability_cache
+    _capability_cache = cache
+
+
+def get_capability_cache():
+    """Returns the CapabilityCache set by set_capability_cache(), if any."""
+    return _capability_cache
+
+
+def _capability(proxy, name, default=None):
+    cache = _capability_cache
+    if cache is None:
+        return default
+    return cache.get(proxy, name, default)
+
+
+def _learn(proxy, name, value):
+    cache = _capability_cache
+    if cache is not None:
+        cache.set(proxy, name, value)
+
+
+_negotiation_hook = None
+
+
+def set_negotiation_hook(hook):
+    """Sets a function to be told how long each phase of connecting through
+    a proxy took, for all socksocket objects. Set the negotiation_hook
+    attribute of a socksocket to override it for that socket.
+
+    The hook is called as hook(phase, start, end, proxy, dest, error):
+
+    phase -       "connect" for the TCP connection to the proxy, "tls" for
+                   the TLS handshake with it, "method" and "auth" for
+                   SOCKS5 method selection and username/password
+                   authentication, "request" for the request to the proxy
+                   and its reply.
+    start, end -  time.monotonic() timestamps (time.time() on Python 2).
+    proxy -       (proxy_type, addr, port) of the proxy.
+    dest -        The (host, port) being connected to through the proxy.
+    error -       The exception the phase failed with, or None.
+
+    Pass None to remove the hook, which is the default. Non-blocking and
+    asyncio connections are not timed."""
+    global _negotiation_hook
+    _negotiation_hook = hook
+
+
+def get_negotiation_hook():
+    """Returns the hook set by set_negotiation_hook()."""
+    return _negotiation_hook
+
+
+_TCP_FASTOPEN_CONNECT = getattr(
+    socket, "TCP_FASTOPEN_CONNECT",
+    30 if sys.platform.startswith("linux") else None)
+_TCPI_OPT_SYN_DATA = 32  # tcp_info.tcpi_options: the SYN's data was acked
+# tcp_info.tcpi_fastopen_client_fail (Linux 5.5+) when the SYN carried data
+# the server didn't take: it wasn't acked, or the SYN had to be sent again
+_TFO_DATA_NOT_ACKED = 2
+_TFO_SYN_RETRANSMITTED = 3
+_fast_open_lock = threading.Lock()
+_fast_open_stats = {"attempted": 0, "used": 0}
+
+
+def get_fast_open_stats():
+    """Returns a dict with how many proxy connections were made with TCP
+    Fast Open enabled ("attempted") and how many of them actually had their
+    first bytes carried in the SYN and accepted ("used")."""
+    with _fast_open_lock:
+        return dict(_fast_open_stats)
+
+
+def _syn_data_acked(sock):
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 8)
+    except (AttributeError, socket.error):
+        return False
+    return bool(bytearray(info)[5] & _TCPI_OPT_SYN_DATA)
+
+
+def _syn_data_rejected(sock):
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 8)
+    except (AttributeError, socket.error):
+        return False
+    # Two bits after tcpi_delivery_rate_app_limited, in bit field order
+    shift = 1 if sys.byteorder == "little" else 5
+    return (bytearray(info)[7] >> shift & 3) in (_TFO_DATA_NOT_ACKED,
+                                                 _TFO_SYN_RETRANSMITTED)
+
+
+class TLSSessionCache(object):
+    """Keeps the TLS session of the latest connection to each server, so
+    that the next connection to it resumes the session with an abbreviated
+    handshake instead of a full one.
+
+    maxsize -     Number of servers kept; the least recently used ones are
+                   evicted first.
+
+    The resumed and full attributes count the handshakes made with the
+    cache by whether they resumed a session."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.resumed = 0
+        self.full = 0
+        self._sessions = OrderedDict()  # key -> ssl.SSLSession
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the session kept for key, or None."""
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is not None:
+                self._sessions[key] = session  # Most recently used last
+            return session
+
+    def update(self, key, tls):
+        """Counts the handshake of tls, an ssl.SSLSocket or ssl.SSLObject
+        given the session from get(key), and keeps its session for the
+        next connection.
+
+        With TLS 1.3 the session arrives after the handshake, so call this
+        once something has been received over the connection."""
+        session = getattr(tls, "session", None)  # Python 3.6+
+        with self._lock:
+            if getattr(tls, "session_reused", False):
+                self.resumed += 1
+            else:
+                self.full += 1
+            if session is not None:
+                self._sessions.pop(key, None)
+                self._sessions[key] = session
+                while len(self._sessions) > self.maxsize:
+                    self._sessions.popitem(last=False)
+
+    def discard(self, key):
+        """Forgets the session kept for key."""
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def clear(self):
+        """Forgets all sessions."""
+        with self._lock:
+            self._sessions.clear()
+
+
+_proxy_tls_sessions = TLSSessionCache()
+_default_tls_context = None
+
+
+def set_proxy_tls_session_cache(cache):
+    """Sets the TLSSessionCache for the TLS connections to proxies. Pass
+    None to do a full handshake every time."""
+    global _proxy_tls_sessions
+    _proxy_tls_sessions = cache
+
+
+def get_proxy_tls_session_cache():
+    """Returns the TLSSessionCache set by set_proxy_tls_session_cache(), if
+    any."""
+    return _proxy_tls_sessions
+
+
+def _tls_context(context):
+    """The SSLContext to use for the tls argument of set_proxy()."""
+    global _default_tls_context
+    if context is not True:
+        return context
+    if _default_tls_context is None:
+        import ssl
+        # Shared, since sessions can only be resumed with their own context
+        _default_tls_context = ssl.create_default_context()
+    return _default_tls_context
+
+
+class _TLSLayer(object):
+    """TLS on a socksocket's stream, encrypted and decrypted in userspace
+    by an ssl.SSLObject, so that layers can be stacked: TLS with the
+    destination inside the TLS connection to the proxy.
+
+    Works on blocking and non-blocking sockets alike; encrypted data is
+    always sent in full, waiting for the socket to become writable if need
+    be, so nothing lingers in the layer."""
+
+    def __init__(self, sock, context, server_hostname, session=None):
+        import ssl
+        if not hasattr(ssl, "MemoryBIO"):
+            raise GeneralProxyError("TLS layers need Python 3.5 or later")
+        self.sock = sock
+        self.lower = sock._tls[-1] if sock._tls else None
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        kwargs = {"session": session} if session is not None else {}
+        self.tls = context.wrap_bio(self.incoming, self.outgoing,
+                                    server_hostname=server_hostname, **kwargs)
+        self.key = None  # Of the session in the TLSSessionCache
+        self.peeked = b""  # Received with MSG_PEEK, so received again
+        self._want_read = ssl.SSLWantReadError
+        self._closed = (ssl.SSLZeroReturnError, ssl.SSLEOFError)
+        self._error = ssl.SSLError
+
+    def do_handshake(self):
+        """Handshakes as far as the socket allows without blocking."""
+        while True:
+            try:
+                self.tls.do_handshake()
+            except self._want_read:
+                self._flush()
+                self._fill()
+            else:
+                self._flush()
+                return
+
+    def _flush(self):
+        data = self.outgoing.read()
+        if not data:
+            return
+        if self.lower:
+            return self.lower.sendall(data)
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[_orig_socket.send(self.sock, view):]
+            except socket.error as e:
+                if e.errno not in (EAGAIN, EWOULDBLOCK):
+                    raise
+                _wait_ready([], [self.sock])
+
+    def _fill(self):
+        if self.lower:
+            data = self.lower.recv(_TLS_BUFFER_SIZE)
+        else:
+            data = _orig_socket.recv(self.sock, _TLS_BUFFER_SIZE)
+        if data:
+            self.incoming.write(data)
+        else:
+            self.incoming.write_eof()
+
+    def _read(self, count, buffer=None):
+        while True:
+            try:
+                if buffer is None:
+                    return self.tls.read(count)
+                return self.tls.read(count, buffer)
+            except self._want_read:
+                self._flush()  # Post-handshake messages may need a reply
+                self._fill()
+            except self._closed:
+                return b"" if buffer is None else 0
+
+    def recv(self, bufsize, flags=0):
+        if flags & socket.MSG_PEEK:
+            if not self.peeked:
+                self.peeked = self._read(bufsize)
+            return self.peeked[:bufsize]
+        if self.peeked:
+            data = self.peeked[:bufsize]
+            self.peeked = self.peeked[bufsize:]
+            return data
+        return self._read(bufsize)
+
+    def pending(self):
+        """Returns how many bytes can be received without waiting for the
+        socket, as ssl.SSLSocket.pending() does. Records received whole
+        but not decrypted yet are decrypted to find out."""
+        if not self.peeked and not self.tls.pending() and (
+                self.incoming.pending or self.lower and self.lower.pending()):
+            try:
+                if self.lower and self.lower.pending():
+                    self.incoming.write(self.lower.recv(_TLS_BUFFER_SIZE))
+                self.peeked = self.tls.read(_TLS_BUFFER_SIZE)
+            except (self._want_read, self._closed):
+                pass  # Not a whole record yet, or the socket says EOF
+        return len(self.peeked) + self.tls.pending()
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        nbytes = nbytes or len(buffer)
+        if self.peeked or flags & socket.MSG_PEEK:
+            data = self.recv(nbytes, flags)
+            buffer[:len(data)] = data
+            return len(data)
+        return self._read(nbytes, buffer)
+
+    def send(self, data, flags=0):
+        sent = self.tls.write(memoryview(data).cast("B")[:_TLS_BUFFER_SIZE])
+        self._flush()
+        return sent
+
+    def sendall(self, data, flags=0):
+        view = memoryview(data).cast("B")
+        while view:
+            view = view[self.send(view):]
+
+    def sendfile(self, file, offset=0, count=None):
+        # Not os.sendfile(), which would bypass the encryption
+        return self.sock._sendfile_use_send(file, offset, count)
+
+    def shutdown(self, how):
+        if how != socket.SHUT_RD:
+            # A TLS stream ends with a close_notify alert; a FIN alone
+            # would cut it off
+            try:
+                self.tls.unwrap()
+            except self._error:
+                pass  # Not waiting for the peer's close_notify
+            self._flush()
+        if how == socket.SHUT_WR:
+            return  # Receiving goes on, as after a TCP half-close
+        if self.lower:
+            self.lower.shutdown(how)
+        else:
+            _orig_socket.shutdown(self.sock, how)
+
+
+_TLS_BUFFER_SIZE = 65536
+_TLS_METHODS = ("recv", "recv_into", "send", "sendall", "sendfile",
+                "shutdown", "pending")
+
+
+def _keep_proxy_tls_session(layer):
+    cache = _proxy_tls_sessions
+    if cache is not None:
+        cache.update(layer.key, layer.tls)
+
+
+class Proxy(object):
+    """Proxy(proxy_type=None, addr=None, port=None, rdns=True, username=None,
+    password=None) -> proxy configuration
+
+    set_proxy()'s arguments, with what they contribute to the handshakes
+    encoded once instead of on every connection. Proxy objects are
+    immutable and shared by the sockets using them: set_proxy() hands out
+    the same one for the same arguments, and accepts one in place of them.
+
+    For compatibility a Proxy also behaves like the
+    (proxy_type, addr, port, rdns, username, password) tuple, username and
+    password as bytes, that socksocket.proxy used to be."""
+
+    __slots__ = ("_tuple", "address", "socks5_greeting", "socks5_auth",
+                 "socks4_userid", "http_authorization")
+
+    def __init__(self, proxy_type=None, addr=None, port=None, rdns=True,
+                 username=None, password=None):
+        if username and not isinstance(username, bytes):
+            username = username.encode()
+        if password and not isinstance(password, bytes):
+            password = password.encode()
+        init = functools.partial(object.__setattr__, self)
+        init("_tuple", (proxy_type, addr, port, rdns, username or None,
+                        password or None))
+        init("address", (addr, port or DEFAULT_PORTS.get(proxy_type)))
+        if username and password:
+            # Offer username/password authentication besides none
+            init("socks5_greeting", b"\x05\x02\x00\x02")
+            init("socks5_auth", b"\x01" + chr(len(username)).encode()
+                 + username + chr(len(password)).encode() + password)
+        else:
+            init("socks5_greeting", b"\x05\x01\x00")
+            init("socks5_auth", None)
+        # The username parameter is considered userid for SOCKS4
+        init("socks4_userid", (username or b"") + b"\x00")
+        init("http_authorization", username and (
+            b"Proxy-Authorization: basic "
+            + b64encode(username + b":" + (password or b""))))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Proxy objects are immutable")
+
+    def __reduce__(self):
+        return Proxy, self._tuple
+
+    def __getitem__(self, index):
+        return self._tuple[index]
+
+    def __iter__(self):
+        return iter(self._tuple)
+
+    def __len__(self):
+        return 6
+
+    def __eq__(self, other):
+        if isinstance(other, Proxy):
+            other = other._tuple
+        return self._tuple == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._tuple)
+
+    def __repr__(self):
+        return "Proxy" + repr(self._tuple)
+
+
+_proxies = OrderedDict()  # set_proxy() arguments -> Proxy
+_proxies_lock = threading.Lock()
+MAX_PROXY_CACHE_SIZE = 256
+
+
+def _proxy_for(proxy_type=None, addr=None, port=None, rdns=True,
+               username=None, password=None):
+    """Returns the shared Proxy for set_proxy()'s arguments."""
+    if isinstance(proxy_type, Proxy):
+        return proxy_type
+    if username and not isinstance(username, bytes):
+        username = username.encode()
+    if password and not isinstance(password, bytes):
+        password = password.encode()
+    key = proxy_type, addr, port, rdns, username or None, password or None
+    with _proxies_lock:
+        proxy = _proxies.pop(key, None)
+        if proxy is None:
+            proxy = Proxy(*key)
+            if len(_proxies) >= MAX_PROXY_CACHE_SIZE:
+                _proxies.popitem(last=False)
+        _proxies[key] = proxy  # Most recently used last
+    return proxy
+
+
+_NO_PROXY = Proxy(None, None, None, None, None, None)
+
+
+def _as_proxy(proxy):
+    if isinstance(proxy, Proxy):
+        return proxy
+    return _proxy_for(*proxy)
+
+
+class ProxyPool(object):
+    """Spreads connections over several upstream proxies.
+
+    proxies -     List with a tuple of set_proxy() arguments for each
+                   proxy, e.g. [(SOCKS5, "a.example"), (HTTP, "b.example")].
+    smoothing -   Weight of the newest sample in the moving average of each
+                   proxy's connect and handshake latency.
+    backoff -     Seconds to avoid a proxy after it failed; doubles with
+                   every consecutive failure, up to max_backoff.
+
+    Can be passed instead of a proxy type to set_proxy(),
+    set_default_proxy(), create_connection() and SocksiPyHandler. Each
+    connection goes through the proxy with the lowest expected latency,
+    weighted by the connections it already carries. Proxies that failed
+    recently are only used when all of them have."""
+
+    def __init__(self, proxies, smoothing=0.3, backoff=1.0, max_backoff=60.0):
+        self.smoothing = smoothing
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._members = [_ProxyPoolMember(proxy) for proxy in proxies]
+        if not self._members:
+            raise GeneralProxyError("Empty proxy pool")
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        """Picks a proxy for a new connection."""
+        now = _clock()
+        with self._lock:
+            members = [member for member in self._members
+                       if member.retry_at <= now] or self._members
+            member = min(members, key=_ProxyPoolMember.load)
+            member.in_flight += 1
+        return member
+
+    def _record(self, member, latency=None):
+        """Records a connection's latency, or its failure if None."""
+        with self._lock:
+            if latency is None:
+                member.failures += 1
+                backoff = self.backoff * 2 ** (member.failures - 1)
+                member.retry_at = _clock() + min(backoff, self.max_backoff)
+            else:
+                member.failures = 0
+                if member.latency is None:
+                    member.latency = latency
+                else:
+                    member.latency += self.smoothing * (latency
+                                                        - member.latency)
+
+    def _record_error(self, member, error, latency):
+        """Records a connection that failed with error. Only errors
+        connecting to the proxy or talking to it count against it: a reply
+        that the destination can't be reached is a round trip like any
+        other."""
+        if _is_proxy_failure(error):
+            self._record(member)
+        elif isinstance(error, ProxyError):
+            self._record(member, latency)
+
+    def _release(self, member):
+        """Called when a connection through member is closed."""
+        with self._lock:
+            member.in_flight -= 1
+
+    def stats(self):
+        """Returns a list with a dict of statistics for each proxy."""
+        with self._lock:
+            return [{"proxy": member.proxy,
+                     "latency": member.latency,
+                     "in_flight": member.in_flight,
+                     "failures": member.failures}
+                    for member in self._members]
+
+
+def _connection_dropped(error):
+    """Whether error means the proxy closed or reset the connection."""
+    return isinstance(error, GeneralProxyError) and (
+        error.socket_err is not None
+        or error.msg == "Connection closed unexpectedly")
+
+
+def _is_proxy_failure(error):
+    """Whether error means the proxy couldn't be reached or broke the
+    protocol, rather than it replying about the destination."""
+    if isinstance(error, ProxyError):
+        return isinstance(error, (ProxyConnectionError, GeneralProxyError))
+    return isinstance(error, socket.error)
+
+
+class _ProxyPoolMember(object):
+    def __init__(self, proxy):
+        # Fill in set_proxy()'s defaults
+        proxy = tuple(proxy)
+        self.proxy = proxy + (None, None, None, True, None, None)[len(proxy):]
+        self.latency = None  # Moving average, in seconds
+        self.in_flight = 0
+        self.failures = 0  # Consecutive
+        self.retry_at = 0
+
+    def load(self):
+        # Proxies without samples yet are tried first
+        return ((self.latency or 0.0) * (self.in_flight + 1), self.in_flight)
+
+
+# Handing a standby connection over to a socksocket replaces the socket's file
+# descriptor, which only works where sockets are file descriptors
+_CAN_ADOPT_SOCKETS = os.name == "posix"
+
+
+class StandbyPool(object):
+    """Keeps connections to SOCKS5 proxies open, greeted and authenticated
+    ahead of time, so that connecting through a proxy only takes the
+    CONNECT request and its reply: a single round trip.
+
+    size -        Connections kept ready for each proxy.
+    max_idle -    Seconds a ready connection is kept before it is replaced
+                   by a fresh one, as proxies drop idle clients.
+    linger -      Seconds a proxy is kept warm after it was last asked for
+                   a connection.
+    timeout -     Timeout for making and greeting a standby connection.
+
+    Install it with set_standby_pool(). From then on, the SOCKS5 proxies
+    that socksocket.connect() and create_connection() go through are kept
+    warm by a background thread; warm() starts before the first
+    connection. Ready connections are checked for having been closed by
+    the proxy when they are taken. Proxy chains, non-blocking connects and
+    sockets bound to a source address don't use the pool. Unix only."""
+
+    def __init__(self, size=2, max_idle=30.0, linger=300.0, timeout=10.0):
+        self.size = size
+        self.max_idle = max_idle
+        self.linger = linger
+        self.timeout = timeout
+        self._proxies = {}  # (addr, port, username, password) -> _Standby
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def warm(self, proxy_type, addr, port=None, rdns=True, username=None,
+             password=None, family=socket.AF_INET):
+        """Starts keeping connections to a SOCKS5 proxy ready. Takes the
+        arguments of set_proxy(), and the address family to connect with."""
+        if proxy_type != SOCKS5:
+            raise GeneralProxyError("Only SOCKS5 proxies can be kept warm")
+        proxy = _proxy_for(proxy_type, addr, port, rdns, username, password)
+        with self._cond:
+            self._register(proxy, family)
+
+    def _register(self, proxy, family):
+        proxy_type, addr, port, rdns, username, password = proxy
+        key = addr, port or DEFAULT_PORTS[SOCKS5], username, password
+        standby = self._proxies.get(key)
+        if standby is None:
+            standby = self._proxies[key] = _Standby(proxy)
+        standby.family = family
+        standby.last_used = _clock()
+        if self._thread is None and not self._closed:
+            self._thread = threading.Thread(target=self._run,
+                                            name="socks-standby")
+            self._thread.daemon = True
+            self._thread.start()
+        self._cond.notify()
+        return standby
+
+    def _take(self, proxy, family):
+        """Returns a ready connection to proxy, or None if there's none.
+        Either way the proxy is kept warm from now on."""
+        now = _clock()
+        conn = None
+        stale = []
+        with self._cond:
+            if self._closed:
+                return None
+            standby = self._register(proxy, family)
+            while standby.ready:
+                expiry, ready = standby.ready.popleft()
+                if (expiry > now and ready.family == family
+                        and _standby_alive(ready)):
+                    conn = ready
+                    break
+                standby.dead += 1
+                stale.append(ready)
+            if conn is None:
+                standby.missed += 1
+            else:
+                standby.taken += 1
+        for ready in stale:
+            ready.close()
+        return conn
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                standby, stale, wait = self._plan(_clock())
+                if standby is None and not stale:
+                    self._cond.wait(wait)
+                    continue
+            for conn in stale:
+                conn.close()
+            if standby is not None:
+                self._fill(standby)
+
+    def _plan(self, now):
+        """Returns the proxy to make a connection to next (or None), the
+        connections to close, and how long to wait if there's nothing to
+        do."""
+        stale = []
+        deadlines = []
+        for key, standby in list(self._proxies.items()):
+            if standby.last_used + self.linger <= now:
+                # Nobody has asked for this proxy in a while
+                del self._proxies[key]
+                stale.extend(conn for _, conn in standby.ready)
+                continue
+            deadlines.append(standby.last_used + self.linger)
+            while standby.ready and standby.ready[0][0] <= now:
+                stale.append(standby.ready.popleft()[1])
+                standby.expired += 1
+            if standby.ready:
+                deadlines.append(standby.ready[0][0])
+            if len(standby.ready) < self.size:
+                if standby.retry_at <= now:
+                    return standby, stale, 0
+                deadlines.append(standby.retry_at)
+        return None, stale, max(min(deadlines) - now, 0) if deadlines else None
+
+    def _fill(self, standby):
+        """Makes a standby connection to the proxy."""
+        try:
+            conn = self._connect(standby.proxy, standby.family)
+        except (socket.error, ProxyError) as error:
+            log.debug("Standby connection to SOCKS5 proxy %s:%s failed: %s",
+                      standby.proxy[1], standby.proxy[2], error)
+            with self._cond:
+                standby.failures += 1
+                backoff = 2 ** min(standby.failures - 1, 6)
+                standby.retry_at = _clock() + backoff
+            return
+        with self._cond:
+            standby.failures = 0
+            # It may have lingered away meanwhile
+            if (not self._closed and conn.family == standby.family
+                    and standby in self._proxies.values()):
+                standby.ready.append((_clock() + self.max_idle, conn))
+                return
+        conn.close()
+
+    def _connect(self, proxy, family):
+        """Connects to the proxy and runs the greeting with blocking I/O."""
+        proxy_type, addr, port, rdns, username, password = proxy
+        port = port or DEFAULT_PORTS[SOCKS5]
+        err = None
+        for family, socket_type, proto, _, sa in _proxy_getaddrinfo(
+                addr, port, family):
+            conn = _orig_socket(family, socket_type, proto)
+            try:
+                conn.settimeout(self.timeout)
+                conn.connect(sa)
+                reader = _SocketReader(conn)
+                greeting = _SOCKS5_greeting(proxy)
+                try:
+                    result = None
+                    while True:
+                        op, arg = greeting.send(result)
+                        result = None
+                        if op == _SEND:
+                            conn.sendall(arg)
+                        elif op == _RECV:
+                            result = reader.read(arg)
+                        elif op == _DONE:
+                            break
+                finally:
+                    greeting.close()
+                conn.settimeout(0.0)
+                return conn
+            except ProxyError:
+                conn.close()
+                raise
+            except socket.error as e:
+                conn.close()
+                err = e
+        if err is not None:
+            _proxy_failed(addr, port)
+        raise err or socket.error("gai returned empty list.")
+
+    def close(self):
+        """Closes the ready connections and stops making new ones."""
+        with self._cond:
+            self._closed = True
+            stale = [conn for standby in self._proxies.values()
+                     for _, conn in standby.ready]
+            self._proxies.clear()
+            self._cond.notify()
+        for conn in stale:
+            conn.close()
+
+    def stats(self):
+        """Returns a list with a dict of statistics for each proxy kept
+        warm."""
+        with self._cond:
+            return [{"proxy": standby.proxy[:3],
+                     "ready": len(standby.ready),
+                     "taken": standby.taken,
+                     "missed": standby.missed,
+                     "expired": standby.expired,
+                     "dead": standby.dead,
+                     "failures": standby.failures}
+                    for standby in self._proxies.values()]
+
+
+class _Standby(object):
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.family = socket.AF_INET
+        self.ready = deque()  # (expiry, connection), oldest first
+        self.last_used = 0
+        self.retry_at = 0
+        self.failures = 0  # Consecutive
+        self.taken = 0
+        self.missed = 0
+        self.expired = 0
+        self.dead = 0
+
+
+def _standby_alive(conn):
+    """An idle connection to a SOCKS5 proxy has nothing to read, unless the
+    proxy closed it."""
+    try:
+        conn.recv(1, socket.MSG_PEEK)
+    except socket.error as e:
+        return e.errno in (EAGAIN, EWOULDBLOCK)
+    return False
+
+
+_standby_pool = None
+
+
+def set_standby_pool(pool):
+    """Sets the StandbyPool that connections to SOCKS5 proxies are taken
+    from. Pass None to stop using it; closing it is up to the caller."""
+    global _standby_pool
+    _standby_pool = pool
+
+
+def get_standby_pool():
+    """Returns the StandbyPool set by set_standby_pool(), if any."""
+    return _standby_pool
+
+
+# The proxy handshakes are written as generators that never touch the network
+# themselves. They yield (op, arg) pairs describing the I/O they need and are
+# resumed with its result, so socksocket can drive them with blocking socket
+# calls or one readiness event at a time (see _NonBlockingHandshake), while
+# asyncsocks drives the very same code on an asyncio event loop.
+# Received data is passed in as a memoryview which is only valid until the
+# next op, so handshakes unpack what they need straight away.
+_CONNECT = 0  # Not yielded by handshakes; waiting for connect() to finish
+_SEND = 1  # arg: bytes to send; resumed with None
+_RECV = 2  # arg: exact number of bytes; resumed with the bytes
+_RECV_HEADERS = 3  # arg: size limit; resumed with bytes up to the blank line
+_DONE = 4  # arg: the handshake result
+_PHASE = 5  # arg: name of the phase starting now; resumed with None
+_TLS = 6  # Not yielded by handshakes; arg: _TLSLayer to finish handshaking
+
+MAX_HTTP_HEADERS_SIZE = 65536
+MAX_UDP_HEADER_CACHE_SIZE = 1024
+
+# socket.sendmsg() is Python 3 on Unix only
+_HAS_SENDMSG = hasattr(_orig_socket, "sendmsg")
+
+# UDP generic segmentation offload (Linux 4.18+) sends several datagrams of
+# the same size to the same destination in one system call
+if _HAS_SENDMSG and sys.platform.startswith("linux"):
+    _UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+else:
+    _UDP_SEGMENT = None
+_UDP_MAX_SEGMENTS = 64
+_SOL_UDP = getattr(socket, "SOL_UDP", 17)
+_UDP_MAX_GSO_SIZE = 65507  # Largest IPv4 UDP payload
+_UDP_GSO_MAX_SEGMENT = 1452  # Fits a 1500 byte MTU over IPv6
+
+
+_SOCKS5_addresses = OrderedDict()  # (host, port, rdns) -> (bytes, resolved)
+_SOCKS5_addresses_lock = threading.Lock()
+MAX_SOCKS5_ADDRESS_CACHE_SIZE = 1024
+
+
+def _write_SOCKS5_address(addr, file, rdns):
+    """
+    Write the host and port packed for the SOCKS5 protocol to file,
+    and return the resolved address as a tuple object.
+
+    Encoded addresses are kept in an LRU cache, unless they had to be
+    resolved locally, which is left to the DNS cache.
+    """
+    key = addr[0], addr[1], bool(rdns)
+    with _SOCKS5_addresses_lock:
+        cached = _SOCKS5_addresses.pop(key, None)
+        if cached is not None:
+            _SOCKS5_addresses[key] = cached  # Most recently used last
+    if cached is None:
+        encoded, resolved, local = _encode_SOCKS5_address(addr, rdns)
+        cached = encoded, resolved
+        if not local:
+            with _SOCKS5_addresses_lock:
+                if len(_SOCKS5_addresses) >= MAX_SOCKS5_ADDRESS_CACHE_SIZE:
+                    _SOCKS5_addresses.popitem(last=False)
+                _SOCKS5_addresses[key] = cached
+    file.write(cached[0])
+    return cached[1]
+
+
+def _encode_SOCKS5_address(addr, rdns):
+    """
+    Return the host and port packed for the SOCKS5 protocol, the resolved
+    address as a tuple object, and whether it was resolved locally.
+    """
+    host, port = addr
+    family_to_byte = {socket.AF_INET: b"\x01", socket.AF_INET6: b"\x04"}
+    port_bytes = struct.pack(">H", port)
+
+    # If the given destination address is an IP address, we'll
+    # use the IP address request even if remote resolving was specified.
+    # Detect whether the address is IPv4/6 directly.
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            addr_bytes = socket.inet_pton(family, host)
+        except socket.error:
+            continue
+        host = socket.inet_ntop(family, addr_bytes)
+        return (family_to_byte[family] + addr_bytes + port_bytes,
+                (host, port), False)
+
+    # Well it's not an IP number, so it's probably a DNS name.
+    if rdns:
+        # Resolve remotely
+        host_bytes = host.encode("idna")
+        return (b"\x03" + chr(len(host_bytes)).encode() + host_bytes
+                + port_bytes, (host, port), False)
+
+    # Resolve locally
+    addresses = _getaddrinfo(host, port, socket.AF_UNSPEC,
+                             socket.SOCK_STREAM,
+                             socket.IPPROTO_TCP,
+                             socket.AI_ADDRCONFIG)
+    # We can't really work out what IP is reachable, so just pick the
+    # first.
+    target_addr = addresses[0]
+    family = target_addr[0]
+    host = target_addr[4][0]
+
+    addr_bytes = socket.inet_pton(family, host)
+    host = socket.inet_ntop(family, addr_bytes)
+    return (family_to_byte[family] + addr_bytes + port_bytes, (host, port),
+            True)
+
+
+def _read_SOCKS5_udp_header(view):
+    """
+    Parse the header of a datagram from a SOCKS5 UDP relay.
+    Returns the header length and the source address as a tuple object.
+    """
+    try:
+        frag, atyp = struct.unpack_from("xxBB", view)
+        if frag:
+            raise NotImplementedError("Received UDP packet fragment")
+        if atyp == 1:
+            end = 8
+            addr = socket.inet_ntoa(view[4:end].tobytes())
+        elif atyp == 3:
+            end = 5 + struct.unpack_from("B", view, 4)[0]
+            addr = view[5:end].tobytes()
+        elif atyp == 4:
+            end = 20
+            addr = socket.inet_ntop(socket.AF_INET6, view[4:end].tobytes())
+        else:
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+        port, = struct.unpack_from(">H", view, end)
+    except (struct.error, ValueError, socket.error):
+        # Truncated
+        raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+    return end + 2, (addr, port)
+
+
+def _SOCKS5_greeting(proxy, pipelined_request=None):
+    """
+    Handshake selecting the SOCKS5 authentication method and
+    authenticating, which readies the connection for a request.
+
+    If pipelined_request is given, it is sent together with the greeting
+    and the authentication instead of waiting for each reply in turn.
+    """
+    proxy = _as_proxy(proxy)
+    proxy_type, addr, port, rdns, username, password = proxy
+    pipeline = pipelined_request is not None
+    known_auth = _capability(proxy, "auth_method")
+    auth = proxy.socks5_auth
+
+    yield _PHASE, "method"
+    if pipeline:
+        # Only offer the method we are going to use, so that everything
+        # following the greeting is interpreted the way we expect. With
+        # credentials that's username/password, unless this proxy is
+        # known not to want them.
+        if username and password and known_auth != 0x00:
+            offered = 0x02
+            yield _SEND, b"\x05\x01\x02" + auth + pipelined_request
+        else:
+            offered = 0x00
+            yield _SEND, b"\x05\x01\x00" + pipelined_request
+
+    # First we'll send the authentication packages we support: with a
+    # username/password, USERNAME/PASSWORD in addition to the standard
+    # none, otherwise only none.
+    else:
+        yield _SEND, proxy.socks5_greeting
+
+    # We'll receive the server's response to determine which
+    # method was selected
+    version, chosen_auth = struct.unpack("BB", (yield _RECV, 2))
+
+    if version != 0x05:
+        raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+
+    if pipeline and username and password and chosen_auth != offered:
+        # Unlike the lock-step handshake we didn't offer both methods,
+        # and what we sent after the greeting is now garbage to the
+        # server. Only a new connection can recover.
+        if known_auth == offered:
+            # It chose this method before; don't pipeline it any more
+            _learn(proxy, "pipeline", False)
+        elif chosen_auth in (0x00, 0x02):
+            _learn(proxy, "auth_method", chosen_auth)
+        raise SOCKS5PipelineError(
+            "SOCKS5 proxy server did not accept the pipelined"
+            " authentication method")
+    if chosen_auth in (0x00, 0x02) and chosen_auth != known_auth:
+        _learn(proxy, "auth_method", chosen_auth)
+
+    # Check the chosen authentication method
+
+    if chosen_auth == 0x02:
+        # Okay, we need to perform a basic username/password
+        # authentication.
+        if not (username and password):
+            # Although we said we don't support authentication, the
+            # server may still request basic username/password
+            # authentication
+            raise SOCKS5AuthError("No username/password supplied. "
+                                  "Server requested username/password"
+                                  " authentication")
+
+        yield _PHASE, "auth"
+        if not pipeline:
+            yield _SEND, auth
+        version, auth_status = struct.unpack("BB", (yield _RECV, 2))
+        if version != 0x01:
+            # Bad response
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+        if auth_status != 0x00:
+            # Authentication failed
+            raise SOCKS5AuthError("SOCKS5 authentication failed")
+
+        # Otherwise, authentication succeeded
+
+    # No authentication is required if 0x00
+    elif chosen_auth != 0x00:
+        # Reaching here is always bad
+        if chosen_auth == 0xFF:
+            raise SOCKS5AuthError(
+                "All offered SOCKS5 authentication methods were rejected")
+        else:
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+
+    yield _DONE, None
+
+
+def _SOCKS5_handshake(proxy, cmd, dst, pipeline=False, greeted=False):
+    """
+    Handshake sending a SOCKS5 request with given command (CMD field) and
+    address (DST field). Finishes with the resolved DST address that was
+    used and the bound address.
+
+    If pipeline is true, the greeting, the authentication and the request
+    are sent together instead of waiting for each reply in turn, unless the
+    capability cache knows that the proxy can't take that. If greeted is
+    true, the connection has been through _SOCKS5_greeting() already.
+    """
+    proxy = _as_proxy(proxy)
+    proxy_type, addr, port, rdns, username, password = proxy
+    pipeline = (pipeline and not greeted
+                and _capability(proxy, "pipeline") is not False)
+
+    request = BytesIO()
+    request.write(b"\x05" + cmd + b"\x00")
+    resolved = _write_SOCKS5_address(dst, request, rdns)
+
+    if not greeted:
+        greeting = _SOCKS5_greeting(
+            proxy, request.getvalue() if pipeline else None)
+        try:
+            result = None
+            while True:
+                op, arg = greeting.send(result)
+                if op == _DONE:
+                    break
+                result = yield op, arg
+        finally:
+            greeting.close()
+
+    # Now we can request the actual connection
+    yield _PHASE, "request"
+    if not pipeline:
+        yield _SEND, request.getvalue()
+
+    # Get the response, together with the address type and the first byte
+    # of the bound address, which tells how much is left to read
+    version, status, atyp, first = struct.unpack("BBxBB", (yield _RECV, 5))
+    if version != 0x05:
+        raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+
+    if status != 0x00:
+        # Connection failed: server returned an error
+        error = SOCKS5_ERRORS.get(status, "Unknown error")
+        raise SOCKS5Error("{:#04x}: {}".format(status, error))
+
+    # Get the bound address/port
+    if atyp == 0x01:
+        rest = yield _RECV, 4 - 1 + 2
+        bnd_addr = socket.inet_ntoa(struct.pack("B", first)
+                                    + rest[:3].tobytes())
+    elif atyp == 0x03:
+        rest = yield _RECV, first + 2
+        bnd_addr = rest[:first].tobytes()
+    elif atyp == 0x04:
+        rest = yield _RECV, 16 - 1 + 2
+        bnd_addr = socket.inet_ntop(socket.AF_INET6, struct.pack("B", first)
+                                    + rest[:15].tobytes())
+    else:
+        raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+
+    bnd_port, = struct.unpack_from(">H", rest, len(rest) - 2)
+    yield _DONE, (resolved, (bnd_addr, bnd_port))
+
+
+def _SOCKS5_connect_handshake(proxy, dest_addr, dest_port, pipeline=False):
+    """Handshake for a stream connection through a SOCKS5 server."""
+    CONNECT = b"\x01"
+    return _SOCKS5_handshake(proxy, CONNECT, (dest_addr, dest_port), pipeline)
+
+
+def _SOCKS4_handshake(proxy, dest_addr, dest_port, pipeline=False):
+    """Handshake for a connection through a SOCKS4 server.
+
+    Finishes with the destination and the bound address. This is a single
+    round trip already, so pipeline makes no difference."""
+    proxy = _as_proxy(proxy)
+    proxy_type, addr, port, rdns, username, password = proxy
+
+    # Check if the destination address provided is an IP address
+    remote_resolve = False
+    socks4a = _capability(proxy, "socks4a")
+    try:
+        addr_bytes = socket.inet_aton(dest_addr)
+    except socket.error:
+        # It's a DNS name. Check where it should be resolved.
+        if rdns and socks4a is not False:
+            addr_bytes = b"\x00\x00\x00\x01"
+            remote_resolve = True
+        else:
+            addr_bytes = socket.inet_aton(_gethostbyname(dest_addr))
+
+    # Construct the request packet
+    request = [struct.pack(">BBH", 0x04, 0x01, dest_port), addr_bytes,
+               proxy.socks4_userid]
+
+    # DNS name if remote resolving is required
+    # NOTE: This is actually an extension to the SOCKS4 protocol
+    # called SOCKS4A and may not be supported in all cases.
+    if remote_resolve:
+        request.append(dest_addr.encode("idna") + b"\x00")
+    yield _PHASE, "request"
+    yield _SEND, b"".join(request)
+
+    # Get the response from the server
+    resp = yield _RECV, 8
+    version, status, bnd_port = struct.unpack_from(">BBH", resp)
+    if version != 0x00:
+        # Bad data
+        raise GeneralProxyError("SOCKS4 proxy server sent invalid data")
+
+    if status != 0x5A:
+        # Connection failed: server returned an error
+        error = SOCKS4_ERRORS.get(status, "Unknown error")
+        raise SOCKS4Error("{:#04x}: {}".format(status, error))
+
+    # Get the bound address/port
+    sockname = (socket.inet_ntoa(resp[4:].tobytes()), bnd_port)
+    if remote_resolve:
+        if not socks4a:
+            _learn(proxy, "socks4a", True)
+        peername = socket.inet_ntoa(addr_bytes), dest_port
+    else:
+        peername = dest_addr, dest_port
+    yield _DONE, (peername, sockname)
+
+
+def _parse_HTTP_response(response):
+    """Parses an HTTP response header block.
+
+    Returns the protocol version, status code, reason phrase and a dict of
+    the header fields, with lowercase names."""
+    lines = response.tobytes().decode("iso-8859-1").split("\n")
+    status_line = lines[0].rstrip("\r")
+
+    if not status_line:
+        raise GeneralProxyError("Connection closed unexpectedly")
+
+    try:
+        proto, status_code, status_msg = status_line.split(" ", 2)
+    except ValueError:
+        raise GeneralProxyError("HTTP proxy server sent invalid response")
+
+    if not proto.startswith("HTTP/"):
+        raise GeneralProxyError(
+            "Proxy server does not appear to be an HTTP proxy")
+
+    try:
+        status_code = int(status_code)
+    except ValueError:
+        raise HTTPError(
+            "HTTP proxy server did not return a valid HTTP status")
+
+    headers = {}
+    name = None
+    for line in lines[1:]:
+        line = line.rstrip("\r")
+        if not line:
+            break
+        if line[0] in " \t" and name:  # Obsolete line folding
+            headers[name] += " " + line.strip()
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise GeneralProxyError("HTTP proxy server sent invalid response")
+        name = name.strip().lower()
+        if name in headers:
+            headers[name] += ", " + value.strip()
+        else:
+            headers[name] = value.strip()
+    return proto, status_code, status_msg.rstrip(), headers
+
+
+def _HTTP_reusable_body(proto, headers):
+    """Length of the body of a response after which the proxy keeps the
+    connection open for another request, or None if it doesn't (or the
+    body is too long to be worth skipping)."""
+    connection = (headers.get("connection", "") + ","
+                  + headers.get("proxy-connection", "")).lower()
+    tokens = set(token.strip() for token in connection.split(","))
+    if "close" in tokens or proto == "HTTP/1.0" and "keep-alive" not in tokens:
+        return None
+    if "transfer-encoding" in headers:
+        return None
+    try:
+        length = int(headers.get("content-length", ""))
+    except ValueError:
+        return None  # Delimited by closing the connection
+    if not 0 <= length <= MAX_HTTP_HEADERS_SIZE:
+        return None
+    return length
+
+
+def _HTTP_handshake(proxy, dest_addr, dest_port, pipeline=False,
+                    resolved=None, authorized=False):
+    """Handshake for a connection through an HTTP server.
+
+    Finishes with the destination and the (unknown) bound address. This is
+    a single round trip already, so pipeline makes no difference.
+    Credentials are sent up front; a username without a password is only
+    sent when the proxy asks for it with a 407, on the same connection if
+    the proxy keeps it open. Otherwise HTTPAuthRetryError asks for a new
+    connection, whose handshake is to be made with authorized true to send
+    it up front; a 407 then fails with HTTPError. resolved is dest_addr
+    already resolved locally, by callers which can't wait for
+    _gethostbyname().
+    NOTE: This currently only supports HTTP CONNECT-style proxies."""
+    proxy = _as_proxy(proxy)
+    proxy_type, addr, port, rdns, username, password = proxy
+
+    # If we need to resolve locally, we do this now
+    addr = dest_addr if rdns else resolved or _gethostbyname(dest_addr)
+
+    http_headers = [
+        (b"CONNECT " + addr.encode("idna") + b":"
+         + str(dest_port).encode() + b" HTTP/1.1"),
+        b"Host: " + dest_addr.encode("idna")
+    ]
+    authorization = [proxy.http_authorization] if username else []
+    authorized = bool(username and (password or authorized
+                                    or _capability(proxy, "http_auth")))
+
+    yield _PHASE, "request"
+    while True:
+        yield _SEND, b"\r\n".join(
+            http_headers + (authorization if authorized else [])
+            + [b"\r\n"])
+        response = yield _RECV_HEADERS, MAX_HTTP_HEADERS_SIZE
+        proto, status_code, status_msg, headers = _parse_HTTP_response(
+            response)
+        if status_code != 407 or authorized or not username:
+            break
+        # From now on, send them up front
+        _learn(proxy, "http_auth", True)
+        length = _HTTP_reusable_body(proto, headers)
+        if length is None:
+            raise HTTPAuthRetryError("{}: {}".format(status_code,
+                                                     status_msg))
+        if length:
+            yield _RECV, length  # Skip the error page
+        authorized = True
+        yield _PHASE, "auth"
+
+    if status_code != 200:
+        error = "{}: {}".format(status_code, status_msg)
+        if status_code in (400, 403, 405):
+            # It's likely that the HTTP proxy server does not support the
+            # CONNECT tunneling method
+            error += ("\n[*] Note: The HTTP proxy server may not be"
+                      " supported by PySocks (must be a CONNECT tunnel"
+                      " proxy)")
+        raise HTTPError(error)
+
+    yield _DONE, ((addr, dest_port), (b"0.0.0.0", 0))
+
+
+_handshakes = {
+    SOCKS4: _SOCKS4_handshake,
+    SOCKS5: _SOCKS5_connect_handshake,
+    HTTP: _HTTP_handshake,
+    HTTPS: _HTTP_handshake  # Once TLS is up
+}
+
+
+class _SocketReader(object):
+    """Receives handshake replies into a reusable buffer with recv_into().
+
+    Never reads past what was asked for, so no tunnel data is lost."""
+
+    def __init__(self, sock, size=262):  # Longest SOCKS5 reply
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def _recv_into(self, start, stop):
+        view = self.view[start:stop]
+        while view:
+            received = self.sock.recv_into(view)
+            if not received:
+                return False
+            view = view[received:]
+        return True
+
+    def read(self, count):
+        """Receive EXACTLY count bytes.
+
+        Returns a memoryview, which is only valid until the next call."""
+        if count > len(self.buffer):
+            self.buffer = bytearray(count)
+            self.view = memoryview(self.buffer)
+        if not self._recv_into(0, count):
+            raise GeneralProxyError("Connection closed unexpectedly")
+        return self.view[:count]
+
+    def read_headers(self, limit):
+        """Receive an HTTP header block, up to and including the blank line.
+
+        Returns whatever was received if the connection closes early."""
+        end = 0
+        while True:
+            buffer, received, complete = _recv_header_part(
+                self.sock, self.buffer, end, limit)
+            if buffer is not self.buffer:
+                self.buffer, self.view = buffer, memoryview(buffer)
+            end += received
+            if complete or not received:
+                return self.view[:end]
+
+
+# Bytes peeked at a time for the end of an HTTP header block
+_HTTP_PEEK_SIZE = 1024
+
+
+def _recv_header_part(sock, buffer, end, limit):
+    """Receives more of an HTTP header block into the bytearray buffer,
+    which holds end bytes of it already.
+
+    Peeks at what has arrived, into the buffer itself, and then receives
+    it up to and including the blank line, so that no tunnel data is taken
+    and headers usually take just two system calls. Returns the buffer,
+    grown if need be, the number of bytes received (0 when the connection
+    closed) and whether the header block is complete."""
+    window = min(_HTTP_PEEK_SIZE, limit + 1 - end)
+    if end + window > len(buffer):
+        grown = bytearray(max(end + window, 2 * len(buffer)))
+        grown[:end] = buffer[:end]
+        buffer = grown
+    view = memoryview(buffer)
+    peeked = sock.recv_into(view[end:end + window], window, socket.MSG_PEEK)
+    # The blank line may straddle what we already have
+    found = buffer.find(b"\r\n\r\n", max(end - 3, 0), end + peeked)
+    count = found + 4 - end if found >= 0 else peeked
+    received = sock.recv_into(view[end:end + count], count) if count else 0
+    complete = found >= 0 and received == count
+    if not complete and end + received > limit:
+        raise GeneralProxyError("HTTP proxy server sent oversized headers")
+    return buffer, received, complete
+
+
+class _NonBlockingHandshake(object):
+    """Drives a handshake generator on a non-blocking socket.
+
+    Starts out waiting for the socket's connect() to finish, unless TCP
+    Fast Open is on (fast_open), which may defer connect() to the first
+    send; the handshake then starts sending straight away. step() then
+    makes as much progress as the socket allows without blocking;
+    wants_read and wants_write tell which event to wait for in between."""
+
+    def __init__(self, sock, handshake, fast_open=False):
+        self.sock = sock
+        self.handshake = handshake
+        self.fast_open = fast_open
+        self.buffer = bytearray(262)  # Longest SOCKS5 reply
+        self.op, self.arg = _CONNECT, None
+        self.done = 0  # Bytes sent or received so far for the current op
+
+    @property
+    def wants_read(self):
+        return self.op in (_RECV, _RECV_HEADERS, _TLS)
+
+    @property
+    def wants_write(self):
+        return self.op in (_CONNECT, _SEND)
+
+    @property
+    def result(self):
+        return self.arg if self.op == _DONE else None
+
+    def _resume(self, result=None):
+        self.op, self.arg = self.handshake.send(result)
+        while self.op == _PHASE:  # Only the blocking driver times phases
+            self.op, self.arg = self.handshake.send(None)
+        self.done = 0
+        if self.op == _SEND:
+            self.arg = memoryview(self.arg)
+        elif self.op == _RECV and self.arg > len(self.buffer):
+            self.buffer = bytearray(self.arg)
+
+    def _connected(self):
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise socket.error(error, os.strerror(error))
+        try:
+            _orig_socket.getpeername(self.sock)
+        except socket.error as e:
+            if e.errno == ENOTCONN:
+                return False
+            raise
+        return True
+
+    def _recv_headers(self):
+        """Like _SocketReader.read_headers(), but returns None when the
+        header block is incomplete and nothing more can be read yet."""
+        self.buffer, received, complete = _recv_header_part(
+            self.sock, self.buffer, self.done, self.arg)
+        self.done += received
+        if complete or not received:
+            return memoryview(self.buffer)[:self.done]
+        return None
+
+    def step(self):
+        """Returns True once the handshake is finished."""
+        try:
+            while self.op != _DONE:
+                if self.op == _CONNECT:
+                    if not self.fast_open and not self._connected():
+                        return False
+                    self._resume()
+                elif self.op == _TLS:
+                    self.arg.do_handshake()
+                    self._resume()
+                elif self.op == _SEND:
+                    self.done += self.sock.send(self.arg[self.done:])
+                    if self.done == len(self.arg):
+                        self._resume()
+                elif self.op == _RECV:
+                    view = memoryview(self.buffer)[:self.arg]
+                    received = self.sock.recv_into(view[self.done:])
+                    if not received:
+                        raise GeneralProxyError(
+                            "Connection closed unexpectedly")
+                    self.done += received
+                    if self.done == self.arg:
+                        self._resume(view)
+                else:
+                    headers = self._recv_headers()
+                    if headers is None:
+                        return False
+                    self._resume(headers)
+        except socket.error as e:
+            # A first send with TCP Fast Open but no cookie yet only sends
+            # the SYN, and fails with EINPROGRESS
+            if e.errno in (EAGAIN, EWOULDBLOCK, EINPROGRESS):
+                return False
+            raise
+        self.handshake.close()
+        return True
+
+    def close(self):
+        self.handshake.close()
 
 
 def set_default_proxy(proxy_type=None, addr=None, port=None, rdns=True,
-                      username=None, password=None):
+                      username=None, password=None, pipeline=False,
+                      fast_open=False, tls=None):
     """Sets a default proxy.
 
     All further socksocket objects will use the default unless explicitly
     changed. All parameters are as for socket.set_proxy()."""
-    socksocket.default_proxy = (proxy_type, addr, port, rdns,
-                                username.encode() if username else None,
-                                password.encode() if password else None)
+    socksocket.default_proxy = _proxy_for(proxy_type, addr, port, rdns,
+                                          username, password)
+    socksocket.default_proxy_options = {"pipeline": pipeline,
+                                        "fast_open": fast_open, "tls": tls}
 
 
 def setdefaultproxy(*args, **kwargs):
@@ -150,12 +2018,89 @@ def wrap_module(module):
 wrapmodule = wrap_module
 
 
+def _happy_eyeballs(addrinfos, delay, timeout, prepare):
+    """Connect to the first reachable address of addrinfos (RFC 8305).
+
+    Attempts alternate between address families and a new one starts every
+    delay seconds, or as soon as the previous one failed, while earlier
+    ones are still pending. prepare(sock) is called on each new socksocket
+    before it connects. Returns the first socksocket to connect and its
+    addrinfo, and closes the others; raises the last error if none
+    connects."""
+    # Interleave the address families, keeping getaddrinfo()'s preference
+    by_family = OrderedDict()
+    for info in addrinfos:
+        by_family.setdefault(info[0], []).append(info)
+    queue = []
+    while any(by_family.values()):
+        for infos in by_family.values():
+            if infos:
+                queue.append(infos.pop(0))
+
+    pending = {}  # socksocket -> attempt deadline
+    err = None
+    next_attempt = _clock()
+    try:
+        while queue or pending:
+            now = _clock()
+            if queue and (now >= next_attempt or not pending):
+                info = queue.pop(0)
+                family, socket_type, proto, canonname, sa = info
+                sock = socksocket(family, socket_type, proto)
+                try:
+                    prepare(sock)
+                    _orig_socket.settimeout(sock, 0.0)
+                    code = _orig_socket.connect_ex(sock, sa)
+                    if code == 0:
+                        return sock, info
+                    if code not in (EINPROGRESS, EWOULDBLOCK):
+                        raise socket.error(code, os.strerror(code))
+                except socket.error as e:
+                    err = e
+                    sock.close()
+                    continue
+                pending[sock] = (info, now + timeout if timeout is not None
+                                 else None)
+                next_attempt = now + delay
+
+            deadlines = [d for _, d in pending.values() if d is not None]
+            if queue:
+                deadlines.append(next_attempt)
+            wait = max(min(deadlines) - now, 0) if deadlines else None
+            # Failed attempts are writable too; SO_ERROR tells them apart
+            _, writable = _wait_ready([], list(pending), wait)
+
+            now = _clock()
+            for sock in writable:
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0:
+                    info, _ = pending.pop(sock)
+                    return sock, info
+                # Start the next attempt right away
+                err = socket.error(code, os.strerror(code))
+                del pending[sock]
+                sock.close()
+                next_attempt = now
+            for sock, (_, deadline) in list(pending.items()):
+                if deadline is not None and deadline <= now:
+                    err = socket.timeout("timed out")
+                    del pending[sock]
+                    sock.close()
+    finally:
+        for sock in pending:
+            sock.close()
+
+    raise err
+
+
 def create_connection(dest_pair,
                       timeout=None, source_address=None,
                       proxy_type=None, proxy_addr=None,
                       proxy_port=None, proxy_rdns=True,
                       proxy_username=None, proxy_password=None,
-                      socket_options=None):
+                      socket_options=None, proxy_pipeline=False,
+                      happy_eyeballs_delay=0.25, proxies=None,
+                      proxy_fast_open=False, proxy_tls=None):
     """create_connection(dest_pair, *[, timeout], **proxy_args) -> socket object
 
     Like socket.create_connection(), but connects to proxy
@@ -166,7 +2111,46 @@ def create_connection(dest_pair,
     timeout - Optional socket timeout value, in seconds.
     source_address - tuple (host, port) for the socket to bind to as its source
     address before connecting (only for compatibility)
+    happy_eyeballs_delay - When the proxy has several addresses, start a
+    connection attempt to the next one every this many seconds instead of
+    waiting for the previous attempt to time out (RFC 8305). None tries
+    them one at a time.
+    proxies - Instead of a single proxy, a chain of them as accepted by
+    socksocket.set_proxy_chain().
+    proxy_fast_open - Use TCP Fast Open to the proxy, see set_proxy().
+    The proxy's addresses are then tried one at a time, as the first bytes
+    have to go with each SYN: happy_eyeballs_delay doesn't apply.
+    proxy_tls - Connect to the proxy over TLS, see set_proxy(), or to the
+    hops of proxies, see set_proxy_chain().
     """
+    if isinstance(proxy_type, Proxy):
+        (proxy_type, proxy_addr, proxy_port, proxy_rdns, proxy_username,
+         proxy_password) = proxy_type
+    if isinstance(proxy_type, ProxyPool):
+        pool = proxy_type
+        member = pool._acquire()
+        start = _clock()
+        try:
+            sock = create_connection(dest_pair, timeout, source_address,
+                                     *member.proxy,
+                                     socket_options=socket_options,
+                                     proxy_pipeline=proxy_pipeline,
+                                     happy_eyeballs_delay=happy_eyeballs_delay,
+                                     proxy_fast_open=proxy_fast_open,
+                                     proxy_tls=proxy_tls)
+        except BaseException as error:
+            pool._record_error(member, error, _clock() - start)
+            pool._release(member)
+            raise
+        pool._record(member, _clock() - start)
+        sock._proxy_pool = (pool, member, start)
+        return sock
+
+    if proxies:
+        # The first hop is the one we connect to
+        proxy_type, proxy_addr, proxy_port = (tuple(proxies[0])
+                                              + (None,) * 2)[:3]
+
     # Remove IPv6 brackets on the remote address and proxy address.
     remote_host, remote_port = dest_pair
     if remote_host.startswith("["):
@@ -174,41 +2158,514 @@ def create_connection(dest_pair,
     if proxy_addr and proxy_addr.startswith("["):
         proxy_addr = proxy_addr.strip("[]")
 
+    def prepare(sock, pipeline, http_auth=False):
+        # http_auth: retrying after HTTPAuthRetryError
+        sock._http_auth = http_auth
+        if socket_options:
+            for opt in socket_options:
+                sock.setsockopt(*opt)
+
+        if isinstance(timeout, (int, float)):
+            sock.settimeout(timeout)
+
+        if proxies:
+            sock.set_proxy_chain(proxies, pipeline, proxy_fast_open,
+                                 proxy_tls)
+        elif proxy_type:
+            sock.set_proxy(proxy_type, proxy_addr, proxy_port, proxy_rdns,
+                           proxy_username, proxy_password, pipeline,
+                           proxy_fast_open, proxy_tls)
+        if source_address:
+            sock.bind(source_address)
+
     err = None
 
     # Allow the SOCKS proxy to be on IPv4 or IPv6 addresses.
-    for r in socket.getaddrinfo(proxy_addr, proxy_port, 0, socket.SOCK_STREAM):
+    if proxy_type:
+        proxy_port = proxy_port or DEFAULT_PORTS.get(proxy_type)
+        addrinfos = _proxy_getaddrinfo(proxy_addr, proxy_port)
+    else:
+        addrinfos = socket.getaddrinfo(proxy_addr, proxy_port, 0,
+                                       socket.SOCK_STREAM)
+
+    # A ready standby connection beats racing new ones
+    standby = (_standby_pool and proxy_type == SOCKS5 and not proxies
+               and not proxy_tls)
+    if (proxy_type and proxy_port and happy_eyeballs_delay is not None
+            and len(addrinfos) > 1 and not standby and not proxy_fast_open):
+        pipeline = proxy_pipeline
+        http_auth = False
+        hook = _negotiation_hook
+        proxy = (proxy_type, proxy_addr, proxy_port)
+        dest = (remote_host, remote_port)
+        while addrinfos:
+            start = _clock() if hook else None
+            try:
+                sock, info = _happy_eyeballs(
+                    addrinfos, happy_eyeballs_delay,
+                    timeout if isinstance(timeout, (int, float)) else None,
+                    lambda sock: prepare(sock, pipeline, http_auth))
+            except socket.error as error:
+                _proxy_failed(proxy_addr, proxy_port)
+                if hook:
+                    hook("connect", start, _clock(), proxy, dest, error)
+                proxy_server = "{}:{}".format(proxy_addr, proxy_port)
+                msg = "Error connecting to {} proxy {}".format(
+                    PRINTABLE_PROXY_TYPES[proxy_type], proxy_server)
+                log.debug("%s due to: %s", msg, error)
+                raise ProxyConnectionError(msg, error)
+            if hook:
+                hook("connect", start, _clock(), proxy, dest, None)
+
+            try:
+                _orig_socket.settimeout(sock, sock.gettimeout())
+                sock._negotiate(remote_host, remote_port)
+                return sock
+            except SOCKS5PipelineError:
+                # The connection is unusable now; start over in lock-step.
+                pipeline = False
+            except HTTPAuthRetryError:
+                # Start over once, with the credentials up front
+                http_auth = True
+            except (socket.error, ProxyError) as e:
+                # Like the loop below, go on with the proxy's other
+                # addresses
+                err = e
+                sock.close()
+                addrinfos = [r for r in addrinfos if r is not info]
+        raise err
+
+    for r in addrinfos:
         family, socket_type, proto, canonname, sa = r
-        sock = None
-        try:
-            sock = socksocket(family, socket_type, proto)
+        pipeline = proxy_pipeline
+        http_auth = False
+        while True:
+            sock = None
+            try:
+                sock = socksocket(family, socket_type, proto)
+                prepare(sock, pipeline, http_auth)
+                sock.connect((remote_host, remote_port))
+                return sock
+
+            except SOCKS5PipelineError as e:
+                # The connection is unusable now; start over in lock-step.
+                err = e
+                pipeline = False
+                continue
+
+            except HTTPAuthRetryError as e:
+                # Start over once, with the credentials up front
+                err = e
+                http_auth = True
+                continue
+
+            except (socket.error, ProxyError) as e:
+                err = e
+                if sock:
+                    sock.close()
+                    sock = None
+                break
+
+    if err:
+        raise err
+
+    raise socket.error("gai returned empty list.")
 
+
+def create_connections(dests, timeout=None, source_address=None,
+                       proxy_type=None, proxy_addr=None,
+                       proxy_port=None, proxy_rdns=True,
+                       proxy_username=None, proxy_password=None,
+                       socket_options=None, proxy_pipeline=False,
+                       proxies=None, proxy_fast_open=False, proxy_tls=None,
+                       concurrency=64, deadline=None):
+    """create_connections(dests, *[, timeout], **proxy_args) -> iterator
+
+    Connects to each (IP/hostname, port) pair in dests through the proxy,
+    negotiating up to concurrency tunnels at a time on non-blocking
+    sockets in the calling thread. Yields (dest_pair, socket, None) for
+    each connection as soon as it is established, and
+    (dest_pair, None, error) for each one that failed, in the order they
+    finish. A failure doesn't stop the other connections.
+
+    timeout - Limits each connection attempt, and is set on the sockets
+    returned, as with create_connection().
+    deadline - Seconds after which connections not established yet fail
+    with socket.timeout, including those not started yet.
+    The other arguments are those of create_connection(), except for
+    happy_eyeballs_delay: each connection is made to the first address of
+    its proxy, or of its destination when there is no proxy.
+    """
+    stop = _clock() + deadline if deadline is not None else None
+    if isinstance(proxy_type, Proxy):
+        (proxy_type, proxy_addr, proxy_port, proxy_rdns, proxy_username,
+         proxy_password) = proxy_type
+    if proxies:
+        # The first hop is the one we connect to
+        proxy_type, proxy_addr, proxy_port = (tuple(proxies[0])
+                                              + (None,) * 2)[:3]
+    if proxy_addr and proxy_addr.startswith("["):
+        proxy_addr = proxy_addr.strip("[]")
+    pool = proxy_type if isinstance(proxy_type, ProxyPool) else None
+
+    def start(dest, pipeline, http_auth):
+        sock = member = None
+        try:
+            proxy = (proxy_type, proxy_addr, proxy_port, proxy_rdns,
+                     proxy_username, proxy_password)
+            if pool:
+                # Picked here, as the socket needs the proxy's family
+                member = pool._acquire()
+                proxy = tuple(_as_proxy(member.proxy))
+            if proxy[0]:
+                # The address family of the proxy's first address
+                family = _proxy_getaddrinfo(*_as_proxy(proxy).address)[0][0]
+            else:
+                family, _, _, _, sockaddr = socket.getaddrinfo(
+                    dest[0], dest[1], 0, socket.SOCK_STREAM)[0]
+                dest = sockaddr[:2]
+            sock = socksocket(family, socket.SOCK_STREAM)
+            sock._http_auth = http_auth
+            if member:
+                sock._proxy_pool = (pool, member, _clock())
+                member = None  # Released with the socket now
             if socket_options:
                 for opt in socket_options:
                     sock.setsockopt(*opt)
-
-            if isinstance(timeout, (int, float)):
-                sock.settimeout(timeout)
-
-            if proxy_type:
-                sock.set_proxy(proxy_type, proxy_addr, proxy_port, proxy_rdns,
-                               proxy_username, proxy_password)
+            if proxies:
+                sock.set_proxy_chain(proxies, pipeline, proxy_fast_open,
+                                     proxy_tls)
+            elif proxy[0]:
+                sock.set_proxy(*proxy, pipeline=pipeline,
+                               fast_open=proxy_fast_open, tls=proxy_tls)
             if source_address:
                 sock.bind(source_address)
-
-            sock.connect((remote_host, remote_port))
-            return sock
-
+            sock.setblocking(False)
+            code = sock.connect_ex(dest)
         except (socket.error, ProxyError) as e:
-            err = e
+            if member:
+                pool._record_error(member, e, 0.0)
+                pool._release(member)
             if sock:
+                sock._record_proxy_pool(e)
                 sock.close()
-                sock = None
+            return None, e
+        if code not in (0, EINPROGRESS, EWOULDBLOCK):
+            error = socket.error(code, os.strerror(code))
+            if sock.proxy[0] is not None:
+                msg = "Error connecting to {} proxy {}:{}".format(
+                    PRINTABLE_PROXY_TYPES[sock.proxy[0]],
+                    *sock._proxy_addr())
+                error = ProxyConnectionError(msg, error)
+            sock.close()
+            return None, error
+        return sock, None
+
+    dests = iter(dests)
+    exhausted = False
+    retry = deque()  # (dest_pair, pipeline, http_auth) to start over
+    pending = {}  # socksocket -> (dest_pair, pipeline, attempt deadline)
+    try:
+        while True:
+            now = _clock()
+            while len(pending) < concurrency and (retry or not exhausted):
+                if retry:
+                    dest, pipeline, http_auth = retry.popleft()
+                else:
+                    try:
+                        dest = next(dests)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pipeline, http_auth = proxy_pipeline, False
+                if stop is not None and stop <= now:
+                    yield dest, None, socket.timeout("timed out")
+                    continue
+                sock, error = start(dest, pipeline, http_auth)
+                if error:
+                    yield dest, None, error
+                    continue
+                limit = now + timeout if timeout is not None else None
+                if stop is not None:
+                    limit = min(limit or stop, stop)
+                pending[sock] = dest, pipeline, limit
+
+            if not pending:
+                if exhausted and not retry:
+                    return
+                continue
 
-    if err:
-        raise err
+            for sock, (dest, _, limit) in list(pending.items()):
+                if limit is not None and limit <= now:
+                    del pending[sock]
+                    sock._record_proxy_pool(socket.timeout("timed out"))
+                    sock.close()
+                    yield dest, None, socket.timeout("timed out")
+            if not pending:
+                continue
+            limits = [limit for _, _, limit in pending.values()
+                      if limit is not None]
+            wait = max(min(limits) - now, 0) if limits else None
+            # Direct connections wait for connect() to finish, like proxied
+            # ones that are still connecting to the proxy
+            readers = [sock for sock in pending if sock.wants_read]
+            writers = [sock for sock in pending if not sock.wants_read]
+            # Data TLS holds decrypted doesn't make the socket readable
+            buffered = [sock for sock in pending if sock.pending()]
+            readable, writable = _wait_ready(readers, writers,
+                                             0 if buffered else wait)
+
+            for sock in set(readable + writable + buffered):
+                dest, pipeline, limit = pending.pop(sock)
+                try:
+                    if sock._handshake is None:
+                        code = sock.getsockopt(socket.SOL_SOCKET,
+                                               socket.SO_ERROR)
+                        if code:
+                            sock.close()
+                            raise socket.error(code, os.strerror(code))
+                    elif not sock.continue_negotiation():
+                        pending[sock] = dest, pipeline, limit
+                        continue
+                except SOCKS5PipelineError:
+                    # The connection is unusable now; start over in
+                    # lock-step.
+                    retry.append((dest, False, sock._http_auth))
+                    continue
+                except HTTPAuthRetryError:
+                    # Start over once, with the credentials up front
+                    retry.append((dest, pipeline, True))
+                    continue
+                except (socket.error, ProxyError) as e:
+                    yield dest, None, e
+                    continue
+                sock.settimeout(timeout)
+                yield dest, sock, None
+    finally:
+        for sock in pending:
+            sock.close()
 
-    raise socket.error("gai returned empty list.")
+
+def open_connection(*args, **kwargs):
+    """open_connection(dest_pair, **proxy_args) -> (StreamReader, StreamWriter)
+
+    Coroutine. The asyncio counterpart of create_connection(): negotiates
+    with the proxy on the running event loop and returns asyncio streams.
+    Requires Python 3.7+; see asyncsocks.open_connection() for details."""
+    from asyncsocks import open_connection
+    return open_connection(*args, **kwargs)
+
+
+_HAS_SPLICE = hasattr(os, "splice")  # Linux, Python 3.10+
+_F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", None)
+if _HAS_SPLICE:
+    _SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+
+
+class _RelayDirection(object):
+    """Moves bytes from one non-blocking socket to another.
+
+    Goes through a pipe with os.splice() where possible, so the data never
+    enters userspace, and through a buffer with recv_into()/send()
+    otherwise. At most one buffer's worth is in flight at a time, so a
+    slow writer stops reading."""
+
+    def __init__(self, src, dst, buffer_size):
+        self.src = src
+        self.dst = dst
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.pending = 0  # Bytes read but not yet written
+        self.eof = False
+        self.pipe = None
+        if _HAS_SPLICE and not (_is_tls(src) or _is_tls(dst)):
+            try:
+                self.pipe = os.pipe()
+            except OSError:
+                pass  # Out of file descriptors; copy instead
+            else:
+                if _F_SETPIPE_SZ and buffer_size != 65536:
+                    try:
+                        fcntl.fcntl(self.pipe[1], _F_SETPIPE_SZ, buffer_size)
+                    except OSError:
+                        pass
+        if self.pipe is None:
+            self.buffer = bytearray(buffer_size)
+            self.view = memoryview(self.buffer)
+            self.start = 0
+
+    @property
+    def wants_read(self):
+        return not self.eof and not self.pending
+
+    @property
+    def wants_write(self):
+        return bool(self.pending)
+
+    @property
+    def finished(self):
+        return self.eof and not self.pending
+
+    def pump(self):
+        """Reads and writes until one of them would block, or EOF."""
+        try:
+            while True:
+                if self.pending:
+                    if self.pipe:
+                        sent = os.splice(self.pipe[0], self.dst.fileno(),
+                                         self.pending, flags=_SPLICE_FLAGS)
+                    else:
+                        sent = self.dst.send(
+                            self.view[self.start:self.start + self.pending])
+                        self.start += sent
+                    self.pending -= sent
+                    self.count += sent
+                elif self.eof:
+                    return
+                else:
+                    if self.pipe:
+                        received = os.splice(self.src.fileno(), self.pipe[1],
+                                             self.buffer_size,
+                                             flags=_SPLICE_FLAGS)
+                    else:
+                        received = self.src.recv_into(self.buffer)
+                        self.start = 0
+                    if not received:
+                        self.eof = True
+                        try:
+                            self.dst.shutdown(socket.SHUT_WR)
+                        except socket.error:
+                            pass  # Already gone
+                        return
+                    self.pending = received
+        except socket.error as e:
+            if e.errno not in (EAGAIN, EWOULDBLOCK) and not _tls_blocked(e):
+                raise
+
+    def close(self):
+        if self.pipe:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+
+def _is_tls(sock):
+    # TLS sockets decrypt in userspace; no ssl module, no TLS sockets
+    if getattr(sock, "_tls", None):
+        return True
+    ssl = sys.modules.get("ssl")
+    return ssl is not None and isinstance(sock, ssl.SSLSocket)
+
+
+def _tls_blocked(error):
+    # Non-blocking ssl.SSLSockets don't raise EAGAIN but these
+    ssl = sys.modules.get("ssl")
+    return ssl is not None and isinstance(
+        error, (ssl.SSLWantReadError, ssl.SSLWantWriteError))
+
+
+def _relay_directions(sock_a, sock_b, buffer_size):
+    directions = [_RelayDirection(sock_a, sock_b, buffer_size)]
+    try:
+        directions.append(_RelayDirection(sock_b, sock_a, buffer_size))
+    except BaseException:
+        directions[0].close()
+        raise
+    return directions
+
+
+def _relay_pump(directions, readable=None, writable=None):
+    """Pumps the directions whose socket is ready (or all of them).
+
+    Returns True when the relay is over: both sides sent EOF, or either
+    reset its connection."""
+    for direction in directions:
+        if (readable is None
+                or direction.wants_read and direction.src in readable
+                or direction.wants_write and direction.dst in writable):
+            try:
+                direction.pump()
+            except socket.error as e:
+                if e.errno not in (ECONNRESET, EPIPE):
+                    raise
+                return True
+    return all(direction.finished for direction in directions)
+
+
+def _relay_waits(directions):
+    """Sockets to wait for until they're readable, and writable."""
+    return ([d.src for d in directions if d.wants_read],
+            [d.dst for d in directions if d.wants_write])
+
+
+def _relay_buffered(directions):
+    """Sockets to read from without waiting, as TLS holds decrypted data
+    for them, which doesn't make them readable."""
+    return [d.src for d in directions
+            if d.wants_read and getattr(d.src, "pending", None)
+            and d.src.pending()]
+
+
+def _wait_ready(readers, writers, timeout=None):
+    """Waits until any of the sockets is readable or writable, as asked,
+    or timeout seconds have passed."""
+    if not hasattr(select, "poll"):
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+        return readable, writable
+    poller = select.poll()
+    by_fd = {}
+    for sock in readers:
+        by_fd[sock.fileno()] = sock
+        poller.register(sock, select.POLLIN)
+    for sock in writers:
+        fd = sock.fileno()
+        by_fd[fd] = sock
+        poller.register(sock, select.POLLOUT | (
+            select.POLLIN if sock in readers else 0))
+    readable, writable = [], []
+    for fd, event in poller.poll(
+            None if timeout is None else int(math.ceil(timeout * 1000))):
+        # Errors and hangups surface from the next read or write
+        if event & ~select.POLLOUT:
+            readable.append(by_fd[fd])
+        if event & ~select.POLLIN:
+            writable.append(by_fd[fd])
+    return readable, writable
+
+
+def relay(sock_a, sock_b, buffer_size=65536):
+    """relay(sock_a, sock_b, buffer_size=65536) -> (a_to_b, b_to_a)
+
+    Copies data both ways between two connected stream sockets, such as a
+    client's and a socksocket, until both have sent EOF or either resets
+    the connection. Returns the number of bytes relayed each way.
+
+    An EOF from one socket is passed on by shutting down writing on the
+    other. On Linux the data moves through a pipe with os.splice(), without
+    being copied into Python; otherwise, and for TLS sockets, it goes
+    through a buffer_size buffer. Either way at most buffer_size bytes are
+    in flight per direction, so a slow receiver slows down its sender.
+
+    The sockets are non-blocking while relaying and get their timeouts back
+    afterwards; closing them is left to the caller. See asyncsocks.relay()
+    for the asyncio version."""
+    timeouts = sock_a.gettimeout(), sock_b.gettimeout()
+    sock_a.settimeout(0.0)
+    sock_b.settimeout(0.0)
+    directions = _relay_directions(sock_a, sock_b, buffer_size)
+    try:
+        done = _relay_pump(directions)
+        while not done:
+            buffered = _relay_buffered(directions)
+            readable, writable = _wait_ready(*_relay_waits(directions),
+                                             timeout=0 if buffered else None)
+            done = _relay_pump(directions, readable + buffered, writable)
+        return directions[0].count, directions[1].count
+    finally:
+        for direction in directions:
+            direction.close()
+        sock_a.settimeout(timeouts[0])
+        sock_b.settimeout(timeouts[1])
 
 
 class _BaseSocket(socket.socket):
@@ -226,7 +2683,8 @@ class _BaseSocket(socket.socket):
 
 def _makemethod(name):
     return lambda self, *pos, **kw: self._savedmethods[name](*pos, **kw)
-for name in ("sendto", "send", "recvfrom", "recv"):
+for name in ("sendto", "send", "recvfrom", "recv", "recvfrom_into",
+             "recv_into"):
     method = getattr(_BaseSocket, name, None)
 
     # Determine if the method is not defined the usual way
@@ -248,6 +2706,7 @@ class socksocket(_BaseSocket):
     """
 
     default_proxy = None
+    default_proxy_options = {}
 
     def __init__(self, family=socket.AF_INET, type=socket.SOCK_STREAM,
                  proto=0, *args, **kwargs):
@@ -257,28 +2716,33 @@ class socksocket(_BaseSocket):
 
         super(socksocket, self).__init__(family, type, proto, *args, **kwargs)
         self._proxyconn = None  # TCP connection to keep UDP relay alive
+        self._udp_headers = {}  # Destination -> encoded UDP request header
+        self._udp_buffer = None  # Reused by UDP receives
+        self._udp_gso = _UDP_SEGMENT is not None
 
         if self.default_proxy:
             self.proxy = self.default_proxy
+            self.proxy_options = dict(self.default_proxy_options)
         else:
-            self.proxy = (None, None, None, None, None, None)
+            self.proxy = _NO_PROXY
+            self.proxy_options = {}
+        self.proxy_chain = []
+        self.proxy_chain_times = []
         self.proxy_sockname = None
         self.proxy_peername = None
+        self._handshake = None  # Non-blocking negotiation in progress
+        self._proxy_pool = None  # (ProxyPool, member, connect start time)
+        self.negotiation_hook = None  # Overrides set_negotiation_hook()
+        self.fast_open_used = False  # The SYN carried negotiation bytes
+        self.standby_used = False  # Connected from the StandbyPool
+        self._sockopts = {}  # (level, optname) -> setsockopt() arguments
+        self._proxy_greeted = False  # Only the SOCKS5 request is left
+        self._tls = []  # _TLSLayers, innermost last
+        self.proxy_tls = None  # ssl.SSLObject of the TLS to the proxy
+        self._http_auth = False  # Send HTTP credentials up front (retry)
 
         self._timeout = None
 
-    def _readall(self, file, count):
-        """Receive EXACTLY the number of bytes requested from the file object.
-
-        Blocks until the required number of bytes have been received."""
-        data = b""
-        while len(data) < count:
-            d = file.read(count - len(data))
-            if not d:
-                raise GeneralProxyError("Connection closed unexpectedly")
-            data += d
-        return data
-
     def settimeout(self, timeout):
         self._timeout = timeout
         try:
@@ -291,6 +2755,11 @@ class socksocket(_BaseSocket):
     def gettimeout(self):
         return self._timeout
 
+    def setsockopt(self, *args):
+        # Kept to set again on a connection taken from the StandbyPool
+        self._sockopts[args[:2]] = args
+        return super(socksocket, self).setsockopt(*args)
+
     def setblocking(self, v):
         if v:
             self.settimeout(None)
@@ -298,25 +2767,89 @@ class socksocket(_BaseSocket):
             self.settimeout(0.0)
 
     def set_proxy(self, proxy_type=None, addr=None, port=None, rdns=True,
-                  username=None, password=None):
+                  username=None, password=None, pipeline=False,
+                  fast_open=False, tls=None):
         """ Sets the proxy to be used.
 
-        proxy_type -  The type of the proxy to be used. Three types
+        proxy_type -  The type of the proxy to be used. Four types
                         are supported: PROXY_TYPE_SOCKS4 (including socks4a),
-                        PROXY_TYPE_SOCKS5 and PROXY_TYPE_HTTP
+                        PROXY_TYPE_SOCKS5, PROXY_TYPE_HTTP and
+                        PROXY_TYPE_HTTPS (HTTP over TLS). Or a
+                        ProxyPool, which picks the proxy for each
+                        connection; the other arguments are then ignored.
+                        Or a Proxy, which replaces addr to password.
         addr -        The address of the server (IP or DNS).
         port -        The port of the server. Defaults to 1080 for SOCKS
-                        servers and 8080 for HTTP proxy servers.
+                        servers, 8080 for HTTP and 443 for HTTPS proxy
+                        servers.
         rdns -        Should DNS queries be performed on the remote side
                        (rather than the local side). The default is True.
                        Note: This has no effect with SOCKS4 servers.
         username -    Username to authenticate with to the server.
                        The default is no authentication.
         password -    Password to authenticate with to the server.
-                       Only relevant when username is also provided."""
-        self.proxy = (proxy_type, addr, port, rdns,
-                      username.encode() if username else None,
-                      password.encode() if password else None)
+                       Only relevant when username is also provided.
+                       HTTP proxies are sent a username without a
+                       password once they ask for credentials; if they
+                       close the connection on asking, connect() fails
+                       with HTTPAuthRetryError, and create_connection()
+                       retries once on a new connection, sending it up
+                       front.
+        pipeline -    Send the SOCKS5 greeting, authentication and request
+                       in a single write instead of waiting for each reply,
+                       saving up to two round trips. The default is False.
+                       Note: Proxies requiring a different authentication
+                       method than offered fail with SOCKS5PipelineError;
+                       create_connection() then retries without pipelining.
+        fast_open -   Use TCP Fast Open (Linux) to carry the first bytes
+                       of the negotiation in the SYN to the proxy, saving a
+                       round trip once the proxy has handed out a TFO
+                       cookie. Falls back to a normal connect where TFO is
+                       unavailable. The default is False.
+        tls -         Connect to the proxy over TLS: an ssl.SSLContext, or
+                       True for ssl.create_default_context(). Always on
+                       for HTTPS proxies; with SOCKS5 it makes for SOCKS
+                       over TLS. Sessions are resumed through the
+                       TLSSessionCache, see set_proxy_tls_session_cache().
+                       Needs Python 3.5 or later."""
+        self.proxy = _proxy_for(proxy_type, addr, port, rdns, username,
+                                password)
+        self.proxy_options = {"pipeline": pipeline, "fast_open": fast_open,
+                              "tls": tls}
+        self.proxy_chain = []
+
+    def set_proxy_chain(self, proxies, pipeline=False, fast_open=False,
+                        tls=None):
+        """Sets a chain of proxies to connect through, in order.
+
+        proxies -     List with a tuple of set_proxy() arguments for each
+                       hop, e.g. [(SOCKS5, "a.example"), (HTTP, "b.example")].
+                       The first proxy is connected to directly, each of
+                       the following ones through the tunnel built so far.
+        pipeline -    As for set_proxy(), applies to every hop.
+        fast_open -   As for set_proxy(), applies to the first hop.
+        tls -         The ssl.SSLContext for the HTTPS hops, or a list with
+                       a tls argument of set_proxy() for each hop.
+
+        HTTPS hops are connected to over TLS, inside the tunnel through
+        the hops before them. After connecting, proxy_chain_times holds the
+        seconds spent negotiating with each hop."""
+        chain = []
+        for args in proxies:
+            self.set_proxy(*args, pipeline=pipeline, fast_open=fast_open)
+            chain.append(self.proxy)
+        if not chain:
+            raise GeneralProxyError("Empty proxy chain")
+        if isinstance(tls, (list, tuple)):
+            if len(tls) != len(chain):
+                raise GeneralProxyError("Need a tls argument for each hop")
+            chain_tls = list(tls)
+        else:
+            chain_tls = [tls if hop[0] == HTTPS else None for hop in chain]
+        self.proxy = chain[0]
+        self.proxy_options["tls"] = chain_tls[0]
+        self.proxy_options["chain_tls"] = chain_tls
+        self.proxy_chain = chain
 
     def setproxy(self, *args, **kwargs):
         if "proxytype" in kwargs:
@@ -327,6 +2860,8 @@ class socksocket(_BaseSocket):
         """Implements proxy connection for UDP sockets.
 
         Happens during the bind() phase."""
+        if isinstance(self.proxy[0], ProxyPool):
+            self._use_proxy_pool()
         (proxy_type, proxy_addr, proxy_port, rdns, username,
          password) = self.proxy
         if not proxy_type or self.type != socket.SOCK_DGRAM:
@@ -337,6 +2872,9 @@ class socksocket(_BaseSocket):
         if proxy_type != SOCKS5:
             msg = "UDP only supported by SOCKS5 proxy type"
             raise socket.error(EOPNOTSUPP, msg)
+        if self.proxy_options.get("tls"):
+            msg = "UDP not supported over TLS to the proxy"
+            raise socket.error(EOPNOTSUPP, msg)
         super(socksocket, self).bind(*pos, **kw)
 
         # Need to specify actual local port because
@@ -347,14 +2885,23 @@ class socksocket(_BaseSocket):
 
         self._proxyconn = _orig_socket()
         proxy = self._proxy_addr()
-        self._proxyconn.connect(proxy)
+        sockaddr = self._connect_proxy(self._proxyconn, proxy, dst)
 
         UDP_ASSOCIATE = b"\x03"
-        _, relay = self._SOCKS5_request(self._proxyconn, UDP_ASSOCIATE, dst)
+        try:
+            _, relay = self._SOCKS5_request(self._proxyconn, UDP_ASSOCIATE,
+                                            dst)
+        except SOCKS5PipelineError:
+            self._proxyconn.close()
+            self._proxyconn = _orig_socket()
+            sockaddr = self._connect_proxy(self._proxyconn, proxy, dst)
+            self.proxy_options["pipeline"] = False
+            _, relay = self._SOCKS5_request(self._proxyconn, UDP_ASSOCIATE,
+                                            dst)
 
         # The relay is most likely on the same host as the SOCKS proxy,
         # but some proxies return a private IP address (10.x.y.z)
-        host, _ = proxy
+        host = sockaddr[0]
         _, port = relay
         super(socksocket, self).connect((host, port))
         super(socksocket, self).settimeout(self._timeout)
@@ -369,16 +2916,35 @@ class socksocket(_BaseSocket):
         address = args[-1]
         flags = args[:-1]
 
-        header = BytesIO()
-        RSV = b"\x00\x00"
-        header.write(RSV)
-        STANDALONE = b"\x00"
-        header.write(STANDALONE)
-        self._write_SOCKS5_address(address, header)
-
-        sent = super(socksocket, self).send(header.getvalue() + bytes, *flags,
-                                            **kwargs)
-        return sent - header.tell()
+        header = self._udp_header(address)
+        if _HAS_SENDMSG and not kwargs:
+            # Scatter-gather, so the payload is never copied
+            sent = super(socksocket, self).sendmsg([header, bytes], (),
+                                                   *flags)
+        else:
+            sent = super(socksocket, self).send(header + bytes, *flags,
+                                                **kwargs)
+        return sent - len(header)
+
+    def _udp_header(self, address):
+        """Returns the SOCKS5 UDP request header for datagrams to address.
+
+        Headers are cached per destination unless the address had to be
+        resolved locally, which is left to the DNS cache."""
+        header = self._udp_headers.get(address)
+        if header is None:
+            file = BytesIO()
+            RSV = b"\x00\x00"
+            file.write(RSV)
+            STANDALONE = b"\x00"
+            file.write(STANDALONE)
+            host, _ = self._write_SOCKS5_address(address, file)
+            header = file.getvalue()
+            if self.proxy[3] or host == address[0]:
+                if len(self._udp_headers) >= MAX_UDP_HEADER_CACHE_SIZE:
+                    self._udp_headers.clear()
+                self._udp_headers[address] = header
+        return header
 
     def send(self, bytes, flags=0, **kwargs):
         if self.type == socket.SOCK_DGRAM:
@@ -392,29 +2958,166 @@ class socksocket(_BaseSocket):
         if not self._proxyconn:
             self.bind(("", 0))
 
-        buf = BytesIO(super(socksocket, self).recv(bufsize + 1024, flags))
-        buf.seek(2, SEEK_CUR)
-        frag = buf.read(1)
-        if ord(frag):
-            raise NotImplementedError("Received UDP packet fragment")
-        fromhost, fromport = self._read_SOCKS5_address(buf)
+        return self._recvfrom_relay(bufsize, flags)
+
+    def recvfrom_into(self, buffer, nbytes=0, flags=0):
+        if self.type != socket.SOCK_DGRAM:
+            return super(socksocket, self).recvfrom_into(buffer, nbytes,
+                                                         flags)
+        if not self._proxyconn:
+            self.bind(("", 0))
+
+        view = memoryview(buffer)
+        if nbytes > len(view):
+            raise ValueError("nbytes is greater than the length of the buffer")
+        return self._recvfrom_relay(nbytes or len(view), flags, view)
+
+    def _recvfrom_relay(self, nbytes, flags, into=None):
+        """Receives a datagram from the UDP relay and strips its header.
+
+        Copies the payload into the into buffer and returns its length,
+        or returns the payload itself if into is None."""
+        # Reuse the receive buffer, unless another thread is using it
+        packet, self._udp_buffer = self._udp_buffer, None
+        size = nbytes + 262  # Longest SOCKS5 UDP header
+        if packet is None or len(packet) < size:
+            packet = bytearray(size)
+        try:
+            view = memoryview(packet)
+            received = super(socksocket, self).recv_into(view, size, flags)
+            start, (fromhost, fromport) = _read_SOCKS5_udp_header(
+                view[:received])
+
+            if self.proxy_peername:
+                peerhost, peerport = self.proxy_peername
+                if fromhost != peerhost or peerport not in (0, fromport):
+                    raise socket.error(EAGAIN, "Packet filtered")
+
+            payload = view[start:min(received, start + nbytes)]
+            if into is None:
+                return payload.tobytes(), (fromhost, fromport)
+            into[:len(payload)] = payload
+            return len(payload), (fromhost, fromport)
+        finally:
+            self._udp_buffer = packet
+
+    def sendmany(self, datagrams, flags=0):
+        """Sends each (payload, address) pair in datagrams through the
+        UDP relay.
 
-        if self.proxy_peername:
-            peerhost, peerport = self.proxy_peername
-            if fromhost != peerhost or peerport not in (0, fromport):
-                raise socket.error(EAGAIN, "Packet filtered")
+        Runs of datagrams to the same address are sent with a single
+        system call where the kernel supports UDP segmentation offload.
+        Returns the number of datagrams sent, which is less than requested
+        only if a non-blocking socket would block."""
+        if self.type != socket.SOCK_DGRAM:
+            raise socket.error(EOPNOTSUPP, "sendmany() needs a UDP socket")
+        if not self._proxyconn:
+            self.bind(("", 0))
 
-        return (buf.read(bufsize), (fromhost, fromport))
+        datagrams = list(datagrams)
+        sent = 0
+        try:
+            while sent < len(datagrams):
+                payload, address = datagrams[sent]
+                header = self._udp_header(address)
+                run = self._gso_run(datagrams, sent, len(header))
+                if run > 1:
+                    try:
+                        self._send_gso(header, datagrams[sent:sent + run],
+                                       flags)
+                        sent += run
+                        continue
+                    except socket.error as e:
+                        if e.errno in (EAGAIN, EWOULDBLOCK):
+                            raise
+                        # Not supported here after all
+                        self._udp_gso = False
+                self.sendto(payload, flags, address)
+                sent += 1
+        except socket.error as e:
+            if e.errno not in (EAGAIN, EWOULDBLOCK) or not sent:
+                raise
+        return sent
+
+    def _gso_run(self, datagrams, start, header_size):
+        """Returns how many datagrams from start on can be sent together:
+        all to the same address, and all the same size but the last one,
+        which may be shorter."""
+        if not self._udp_gso:
+            return 1
+        payload, address = datagrams[start]
+        size = len(payload)
+        segment = header_size + size
+        if segment > _UDP_GSO_MAX_SEGMENT:
+            return 1
+        limit = min(len(datagrams) - start, _UDP_MAX_SEGMENTS,
+                    _UDP_MAX_GSO_SIZE // segment)
+        run = 1
+        while run < limit:
+            payload, next_address = datagrams[start + run]
+            if next_address != address or len(payload) > size:
+                break
+            run += 1
+            if len(payload) < size:
+                break
+        return run
+
+    def _send_gso(self, header, datagrams, flags):
+        buffers = []
+        for payload, _ in datagrams:
+            buffers.append(header)
+            buffers.append(payload)
+        segment = struct.pack("=H", len(header) + len(datagrams[0][0]))
+        super(socksocket, self).sendmsg(
+            buffers, [(_SOL_UDP, _UDP_SEGMENT, segment)], flags)
+
+    def recvmany(self, count, bufsize=65535, flags=0):
+        """Receives up to count datagrams through the UDP relay.
+
+        Waits for the first one like recvfrom(), then takes whatever else
+        has already arrived without waiting any longer. Returns a list of
+        (payload, address) pairs."""
+        datagrams = [self.recvfrom(bufsize, flags)]
+        if self.type != socket.SOCK_DGRAM or count <= 1:
+            return datagrams
+        # MSG_DONTWAIT would still wait out the timeout in Python
+        super(socksocket, self).settimeout(0.0)
+        try:
+            while len(datagrams) < count:
+                datagrams.append(self._recvfrom_relay(bufsize, flags))
+        except socket.error as e:
+            if e.errno not in (EAGAIN, EWOULDBLOCK):
+                raise
+        finally:
+            super(socksocket, self).settimeout(self._timeout)
+        return datagrams
 
     def recv(self, *pos, **kw):
         bytes, _ = self.recvfrom(*pos, **kw)
         return bytes
 
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        if self.type != socket.SOCK_DGRAM:
+            return super(socksocket, self).recv_into(buffer, nbytes, flags)
+        nbytes, _ = self.recvfrom_into(buffer, nbytes, flags)
+        return nbytes
+
     def close(self):
         if self._proxyconn:
             self._proxyconn.close()
+        if self._proxy_pool:
+            pool, member, _ = self._proxy_pool
+            self._proxy_pool = None
+            pool._release(member)
         return super(socksocket, self).close()
 
+    def pending(self):
+        """Returns how many bytes TLS started with start_tls() or to the
+        proxy holds decrypted, ready to be received without the socket
+        becoming readable: check it before waiting with select() and the
+        like, as for an ssl.SSLSocket."""
+        return 0  # Replaced by the TLS layer's
+
     def get_proxy_sockname(self):
         """Returns the bound IP address and port number at the proxy."""
         return self.proxy_sockname
@@ -437,295 +3140,179 @@ class socksocket(_BaseSocket):
 
     getpeername = get_peername
 
+    def _run_handshake(self, conn, handshake, dest=None):
+        """Drives a handshake generator with blocking I/O on conn.
+
+        Returns the handshake result. Its phases are reported to the
+        negotiation hook, if any, as being on the way to dest."""
+        hook = self.negotiation_hook or _negotiation_hook
+        phase = start = None
+        reader = _SocketReader(conn)
+        try:
+            result = None
+            while True:
+                op, arg = handshake.send(result)
+                result = None
+                if op == _SEND:
+                    conn.sendall(arg)
+                elif op == _RECV:
+                    result = reader.read(arg)
+                elif op == _RECV_HEADERS:
+                    result = reader.read_headers(arg)
+                elif op == _PHASE:
+                    if hook:
+                        now = _clock()
+                        if phase:
+                            hook(phase, start, now, self.proxy[:3], dest,
+                                 None)
+                        phase, start = arg, now
+                else:
+                    if phase:
+                        hook(phase, start, _clock(), self.proxy[:3], dest,
+                             None)
+                    return arg
+        except Exception as error:
+            if phase:
+                hook(phase, start, _clock(), self.proxy[:3], dest, error)
+            raise
+        finally:
+            handshake.close()
+
+    def _connect_proxy(self, conn, proxy_addr, dest):
+        """Connects conn to the proxy, reported to the negotiation hook as
+        the "connect" phase. Returns the proxy's socket address."""
+        hook = self.negotiation_hook or _negotiation_hook
+        start = _clock() if hook else None
+        try:
+            host, port = proxy_addr
+            sockaddr = _proxy_getaddrinfo(host, port, conn.family)[0][4]
+            _orig_socket.connect(conn, sockaddr)
+        except Exception as error:
+            _proxy_failed(*proxy_addr)
+            if hook:
+                hook("connect", start, _clock(), self.proxy[:3], dest,
+                     error)
+            raise
+        if hook:
+            hook("connect", start, _clock(), self.proxy[:3], dest, None)
+        return sockaddr
+
     def _negotiate_SOCKS5(self, *dest_addr):
         """Negotiates a stream connection through a SOCKS5 server."""
         CONNECT = b"\x01"
+        greeted, self._proxy_greeted = self._proxy_greeted, False
         self.proxy_peername, self.proxy_sockname = self._SOCKS5_request(
-            self, CONNECT, dest_addr)
+            self, CONNECT, dest_addr, greeted)
 
-    def _SOCKS5_request(self, conn, cmd, dst):
+    def _SOCKS5_request(self, conn, cmd, dst, greeted=False):
         """
         Send SOCKS5 request with given command (CMD field) and
         address (DST field). Returns resolved DST address that was used.
+        If greeted is true, conn is authenticated already.
         """
-        proxy_type, addr, port, rdns, username, password = self.proxy
-
-        writer = conn.makefile("wb")
-        reader = conn.makefile("rb", 0)  # buffering=0 renamed in Python 3
-        try:
-            # First we'll send the authentication packages we support.
-            if username and password:
-                # The username/password details were supplied to the
-                # set_proxy method so we support the USERNAME/PASSWORD
-                # authentication (in addition to the standard none).
-                writer.write(b"\x05\x02\x00\x02")
-            else:
-                # No username/password were entered, therefore we
-                # only support connections with no authentication.
-                writer.write(b"\x05\x01\x00")
-
-            # We'll receive the server's response to determine which
-            # method was selected
-            writer.flush()
-            chosen_auth = self._readall(reader, 2)
-
-            if chosen_auth[0:1] != b"\x05":
-                # Note: string[i:i+1] is used because indexing of a bytestring
-                # via bytestring[i] yields an integer in Python 3
-                raise GeneralProxyError(
-                    "SOCKS5 proxy server sent invalid data")
-
-            # Check the chosen authentication method
-
-            if chosen_auth[1:2] == b"\x02":
-                # Okay, we need to perform a basic username/password
-                # authentication.
-                if not (username and password):
-                    # Although we said we don't support authentication, the
-                    # server may still request basic username/password
-                    # authentication
-                    raise SOCKS5AuthError("No username/password supplied. "
-                                          "Server requested username/password"
-                                          " authentication")
-
-                writer.write(b"\x01" + chr(len(username)).encode()
-                             + username
-                             + chr(len(password)).encode()
-                             + password)
-                writer.flush()
-                auth_status = self._readall(reader, 2)
-                if auth_status[0:1] != b"\x01":
-                    # Bad response
-                    raise GeneralProxyError(
-                        "SOCKS5 proxy server sent invalid data")
-                if auth_status[1:2] != b"\x00":
-                    # Authentication failed
-                    raise SOCKS5AuthError("SOCKS5 authentication failed")
-
-                # Otherwise, authentication succeeded
-
-            # No authentication is required if 0x00
-            elif chosen_auth[1:2] != b"\x00":
-                # Reaching here is always bad
-                if chosen_auth[1:2] == b"\xFF":
-                    raise SOCKS5AuthError(
-                        "All offered SOCKS5 authentication methods were"
-                        " rejected")
-                else:
-                    raise GeneralProxyError(
-                        "SOCKS5 proxy server sent invalid data")
-
-            # Now we can request the actual connection
-            writer.write(b"\x05" + cmd + b"\x00")
-            resolved = self._write_SOCKS5_address(dst, writer)
-            writer.flush()
-
-            # Get the response
-            resp = self._readall(reader, 3)
-            if resp[0:1] != b"\x05":
-                raise GeneralProxyError(
-                    "SOCKS5 proxy server sent invalid data")
-
-            status = ord(resp[1:2])
-            if status != 0x00:
-                # Connection failed: server returned an error
-                error = SOCKS5_ERRORS.get(status, "Unknown error")
-                raise SOCKS5Error("{:#04x}: {}".format(status, error))
-
-            # Get the bound address/port
-            bnd = self._read_SOCKS5_address(reader)
-
-            super(socksocket, self).settimeout(self._timeout)
-            return (resolved, bnd)
-        finally:
-            reader.close()
-            writer.close()
+        pipeline = self.proxy_options.get("pipeline", False)
+        result = self._run_handshake(
+            conn, _SOCKS5_handshake(self.proxy, cmd, dst, pipeline, greeted),
+            dst)
+        super(socksocket, self).settimeout(self._timeout)
+        return result
 
     def _write_SOCKS5_address(self, addr, file):
         """
         Return the host and port packed for the SOCKS5 protocol,
         and the resolved address as a tuple object.
         """
-        host, port = addr
-        proxy_type, _, _, rdns, username, password = self.proxy
-        family_to_byte = {socket.AF_INET: b"\x01", socket.AF_INET6: b"\x04"}
-
-        # If the given destination address is an IP address, we'll
-        # use the IP address request even if remote resolving was specified.
-        # Detect whether the address is IPv4/6 directly.
-        for family in (socket.AF_INET, socket.AF_INET6):
-            try:
-                addr_bytes = socket.inet_pton(family, host)
-                file.write(family_to_byte[family] + addr_bytes)
-                host = socket.inet_ntop(family, addr_bytes)
-                file.write(struct.pack(">H", port))
-                return host, port
-            except socket.error:
-                continue
-
-        # Well it's not an IP number, so it's probably a DNS name.
-        if rdns:
-            # Resolve remotely
-            host_bytes = host.encode("idna")
-            file.write(b"\x03" + chr(len(host_bytes)).encode() + host_bytes)
-        else:
-            # Resolve locally
-            addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
-                                           socket.SOCK_STREAM,
-                                           socket.IPPROTO_TCP,
-                                           socket.AI_ADDRCONFIG)
-            # We can't really work out what IP is reachable, so just pick the
-            # first.
-            target_addr = addresses[0]
-            family = target_addr[0]
-            host = target_addr[4][0]
-
-            addr_bytes = socket.inet_pton(family, host)
-            file.write(family_to_byte[family] + addr_bytes)
-            host = socket.inet_ntop(family, addr_bytes)
-        file.write(struct.pack(">H", port))
-        return host, port
-
-    def _read_SOCKS5_address(self, file):
-        atyp = self._readall(file, 1)
-        if atyp == b"\x01":
-            addr = socket.inet_ntoa(self._readall(file, 4))
-        elif atyp == b"\x03":
-            length = self._readall(file, 1)
-            addr = self._readall(file, ord(length))
-        elif atyp == b"\x04":
-            addr = socket.inet_ntop(socket.AF_INET6, self._readall(file, 16))
-        else:
-            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
-
-        port = struct.unpack(">H", self._readall(file, 2))[0]
-        return addr, port
+        return _write_SOCKS5_address(addr, file, self.proxy[3])
 
     def _negotiate_SOCKS4(self, dest_addr, dest_port):
         """Negotiates a connection through a SOCKS4 server."""
-        proxy_type, addr, port, rdns, username, password = self.proxy
-
-        writer = self.makefile("wb")
-        reader = self.makefile("rb", 0)  # buffering=0 renamed in Python 3
-        try:
-            # Check if the destination address provided is an IP address
-            remote_resolve = False
-            try:
-                addr_bytes = socket.inet_aton(dest_addr)
-            except socket.error:
-                # It's a DNS name. Check where it should be resolved.
-                if rdns:
-                    addr_bytes = b"\x00\x00\x00\x01"
-                    remote_resolve = True
-                else:
-                    addr_bytes = socket.inet_aton(
-                        socket.gethostbyname(dest_addr))
-
-            # Construct the request packet
-            writer.write(struct.pack(">BBH", 0x04, 0x01, dest_port))
-            writer.write(addr_bytes)
-
-            # The username parameter is considered userid for SOCKS4
-            if username:
-                writer.write(username)
-            writer.write(b"\x00")
-
-            # DNS name if remote resolving is required
-            # NOTE: This is actually an extension to the SOCKS4 protocol
-            # called SOCKS4A and may not be supported in all cases.
-            if remote_resolve:
-                writer.write(dest_addr.encode("idna") + b"\x00")
-            writer.flush()
-
-            # Get the response from the server
-            resp = self._readall(reader, 8)
-            if resp[0:1] != b"\x00":
-                # Bad data
-                raise GeneralProxyError(
-                    "SOCKS4 proxy server sent invalid data")
-
-            status = ord(resp[1:2])
-            if status != 0x5A:
-                # Connection failed: server returned an error
-                error = SOCKS4_ERRORS.get(status, "Unknown error")
-                raise SOCKS4Error("{:#04x}: {}".format(status, error))
-
-            # Get the bound address/port
-            self.proxy_sockname = (socket.inet_ntoa(resp[4:]),
-                                   struct.unpack(">H", resp[2:4])[0])
-            if remote_resolve:
-                self.proxy_peername = socket.inet_ntoa(addr_bytes), dest_port
-            else:
-                self.proxy_peername = dest_addr, dest_port
-        finally:
-            reader.close()
-            writer.close()
+        self.proxy_peername, self.proxy_sockname = self._run_handshake(
+            self, _SOCKS4_handshake(self.proxy, dest_addr, dest_port),
+            (dest_addr, dest_port))
 
     def _negotiate_HTTP(self, dest_addr, dest_port):
         """Negotiates a connection through an HTTP server.
 
         NOTE: This currently only supports HTTP CONNECT-style proxies."""
-        proxy_type, addr, port, rdns, username, password = self.proxy
-
-        # If we need to resolve locally, we do this now
-        addr = dest_addr if rdns else socket.gethostbyname(dest_addr)
-
-        http_headers = [
-            (b"CONNECT " + addr.encode("idna") + b":"
-             + str(dest_port).encode() + b" HTTP/1.1"),
-            b"Host: " + dest_addr.encode("idna")
-        ]
-
-        if username and password:
-            http_headers.append(b"Proxy-Authorization: basic "
-                                + b64encode(username + b":" + password))
-
-        http_headers.append(b"\r\n")
-
-        self.sendall(b"\r\n".join(http_headers))
-
-        # We just need the first line to check if the connection was successful
-        fobj = self.makefile()
-        status_line = fobj.readline()
-        fobj.close()
-
-        if not status_line:
-            raise GeneralProxyError("Connection closed unexpectedly")
-
-        try:
-            proto, status_code, status_msg = status_line.split(" ", 2)
-        except ValueError:
-            raise GeneralProxyError("HTTP proxy server sent invalid response")
-
-        if not proto.startswith("HTTP/"):
-            raise GeneralProxyError(
-                "Proxy server does not appear to be an HTTP proxy")
-
-        try:
-            status_code = int(status_code)
-        except ValueError:
-            raise HTTPError(
-                "HTTP proxy server did not return a valid HTTP status")
-
-        if status_code != 200:
-            error = "{}: {}".format(status_code, status_msg)
-            if status_code in (400, 403, 405):
-                # It's likely that the HTTP proxy server does not support the
-                # CONNECT tunneling method
-                error += ("\n[*] Note: The HTTP proxy server may not be"
-                          " supported by PySocks (must be a CONNECT tunnel"
-                          " proxy)")
-            raise HTTPError(error)
-
-        self.proxy_sockname = (b"0.0.0.0", 0)
-        self.proxy_peername = addr, dest_port
+        self.proxy_peername, self.proxy_sockname = self._run_handshake(
+            self, _HTTP_handshake(self.proxy, dest_addr, dest_port,
+                                  authorized=self._http_auth),
+            (dest_addr, dest_port))
 
     _proxy_negotiators = {
                            SOCKS4: _negotiate_SOCKS4,
                            SOCKS5: _negotiate_SOCKS5,
-                           HTTP: _negotiate_HTTP
+                           HTTP: _negotiate_HTTP,
+                           HTTPS: _negotiate_HTTP
                          }
 
+    def start_tls(self, context, server_hostname=None, session=None):
+        """Starts TLS over the established connection, for when it already
+        runs over TLS to the proxy, which ssl.SSLContext.wrap_socket() can't
+        wrap again. From then on the socket's stream methods send and
+        receive through it.
+
+        The arguments are those of ssl.SSLContext.wrap_bio(). Returns the
+        ssl.SSLObject once the handshake is done, for its certificate,
+        session and so on. Needs Python 3.5 or later."""
+        layer = self._push_tls(context, server_hostname, session)
+        while True:
+            try:
+                layer.do_handshake()
+                return layer.tls
+            except socket.error as e:
+                if e.errno not in (EAGAIN, EWOULDBLOCK):
+                    raise
+                _wait_ready([self], [])
+
+    def _push_tls(self, context, server_hostname, session=None):
+        """Adds a TLS layer, whose handshake is yet to be done."""
+        layer = _TLSLayer(self, context, server_hostname, session)
+        self._tls.append(layer)
+        # Instance attributes, so plain sockets keep the C methods
+        for name in _TLS_METHODS:
+            setattr(self, name, getattr(layer, name))
+        return layer
+
+    def _hops(self):
+        """The proxies to negotiate with in turn, each with its tls
+        option."""
+        if self.proxy_chain:
+            return list(zip(self.proxy_chain,
+                            self.proxy_options["chain_tls"]))
+        return [(self.proxy, self.proxy_options.get("tls"))]
+
+    def _start_proxy_tls(self, context):
+        """Adds the TLS layer for the connection to self.proxy, given its
+        tls option, if it takes TLS, with the session of an earlier
+        connection to resume. Returns the layer, or None."""
+        if not context and self.proxy[0] == HTTPS:
+            context = True
+        if not context:
+            return None
+        context = _tls_context(context)
+        addr, port = self._proxy_addr()
+        key = (context, addr, port)
+        cache = _proxy_tls_sessions
+        layer = self._push_tls(context, addr, cache and cache.get(key))
+        layer.key = key
+        self.proxy_tls = layer.tls
+        return layer
+
+    def _tls_handshake(self, layer, dest):
+        """Runs the handshake of a new TLS layer, reported to the
+        negotiation hook as the "tls" phase."""
+        hook = self.negotiation_hook or _negotiation_hook
+        start = _clock() if hook else None
+        try:
+            layer.do_handshake()
+        except Exception as error:
+            if hook:
+                hook("tls", start, _clock(), self.proxy[:3], dest, error)
+            raise
+        if hook:
+            hook("tls", start, _clock(), self.proxy[:3], dest, None)
+
     @set_self_blocking
     def connect(self, dest_pair, catch_errors=None):
         """
@@ -747,7 +3334,7 @@ class socksocket(_BaseSocket):
         if self.type == socket.SOCK_DGRAM:
             if not self._proxyconn:
                 self.bind(("", 0))
-            dest_addr = socket.gethostbyname(dest_addr)
+            dest_addr = _gethostbyname(dest_addr)
 
             # If the host address is INADDR_ANY or similar, reset the peer
             # address so that packets are received from any peer
@@ -755,6 +3342,17 @@ class socksocket(_BaseSocket):
                 self.proxy_peername = None
             else:
                 self.proxy_peername = (dest_addr, dest_port)
+                self._udp_header(self.proxy_peername)
+            return
+
+        if isinstance(self.proxy[0], ProxyPool):
+            pool, member, start = self._use_proxy_pool()
+            try:
+                self.connect(dest_pair, catch_errors)
+            except BaseException as error:
+                pool._record_error(member, error, _clock() - start)
+                raise
+            pool._record(member, _clock() - start)
             return
 
         (proxy_type, proxy_addr, proxy_port, rdns, username,
@@ -781,10 +3379,29 @@ class socksocket(_BaseSocket):
             return
 
         proxy_addr = self._proxy_addr()
+        self.standby_used = self._use_standby()
+        if self.standby_used:
+            try:
+                self._negotiate(dest_addr, dest_port, keep_open=True)
+                return
+            except GeneralProxyError as error:
+                if not _connection_dropped(error):
+                    self.close()
+                    raise
+            except BaseException:
+                self.close()
+                raise
+            # The proxy closed the connection since it was checked; start
+            # over with a new one, as pooled connections are retried
+            log.debug("Standby connection to %s:%s was closed by the proxy",
+                      *proxy_addr)
+            self.standby_used = False
+            self._adopt(_orig_socket(self.family, self.type, self.proto))
+        fast_open = self._enable_fast_open()
 
         try:
             # Initial connection to proxy server.
-            super(socksocket, self).connect(proxy_addr)
+            self._connect_proxy(self, proxy_addr, dest_pair)
 
         except socket.error as error:
             # Error while connecting to proxy
@@ -804,26 +3421,127 @@ class socksocket(_BaseSocket):
         else:
             # Connected to proxy server, now negotiate
             try:
+                self._negotiate(dest_addr, dest_port, catch_errors)
+            except GeneralProxyError as error:
+                # With TCP Fast Open, connecting may only fail once the
+                # first bytes are sent
+                if (fast_open and not catch_errors
+                        and getattr(error.socket_err, "errno", None) in (
+                            ECONNREFUSED, ETIMEDOUT, EHOSTUNREACH,
+                            ENETUNREACH)):
+                    _proxy_failed(*proxy_addr)
+                    msg = "Error connecting to {} proxy {}:{}".format(
+                        PRINTABLE_PROXY_TYPES[proxy_type], *proxy_addr)
+                    raise ProxyConnectionError(msg, error.socket_err)
+                raise
+            if fast_open:
+                self._record_fast_open()
+
+    def _record_fast_open(self):
+        """Notes whether the SYN to the proxy carried the first bytes."""
+        self.fast_open_used = _syn_data_acked(self)
+        if self.fast_open_used:
+            _learn(self.proxy, "fast_open", True)
+        elif _syn_data_rejected(self):
+            # Not just a first connection, still without a cookie
+            _learn(self.proxy, "fast_open", False)
+        with _fast_open_lock:
+            _fast_open_stats["attempted"] += 1
+            _fast_open_stats["used"] += self.fast_open_used
+
+    def _use_standby(self):
+        """Takes over a connection to the proxy from the StandbyPool, if
+        there is one ready. Returns whether there was."""
+        pool = _standby_pool
+        if (pool is None or not _CAN_ADOPT_SOCKETS or self.proxy_chain
+                or self.proxy[0] != SOCKS5 or self.proxy_options.get("tls")
+                or self.getsockname()[1]):
+            return False
+        conn = pool._take(self.proxy, self.family)
+        if conn is None:
+            return False
+        self._adopt(conn)
+        self._proxy_greeted = True
+        return True
+
+    def _adopt(self, conn):
+        """Puts conn in place of this socket's connection, and closes it."""
+        try:
+            # This socket object stays, with the connection in its place
+            os.dup2(conn.fileno(), self.fileno())
+        finally:
+            conn.close()
+        if hasattr(self, "set_inheritable"):
+            self.set_inheritable(False)
+        # Options set before connect() were set on the replaced socket
+        for args in self._sockopts.values():
+            super(socksocket, self).setsockopt(*args)
+        super(socksocket, self).settimeout(self._timeout)
+
+    def _enable_fast_open(self):
+        """Turns on TCP Fast Open for connecting to the proxy, if asked to
+        and supported. Returns whether it is on."""
+        if not (self.proxy_options.get("fast_open") and _TCP_FASTOPEN_CONNECT
+                and self.family in (socket.AF_INET, socket.AF_INET6)):
+            return False
+        if _capability(self.proxy, "fast_open") is False:
+            return False  # The proxy didn't take data in the SYN
+        try:
+            self.setsockopt(socket.IPPROTO_TCP, _TCP_FASTOPEN_CONNECT, 1)
+        except socket.error:
+            return False  # Kernel too old; connect normally
+        return True
+
+    def _negotiate(self, dest_addr, dest_port, catch_errors=None,
+                   keep_open=False):
+        """Negotiates a connection to dest through the connected proxy,
+        or through each hop of the proxy chain in turn. The socket is
+        closed on failure, unless keep_open is true."""
+        hops = self._hops()
+        targets = [self._proxy_addr(hop) for hop, _ in hops[1:]]
+        targets.append((dest_addr, dest_port))
+        self.proxy_chain_times = []
+        try:
+            for (hop, tls), (addr, port) in zip(hops, targets):
+                # The negotiators work on self.proxy
+                self.proxy = hop
+                start = _clock()
+                layer = self._start_proxy_tls(tls)
+                if layer:
+                    self._tls_handshake(layer, (addr, port))
                 # Calls negotiate_{SOCKS4, SOCKS5, HTTP}
-                negotiate = self._proxy_negotiators[proxy_type]
-                negotiate(self, dest_addr, dest_port)
-            except socket.error as error:
-                if not catch_errors:
-                    # Wrap socket errors
-                    self.close()
-                    raise GeneralProxyError("Socket error", error)
-                else:
-                    raise error
-            except ProxyError:
-                # Protocol error while negotiating with proxy
+                negotiate = self._proxy_negotiators[hop[0]]
+                negotiate(self, addr, port)
+                if layer:
+                    _keep_proxy_tls_session(layer)
+                self.proxy_chain_times.append(_clock() - start)
+        except ProxyError:
+            # Protocol error while negotiating with proxy. Checked
+            # first as ProxyError is a socket.error on Python 3.
+            if not keep_open:
                 self.close()
-                raise
-                
-    @set_self_blocking
+            raise
+        except socket.error as error:
+            if not catch_errors:
+                # Wrap socket errors
+                if not keep_open:
+                    self.close()
+                raise GeneralProxyError("Socket error", error)
+            else:
+                raise error
+        finally:
+            self.proxy = hops[0][0]
+
     def connect_ex(self, dest_pair):
         """ https://docs.python.org/3/library/socket.html#socket.socket.connect_ex
         Like connect(address), but return an error indicator instead of raising an exception for errors returned by the C-level connect() call (other problems, such as "host not found" can still raise exceptions).
+
+        On a non-blocking socket this returns EINPROGRESS (or the platform's
+        equivalent) straight away; the proxy negotiation is then advanced
+        by continue_negotiation() whenever the socket is ready.
         """
+        if self.gettimeout() == 0 and self.type == socket.SOCK_STREAM:
+            return self._start_negotiation(dest_pair)
         try:
             self.connect(dest_pair, catch_errors=True)
             return 0
@@ -835,13 +3553,163 @@ class socksocket(_BaseSocket):
             else:
                 raise
 
-    def _proxy_addr(self):
+    def _start_negotiation(self, dest_pair):
+        """Starts a non-blocking connection to dest_pair through the proxy
+        chain. Returns connect_ex()'s error indicator."""
+        dest_addr, dest_port = dest_pair
+        if isinstance(self.proxy[0], ProxyPool):
+            self._use_proxy_pool()
+        if self.proxy[0] is None:
+            # Treat like regular socket object
+            self.proxy_peername = dest_pair
+            super(socksocket, self).settimeout(0.0)
+            return super(socksocket, self).connect_ex(dest_pair)
+
+        if not dest_addr or not isinstance(dest_port, int):
+            raise GeneralProxyError(
+                "Invalid destination-connection (host, port) pair")
+
+        super(socksocket, self).settimeout(0.0)
+        proxy_addr, proxy_port = self._proxy_addr()
+        sockaddr = _proxy_getaddrinfo(proxy_addr, proxy_port,
+                                      self.family)[0][4]
+        # The TLS layer can't wait for a connect() deferred to its first
+        # send
+        fast_open = (not self._hops()[0][1] and self.proxy[0] != HTTPS
+                     and self._enable_fast_open())
+        code = super(socksocket, self).connect_ex(sockaddr)
+        if code not in (0, EINPROGRESS, EWOULDBLOCK):
+            _proxy_failed(proxy_addr, proxy_port)
+            self._record_proxy_pool(socket.error(code, os.strerror(code)))
+            self.close()
+            return code
+        self._handshake = _NonBlockingHandshake(
+            self, self._chain_handshake(dest_addr, dest_port), fast_open)
+        return code or EINPROGRESS
+
+    def _chain_handshake(self, dest_addr, dest_port):
+        """The handshakes with each hop of the proxy chain, run as one."""
+        hops = self._hops()
+        targets = [self._proxy_addr(hop) for hop, _ in hops[1:]]
+        targets.append((dest_addr, dest_port))
+        pipeline = self.proxy_options.get("pipeline", False)
+        self.proxy_chain_times = []
+        for (hop, tls), (addr, port) in zip(hops, targets):
+            start = _clock()
+            self.proxy = hop
+            try:
+                layer = self._start_proxy_tls(tls)
+            finally:
+                self.proxy = hops[0][0]
+            if layer:
+                yield _TLS, layer
+            if hop[0] in (HTTP, HTTPS):
+                handshake = _HTTP_handshake(hop, addr, port,
+                                            authorized=self._http_auth)
+            else:
+                handshake = _handshakes[hop[0]](hop, addr, port, pipeline)
+            try:
+                result = None
+                while True:
+                    op, arg = handshake.send(result)
+                    if op == _DONE:
+                        break
+                    result = yield op, arg
+            finally:
+                handshake.close()
+            if layer:
+                _keep_proxy_tls_session(layer)
+            self.proxy_chain_times.append(_clock() - start)
+        yield _DONE, arg
+
+    @property
+    def wants_read(self):
+        """True while a non-blocking negotiation waits for the socket to
+        become readable. Not while TLS holds data for it already (see
+        pending()), when it can go on straight away."""
+        return bool(self._handshake and self._handshake.wants_read
+                    and not self.pending())
+
+    @property
+    def wants_write(self):
+        """True while a non-blocking negotiation waits for the socket to
+        become writable."""
+        return bool(self._handshake and self._handshake.wants_write)
+
+    def continue_negotiation(self):
+        """Advances the negotiation started by connect_ex() on a non-blocking
+        socket as far as possible without blocking.
+
+        Returns True once the connection through the proxy is established.
+        Until then, wait for the socket to become readable (wants_read) or
+        writable (wants_write), if either, and call again. Raises ProxyError
+        on failure, as connect() would."""
+        handshake = self._handshake
+        if handshake is None:
+            return True
+        try:
+            if not handshake.step():
+                return False
+        except ProxyError as error:
+            self._handshake = None
+            handshake.close()
+            self._record_proxy_pool(error)
+            self.close()
+            raise
+        except socket.error as error:
+            self._handshake = None
+            # With TCP Fast Open, connecting may only fail once the first
+            # bytes are sent
+            connecting = handshake.op == _CONNECT or (
+                handshake.fast_open and error.errno in (
+                    ECONNREFUSED, ETIMEDOUT, EHOSTUNREACH, ENETUNREACH))
+            handshake.close()
+            self._record_proxy_pool(error)
+            self.close()
+            if connecting:
+                proxy_addr, proxy_port = self._proxy_addr()
+                _proxy_failed(proxy_addr, proxy_port)
+                proxy_server = "{}:{}".format(proxy_addr, proxy_port)
+                printable_type = PRINTABLE_PROXY_TYPES[self.proxy[0]]
+                msg = "Error connecting to {} proxy {}".format(printable_type,
+                                                                proxy_server)
+                log.debug("%s due to: %s", msg, error)
+                raise ProxyConnectionError(msg, error)
+            raise GeneralProxyError("Socket error", error)
+        self._handshake = None
+        self.proxy_peername, self.proxy_sockname = handshake.result
+        self._record_proxy_pool()
+        if handshake.fast_open:
+            self._record_fast_open()
+        return True
+
+    def _use_proxy_pool(self):
+        """Switches from the ProxyPool set as proxy to the proxy it picks
+        for this connection."""
+        pool = self.proxy[0]
+        member = pool._acquire()
+        self.set_proxy(*member.proxy,
+                       pipeline=self.proxy_options.get("pipeline", False),
+                       fast_open=self.proxy_options.get("fast_open", False),
+                       tls=self.proxy_options.get("tls"))
+        self._proxy_pool = (pool, member, _clock())
+        return self._proxy_pool
+
+    def _record_proxy_pool(self, error=None):
+        """Records the outcome of the connection with its ProxyPool: success,
+        or the error it failed with."""
+        if self._proxy_pool:
+            pool, member, start = self._proxy_pool
+            if error is None:
+                pool._record(member, _clock() - start)
+            else:
+                pool._record_error(member, error, _clock() - start)
+
+    def _proxy_addr(self, proxy=None):
         """
         Return proxy address to connect to as tuple object
         """
-        (proxy_type, proxy_addr, proxy_port, rdns, username,
-         password) = self.proxy
-        proxy_port = proxy_port or DEFAULT_PORTS.get(proxy_type)
-        if not proxy_port:
+        address = _as_proxy(proxy or self.proxy).address
+        if not address[1]:
             raise GeneralProxyError("Invalid proxy type")
-        return proxy_addr, proxy_port
+        return address
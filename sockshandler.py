@@ -7,8 +7,11 @@ author: e<e@tr0ll.in>
 
 This module provides a Handler which you can use with urllib2 to allow it to tunnel your connection through a socks.sockssocket socket, with out monkey patching the original socket...
 """
+import collections
+import errno
 import socket
 import ssl
+import threading
 
 try:
     import urllib2
@@ -37,53 +40,226 @@ def is_ip(s):
     else:
         return True
 
+# Deprecated: the capability cache (socks.get_capability_cache()) knows
+# which SOCKS4 proxies don't resolve names. Names are still resolved locally
+# for the proxy addresses in it, and those found out are still added.
 socks4_no_rdns = set()
 
 class SocksiPyConnection(httplib.HTTPConnection):
-    def __init__(self, proxytype, proxyaddr, proxyport=None, rdns=True, username=None, password=None, *args, **kwargs):
+    def __init__(self, proxytype, proxyaddr=None, proxyport=None, rdns=True, username=None, password=None, *args, **kwargs):
         self.proxyargs = (proxytype, proxyaddr, proxyport, rdns, username, password)
+        self.proxy_tls = kwargs.pop("proxy_tls", None)  # See socks.set_proxy()
         httplib.HTTPConnection.__init__(self, *args, **kwargs)
 
     def connect(self):
         (proxytype, proxyaddr, proxyport, rdns, username, password) = self.proxyargs
         rdns = rdns and proxyaddr not in socks4_no_rdns
+        retried = False
+        cache = socks.get_capability_cache()
+        if isinstance(proxytype, socks.ProxyPool):
+            cache = None  # Nothing to learn about the pool as a whole
         while True:
             try:
                 sock = socks.create_connection(
                     (self.host, self.port), self.timeout, None,
                     proxytype, proxyaddr, proxyport, rdns, username, password,
-                    ((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),))
+                    ((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),),
+                    proxy_tls=self.proxy_tls)
                 break
             except socks.SOCKS4Error as e:
-                if rdns and "0x5b" in str(e) and not is_ip(self.host):
+                if (rdns and "0x5b" in str(e) and not is_ip(self.host)
+                        and (cache is None
+                             or cache.get(self.proxyargs, "socks4a") is None)):
                     # Maybe a SOCKS4 server that doesn't support remote resolving
                     # Let's try again
                     rdns = False
+                    retried = True
                     socks4_no_rdns.add(proxyaddr)
                 else:
                     raise
+        if cache and retried:
+            # Resolving locally worked; later connections go straight to it
+            cache.set(self.proxyargs, "socks4a", False)
         self.sock = sock
 
+def _https_context():
+    """The context HTTPSConnection would make for itself, made once so that
+    the TLS sessions of its connections can be resumed."""
+    # Through the hook HTTPSConnection uses, so that replacing it (PEP 476)
+    # still turns certificate verification off
+    context = ssl._create_default_https_context()
+    if hasattr(context, "set_alpn_protocols"):
+        context.set_alpn_protocols(["http/1.1"])
+    if getattr(context, "post_handshake_auth", None) is not None:
+        context.post_handshake_auth = True
+    return context
+
 class SocksiPyConnectionS(httplib.HTTPSConnection):
-    def __init__(self, proxytype, proxyaddr, proxyport=None, rdns=True, username=None, password=None, *args, **kwargs):
+    def __init__(self, proxytype, proxyaddr=None, proxyport=None, rdns=True, username=None, password=None, *args, **kwargs):
         self.proxyargs = (proxytype, proxyaddr, proxyport, rdns, username, password)
+        self.proxy_tls = kwargs.pop("proxy_tls", None)
+        # socks.TLSSessionCache to resume sessions from, by (host, port)
+        self.tls_sessions = kwargs.pop("tls_sessions", None)
+        self._tls = None
+        self._tls_session_key = None  # Session to keep once it arrives
         httplib.HTTPSConnection.__init__(self, *args, **kwargs)
 
     def connect(self):
         SocksiPyConnection.connect(self)
-        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host)
+        kwargs = {}
+        if self.tls_sessions is not None:
+            self._tls_session_key = (self.host, self.port)
+            session = self.tls_sessions.get(self._tls_session_key)
+            if session is not None:
+                kwargs["session"] = session
+        if getattr(self.sock, "proxy_tls", None) is not None:
+            # TLS inside the TLS to the proxy; wrap_socket() can't nest
+            tls = self.sock.start_tls(self._context, server_hostname=self.host, **kwargs)
+        else:
+            self.sock = tls = self._context.wrap_socket(self.sock, server_hostname=self.host, **kwargs)
+        self._tls = tls
         if not self._context.check_hostname and self._check_hostname:
             try:
-                ssl.match_hostname(self.sock.getpeercert(), self.host)
+                ssl.match_hostname(tls.getpeercert(), self.host)
             except Exception:
                 self.sock.shutdown(socket.SHUT_RDWR)
                 self.sock.close()
                 raise
 
+    def getresponse(self, *args, **kwargs):
+        response = httplib.HTTPSConnection.getresponse(self, *args, **kwargs)
+        if self._tls_session_key is not None:
+            # With TLS 1.3 the session comes after the handshake; it has
+            # surely arrived by the time the response has
+            self.tls_sessions.update(self._tls_session_key, self._tls)
+            self._tls_session_key = None
+        return response
+
+class SocksiPyConnectionPool(object):
+    """Keeps tunnelled connections alive between requests.
+
+    Connections are keyed by proxy arguments, scheme, host, port and TLS
+    context. At most max_per_host connections are kept per key and maxsize
+    in total; connections idle for longer than idle_timeout seconds, or
+    which the server closed or sent unexpected data on, are discarded.
+    Safe to share between handlers and threads."""
+
+    def __init__(self, maxsize=32, max_per_host=4, idle_timeout=60.0):
+        self.maxsize = maxsize
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._pool = {}  # key -> deque of [conn, response, last used]
+        self._size = 0
+
+    def get(self, key):
+        """Return an idle, live connection for key, or None."""
+        stale = []
+        try:
+            with self._lock:
+                entries = self._pool.get(key, ())
+                now = socks._clock()
+                for entry in list(entries):
+                    conn, response, used = entry
+                    if not response.isclosed():
+                        continue  # Still in use by a previous request
+                    self._remove(key, entry)
+                    if now - used > self.idle_timeout or self._is_stale(conn):
+                        stale.append(conn)
+                        continue
+                    return conn
+                return None
+        finally:
+            for conn in stale:
+                conn.close()
+
+    def put(self, key, conn, response):
+        """Keep conn once response has been read, if the server allows it."""
+        if response.will_close or not conn.sock:
+            self._discard(conn)
+            return
+        evicted = []
+        with self._lock:
+            entries = self._pool.setdefault(key, collections.deque())
+            if len(entries) >= self.max_per_host:
+                evicted.append(entries[0])
+                self._remove(key, entries[0])
+            if self._size >= self.maxsize:
+                oldest = min((e for d in self._pool.values() for e in d),
+                             key=lambda e: e[2])
+                evicted.append(oldest)
+                for k, d in self._pool.items():
+                    if oldest in d:
+                        self._remove(k, oldest)
+                        break
+            self._pool.setdefault(key, collections.deque()).append(
+                [conn, response, socks._clock()])
+            self._size += 1
+        for entry in evicted:
+            self._discard(entry[0])
+
+    def clear(self):
+        """Discard all pooled connections."""
+        with self._lock:
+            entries = [e for d in self._pool.values() for e in d]
+            self._pool.clear()
+            self._size = 0
+        for entry in entries:
+            self._discard(entry[0])
+
+    def _remove(self, key, entry):
+        entries = self._pool[key]
+        entries.remove(entry)
+        self._size -= 1
+        if not entries:
+            del self._pool[key]
+
+    @staticmethod
+    def _is_stale(conn):
+        sock = conn.sock
+        if sock is None:
+            return True
+        if getattr(sock, "pending", None) and sock.pending():
+            return True
+        try:
+            # An idle keep-alive connection has nothing to read; if it's
+            # readable the server closed it or sent something unexpected.
+            readable, _ = socks._wait_ready([sock], [], 0)
+        except (socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    @staticmethod
+    def _discard(conn):
+        # Like urllib's do_open(): the socket really closes once a response
+        # that may still be being read is done with it.
+        if conn.sock:
+            conn.sock.close()
+            conn.sock = None
+
+# Methods which may be sent again when a kept-alive connection was dropped
+_IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+def _closed_before_handled(err):
+    """Whether err means the server had closed the connection before it
+    handled the request, rather than it timing out or failing midway."""
+    if isinstance(err, httplib.BadStatusLine):
+        return err.line in ("", "''")  # Nothing was read back; repr()ed
+    return getattr(err, "errno", None) in (errno.ECONNRESET, errno.EPIPE)
+
 class SocksiPyHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
     def __init__(self, *args, **kwargs):
+        # pool: optional SocksiPyConnectionPool for keep-alive (Python 3)
+        self.pool = kwargs.pop("pool", None)
+        # tls_sessions: socks.TLSSessionCache for resuming TLS sessions with
+        # the servers, whose resumed and full attributes count handshakes.
+        # Pass None to do full handshakes only.
+        self.tls_sessions = kwargs.pop("tls_sessions", True)
+        if self.tls_sessions is True:
+            self.tls_sessions = socks.TLSSessionCache()
         self.args = args
         self.kw = kwargs
+        self._context = None  # Shared by connections, as sessions need
         urllib2.HTTPHandler.__init__(self)
 
     def http_open(self, req):
@@ -91,14 +267,82 @@ class SocksiPyHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
             kw = merge_dict(self.kw, kwargs)
             conn = SocksiPyConnection(*self.args, host=host, port=port, timeout=timeout, **kw)
             return conn
-        return self.do_open(build, req)
+        return self.pooled_open(build, req, "http")
 
     def https_open(self, req):
+        if self.tls_sessions is not None and "context" not in self.kw and self._context is None:
+            self._context = _https_context()
+
         def build(host, port=None, timeout=0, **kwargs):
             kw = merge_dict(self.kw, kwargs)
-            conn = SocksiPyConnectionS(*self.args, host=host, port=port, timeout=timeout, **kw)
+            if self._context is not None:
+                kw.setdefault("context", self._context)
+            conn = SocksiPyConnectionS(*self.args, host=host, port=port, timeout=timeout,
+                                       tls_sessions=self.tls_sessions, **kw)
             return conn
-        return self.do_open(build, req)
+        return self.pooled_open(build, req, "https")
+
+    def pooled_open(self, build, req, scheme):
+        """Like do_open(), but reuses connections from self.pool."""
+        if self.pool is None or not hasattr(req, "selector"):
+            return self.do_open(build, req)
+
+        host = req.host
+        if not host:
+            raise urllib2.URLError("no host given")
+        key = (scheme, host, self.args, tuple(sorted(self.kw.items())))
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items()
+                       if k not in headers)
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        # Only a request which can be sent again unchanged, and safely so
+        replayable = (req.get_method() in _IDEMPOTENT_METHODS
+                      and (req.data is None
+                           or isinstance(req.data, (bytes, bytearray))))
+        while True:
+            conn = self.pool.get(key)
+            retry = conn is not None and replayable
+            if conn is None:
+                conn = build(host, timeout=req.timeout)
+            else:
+                # This request's timeout, not that of the one before
+                conn.timeout = req.timeout
+                if req.timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                    conn.sock.settimeout(socket.getdefaulttimeout())
+                else:
+                    conn.sock.settimeout(req.timeout)
+            conn.set_debuglevel(self._debuglevel)
+            try:
+                try:
+                    conn.request(req.get_method(), req.selector, req.data,
+                                 headers, encode_chunked=req.has_header(
+                                     "Transfer-encoding"))
+                except socket.error as err: # timeout error
+                    if not (retry and _closed_before_handled(err)):
+                        raise urllib2.URLError(err)
+                    # The server dropped the idle connection under us
+                    conn.close()
+                    continue
+                try:
+                    r = conn.getresponse()
+                except socket.timeout as err:
+                    raise urllib2.URLError(err)
+                except (socket.error, httplib.BadStatusLine) as err:
+                    if not (retry and _closed_before_handled(err)):
+                        raise
+                    conn.close()
+                    continue
+            except:
+                conn.close()
+                raise
+            break
+
+        self.pool.put(key, conn, r)
+        r.url = req.get_full_url()
+        r.msg = r.reason
+        return r
 
 if __name__ == "__main__":
     import sys
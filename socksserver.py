@@ -0,0 +1,385 @@
+"""
+asyncio SOCKS server for PySocks (Python 3.7+)
+
+Accepts SOCKS4, SOCKS4a and SOCKS5 clients (CONNECT and UDP ASSOCIATE) and
+connects them either directly or through an upstream proxy, using the same
+handshake code as socks.socksocket:
+
+    server = socksserver.SOCKSServer(upstream=(socks.SOCKS5, "proxy", 1080))
+    await server.start("127.0.0.1", 1080)
+
+Or from the command line:
+
+    python -m socksserver --listen 127.0.0.1:1080 --upstream proxy:1080
+"""
+import argparse
+import asyncio
+import errno
+from io import BytesIO
+import socket
+import struct
+
+import asyncsocks
+import socks
+
+__all__ = ["SOCKSServer"]
+
+# SOCKS5 reply codes for errors connecting to the destination
+_SOCKS5_REPLIES = {
+    errno.ENETUNREACH: 0x03,
+    errno.EHOSTUNREACH: 0x04,
+    errno.ECONNREFUSED: 0x05,
+    errno.ETIMEDOUT: 0x06,
+}
+
+
+def _SOCKS5_address(addr):
+    """ATYP, address and port of an IP address, as the SOCKS5 protocol
+    puts them."""
+    file = BytesIO()
+    socks._write_SOCKS5_address(addr, file, False)
+    return file.getvalue()
+
+
+def _SOCKS5_reply(status, addr=("0.0.0.0", 0)):
+    return struct.pack("BBx", 0x05, status) + _SOCKS5_address(addr)
+
+
+class SOCKSServer(object):
+    """SOCKSServer(upstream=None, users=None, max_connections=1024,
+    buffer_size=65536, connect_timeout=30.0)
+
+    upstream -        Tuple of set_proxy() arguments for a proxy to connect
+                       through, or None to connect directly.
+    users -           Dict of SOCKS5 usernames and passwords to require;
+                       SOCKS4 clients are then refused.
+    max_connections - Clients beyond this many (UDP associations included)
+                       are disconnected straight away.
+    buffer_size -     Bytes buffered per direction of each connection; a
+                       full buffer stops reading from the other side.
+    connect_timeout - Seconds to wait for the destination or upstream.
+
+    The bytes_relayed attribute counts bytes forwarded through tunnels."""
+
+    def __init__(self, upstream=None, users=None, max_connections=1024,
+                 buffer_size=65536, connect_timeout=30.0):
+        if upstream:
+            upstream = tuple(upstream)
+            upstream += (None, None, None, True, None, None)[len(upstream):]
+        self.upstream = upstream
+        self.users = users
+        self.max_connections = max_connections
+        self.buffer_size = buffer_size
+        self.connect_timeout = connect_timeout
+        self.connections = 0
+        self.bytes_relayed = 0
+        self._tasks = set()
+
+    async def start(self, host="127.0.0.1", port=1080, **kwds):
+        """Starts listening; returns the asyncio.Server. Extra keyword
+        arguments are passed on to asyncio.start_server()."""
+        return await asyncio.start_server(self._handle, host, port,
+                                          limit=self.buffer_size, **kwds)
+
+    async def serve_forever(self, host="127.0.0.1", port=1080, **kwds):
+        server = await self.start(host, port, **kwds)
+        async with server:
+            await server.serve_forever()
+
+    async def close(self):
+        """Disconnects all clients and drops the datagrams still waiting for
+        their destination's name to resolve. Close the asyncio.Server from
+        start() first to stop accepting new ones."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _handle(self, reader, writer):
+        if self.connections >= self.max_connections:
+            writer.close()
+            return
+        self.connections += 1
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        writer.transport.set_write_buffer_limits(high=self.buffer_size)
+        try:
+            version, = await reader.readexactly(1)
+            if version == 0x05:
+                await self._SOCKS5(reader, writer)
+            elif version == 0x04:
+                await self._SOCKS4(reader, writer)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, OSError, ValueError) as e:
+            socks.log.debug("SOCKS client %s: %r",
+                            writer.get_extra_info("peername"), e)
+        except asyncio.CancelledError:
+            pass  # close(); asyncio 3.11 logs cancelled callbacks as errors
+        finally:
+            self.connections -= 1
+            self._tasks.discard(task)
+            writer.close()
+
+    async def _SOCKS4(self, reader, writer):
+        cmd, port = struct.unpack(">BH", await reader.readexactly(3))
+        addr = await reader.readexactly(4)
+        await reader.readuntil(b"\x00")  # userid
+        if addr.startswith(b"\x00\x00\x00") and addr != b"\x00" * 4:
+            # SOCKS4a: the host name follows
+            host = (await reader.readuntil(b"\x00"))[:-1].decode("idna")
+        else:
+            host = socket.inet_ntoa(addr)
+
+        if cmd != 0x01 or self.users is not None:
+            writer.write(b"\x00\x5b" + b"\x00" * 6)
+            return
+        try:
+            remote = await self._connect(host, port)
+        except (OSError, asyncio.TimeoutError):
+            writer.write(b"\x00\x5b" + b"\x00" * 6)
+            return
+        writer.write(b"\x00\x5a" + struct.pack(">H", port) + addr)
+        await self._relay(reader, writer, *remote)
+
+    async def _SOCKS5(self, reader, writer):
+        nmethods, = await reader.readexactly(1)
+        methods = await reader.readexactly(nmethods)
+        method = 0x00 if self.users is None else 0x02
+        if method not in methods:
+            writer.write(b"\x05\xff")
+            return
+        writer.write(struct.pack("BB", 0x05, method))
+
+        if method == 0x02:
+            version, length = await reader.readexactly(2)
+            username = await reader.readexactly(length)
+            length, = await reader.readexactly(1)
+            password = await reader.readexactly(length)
+            username = username.decode("utf-8", "replace")
+            if self.users.get(username) != password.decode("utf-8", "replace"):
+                writer.write(b"\x01\x01")
+                return
+            writer.write(b"\x01\x00")
+
+        version, cmd, _, atyp = await reader.readexactly(4)
+        if atyp == 0x01:
+            host = socket.inet_ntoa(await reader.readexactly(4))
+        elif atyp == 0x03:
+            length, = await reader.readexactly(1)
+            host = (await reader.readexactly(length)).decode("idna")
+        elif atyp == 0x04:
+            host = socket.inet_ntop(socket.AF_INET6,
+                                    await reader.readexactly(16))
+        else:
+            writer.write(_SOCKS5_reply(0x08))
+            return
+        port, = struct.unpack(">H", await reader.readexactly(2))
+
+        if cmd == 0x03:
+            await self._udp_associate(reader, writer)
+            return
+        if cmd != 0x01:
+            writer.write(_SOCKS5_reply(0x07))
+            return
+        try:
+            remote = await self._connect(host, port)
+        except socks.ProxyError as e:
+            socks.log.debug("Upstream error for %s:%s: %s", host, port, e)
+            writer.write(_SOCKS5_reply(0x01))
+            return
+        except asyncio.TimeoutError:
+            writer.write(_SOCKS5_reply(0x06))
+            return
+        except OSError as e:
+            writer.write(_SOCKS5_reply(_SOCKS5_REPLIES.get(e.errno, 0x04)))
+            return
+        sockname = remote[1].get_extra_info("sockname")
+        writer.write(_SOCKS5_reply(0x00, sockname[:2]))
+        await self._relay(reader, writer, *remote)
+
+    async def _connect(self, host, port):
+        """Opens streams to host:port, through the upstream proxy if any."""
+        if self.upstream:
+            connect = asyncsocks.open_connection((host, port), *self.upstream,
+                                                 limit=self.buffer_size)
+        else:
+            connect = asyncio.open_connection(host, port,
+                                              limit=self.buffer_size)
+        reader, writer = await asyncio.wait_for(connect, self.connect_timeout)
+        writer.transport.set_write_buffer_limits(high=self.buffer_size)
+        return reader, writer
+
+    async def _relay(self, reader, writer, remote_reader, remote_writer):
+        try:
+            await asyncio.gather(self._pipe(reader, remote_writer),
+                                 self._pipe(remote_reader, writer))
+        finally:
+            remote_writer.close()
+
+    async def _pipe(self, reader, writer):
+        """Copies reader to writer until EOF, then half-closes writer."""
+        try:
+            while True:
+                data = await reader.read(self.buffer_size)
+                if not data:
+                    break
+                writer.write(data)
+                self.bytes_relayed += len(data)
+                await writer.drain()  # Back-pressure
+            if writer.can_write_eof():
+                writer.write_eof()
+        except OSError:  # Reset, or the other side is already gone
+            writer.close()
+
+    async def _udp_associate(self, reader, writer):
+        """Relays datagrams for the client until it closes the connection."""
+        loop = asyncio.get_running_loop()
+        client_host = writer.get_extra_info("peername")[0]
+        local_host = writer.get_extra_info("sockname")[0]
+        relay = _UDPRelay(self, client_host)
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: relay, local_addr=(local_host, 0))
+        sockname = transport.get_extra_info("sockname")
+        upstream = None
+        try:
+            if self.upstream:
+                try:
+                    upstream, relay.upstream = \
+                        await self._upstream_udp_associate(sockname[1])
+                except (OSError, asyncio.TimeoutError) as e:
+                    socks.log.debug("Upstream UDP association failed: %s", e)
+                    writer.write(_SOCKS5_reply(0x01))
+                    return
+            writer.write(_SOCKS5_reply(0x00, sockname[:2]))
+            # The association lasts as long as the TCP connection
+            while await reader.read(self.buffer_size):
+                pass
+        finally:
+            transport.close()
+            if upstream:
+                upstream.close()
+
+    async def _upstream_udp_associate(self, port):
+        """Sets up a UDP association with the upstream proxy for datagrams
+        from the given local port.
+
+        Returns the TCP socket that keeps it alive and the relay address."""
+        loop = asyncio.get_running_loop()
+        proxy = socks._proxy_for(*self.upstream)
+        if proxy[0] != socks.SOCKS5:
+            raise socks.GeneralProxyError(
+                "UDP only supported by SOCKS5 proxy type")
+        family, socket_type, proto, _, sa = (await loop.getaddrinfo(
+            *proxy.address, type=socket.SOCK_STREAM))[0]
+        sock = socket.socket(family, socket_type, proto)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, sa),
+                                   self.connect_timeout)
+            UDP_ASSOCIATE = b"\x03"
+            # As in socksocket.bind(), give the port but not the address
+            handshake = socks._SOCKS5_handshake(proxy, UDP_ASSOCIATE,
+                                                ("0", port))
+            (_, (_, relay_port)), _ = await asyncsocks._run_handshake(
+                loop, sock, handshake)
+        except BaseException:
+            sock.close()
+            raise
+        # As in socksocket.bind(), the relay is assumed to be on the proxy
+        return sock, (sa[0], relay_port)
+
+
+class _UDPRelay(asyncio.DatagramProtocol):
+    """Forwards datagrams between a client and its destinations, or the
+    upstream proxy's relay. Only the client's host may use it."""
+
+    def __init__(self, server, client_host):
+        self.server = server
+        self.client_host = client_host
+        self.client = None
+        self.upstream = None  # Address of the upstream proxy's relay
+        self.headers = {}  # Source address -> SOCKS5 UDP header
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def _from_client(self, addr):
+        if self.client:
+            return addr == self.client
+        # The first datagram from the client's host fixes its address
+        if addr[0] == self.client_host and addr[:2] != self.upstream:
+            self.client = addr
+            return True
+        return False
+
+    def datagram_received(self, data, addr):
+        if self._from_client(addr):
+            if self.upstream:
+                # Already in the upstream's format
+                self.transport.sendto(data, self.upstream)
+                return
+            try:
+                start, dest = socks._read_SOCKS5_udp_header(memoryview(data))
+            except (socks.ProxyError, NotImplementedError):
+                return  # Malformed or fragmented: drop, as RFC 1928 allows
+            host, port = dest
+            if isinstance(host, bytes):
+                # Held by the server until done, which close() cancels
+                task = asyncio.ensure_future(self._send_to_name(
+                    data[start:], host.decode("idna"), port))
+                self.server._tasks.add(task)
+                task.add_done_callback(self.server._tasks.discard)
+            else:
+                self.transport.sendto(data[start:], (host, port))
+        elif self.client:
+            if self.upstream:
+                # Only the upstream's relay may send to the client
+                if addr[:2] == self.upstream:
+                    self.transport.sendto(data, self.client)
+                return
+            header = self.headers.get(addr[:2])
+            if header is None:
+                header = b"\x00\x00\x00" + _SOCKS5_address(addr[:2])
+                if len(self.headers) < socks.MAX_UDP_HEADER_CACHE_SIZE:
+                    self.headers[addr[:2]] = header
+            self.transport.sendto(header + data, self.client)
+
+    async def _send_to_name(self, payload, host, port):
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+        except OSError:
+            return
+        self.transport.sendto(payload, infos[0][4][:2])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="SOCKS4/SOCKS5 server, optionally forwarding to an"
+                    " upstream proxy")
+    parser.add_argument("--listen", default="127.0.0.1:1080",
+                        help="host:port to listen on")
+    parser.add_argument("--upstream", help="host:port of the upstream proxy")
+    # No TLS to the proxy with asyncio
+    parser.add_argument("--upstream-type", default="SOCKS5",
+                        choices=sorted(name for name, proxy_type
+                                       in socks.PROXY_TYPES.items()
+                                       if proxy_type != socks.HTTPS),
+                        help="type of the upstream proxy")
+    parser.add_argument("--max-connections", type=int, default=1024)
+    args = parser.parse_args(argv)
+
+    upstream = None
+    if args.upstream:
+        host, port = args.upstream.rsplit(":", 1)
+        upstream = (socks.PROXY_TYPES[args.upstream_type], host, int(port))
+    host, port = args.listen.rsplit(":", 1)
+    server = SOCKSServer(upstream, max_connections=args.max_connections)
+    try:
+        asyncio.run(server.serve_forever(host, int(port)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
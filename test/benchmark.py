@@ -0,0 +1,688 @@
+"""Performance benchmarks for PySocks.
+
+Runs SOCKS4, SOCKS5 and HTTP CONNECT stand-in proxies in-process, so neither
+3proxy nor network access is needed, and measures:
+
+ * connects per second and p50/p99 connect latency of socksocket.connect()
+   and create_connection()
+ * connects per second of create_connections(), which negotiates many
+   tunnels at a time
+ * connects per second through a proxy given by host name, with and
+   without the proxy address cache
+ * connects per second through an HTTPS proxy, resuming TLS sessions and
+   doing full handshakes (Python 3.5+)
+ * requests per second through SocksiPyHandler
+ * tunnel throughput
+ * UDP datagrams per second through a SOCKS5 UDP association
+ * throughput of socks.relay(), with os.splice() where available and with
+   plain copies
+ * connects per second and throughput through socksserver, directly and
+   chained to a stand-in upstream (Python 3.7+)
+
+Usage:
+
+    python -m test.benchmark [--rtt MS] [--duration S] [--json FILE]
+                             [--compare FILE [--tolerance FRACTION]]
+
+--rtt delays every round trip of the handshakes by the given number of
+milliseconds. --json saves the results, --compare prints the change against
+results saved earlier and exits with status 1 if anything got worse by more
+than the tolerance.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import urllib.request as urllib2
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import urllib2
+
+import socks
+import sockshandler
+
+HOST = '127.0.0.1'
+CHUNK = b'\0' * 65536
+CERT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    'keycert.pem')
+LINGER_RESET = struct.pack('ii', 1, 0)  # close() sends RST, no TIME_WAIT
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def reset_close(sock):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, LINGER_RESET)
+    except socket.error:
+        pass
+    sock.close()
+
+
+def serve(server, handle):
+    """Accepts connections on server forever, handling each in a thread."""
+    def accept_loop():
+        while True:
+            conn, _ = server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            th = threading.Thread(target=handle, args=(conn,))
+            th.daemon = True
+            th.start()
+    th = threading.Thread(target=accept_loop)
+    th.daemon = True
+    th.start()
+
+
+def listen(sock_type=socket.SOCK_STREAM):
+    sock = socket.socket(socket.AF_INET, sock_type)
+    sock.bind((HOST, 0))
+    if sock_type == socket.SOCK_STREAM:
+        sock.listen(128)
+    return sock
+
+
+class Client(object):
+    """The proxy's side of a client connection.
+
+    Every recv() that has to wait for the client counts as a new round
+    trip, which is delayed by rtt seconds."""
+
+    def __init__(self, sock, rtt):
+        self.sock = sock
+        self.rtt = rtt
+        self.buffer = b''
+
+    def read(self, count):
+        while len(self.buffer) < count:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError
+            if self.rtt:
+                time.sleep(self.rtt)
+            self.buffer += data
+        data, self.buffer = self.buffer[:count], self.buffer[count:]
+        return bytearray(data)
+
+    def read_headers(self):
+        while b'\r\n\r\n' not in self.buffer:
+            self.read(len(self.buffer) + 1)
+            self.buffer = bytes(self.buffer)  # Undo read()'s consumption
+        end = self.buffer.index(b'\r\n\r\n') + 4
+        return self.read(end)
+
+
+class StandInProxy(object):
+    """A minimal threaded SOCKS4/SOCKS5/HTTP(S) CONNECT proxy.
+
+    Accepts any credentials. SOCKS5 supports CONNECT and UDP ASSOCIATE.
+    The TLS handshake of HTTPS isn't delayed by rtt."""
+
+    def __init__(self, proxy_type, rtt=0.0):
+        self.proxy_type = proxy_type
+        self.rtt = rtt
+        self.server = listen()
+        self.port = self.server.getsockname()[1]
+        handlers = {socks.SOCKS4: self.handle_socks4,
+                    socks.SOCKS5: self.handle_socks5,
+                    socks.HTTP: self.handle_http,
+                    socks.HTTPS: self.handle_https}
+        if proxy_type == socks.HTTPS:
+            # One context, whose session tickets all connections accept
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.context.load_cert_chain(CERT)
+        serve(self.server, handlers[proxy_type])
+
+    def handle_https(self, sock):
+        try:
+            sock = self.context.wrap_socket(sock, server_side=True)
+        except socket.error:
+            return reset_close(sock)
+        self.handle_http(sock)
+
+    def handle_socks4(self, sock):
+        client = Client(sock, self.rtt)
+        try:
+            _, _, port = struct.unpack('>BBH', client.read(4))
+            ip = socket.inet_ntoa(bytes(client.read(4)))
+            while client.read(1) != b'\0':  # userid
+                pass
+            if ip.startswith('0.0.0.'):
+                host = bytearray()
+                while True:
+                    c = client.read(1)
+                    if c == b'\0':
+                        break
+                    host += c
+                ip = host.decode('idna')
+            dest = socket.create_connection((ip, port))
+            sock.sendall(b'\0\x5a' + struct.pack('>H', port)
+                         + socket.inet_aton(dest.getpeername()[0]))
+            relay(client, dest)
+        except (EOFError, socket.error):
+            reset_close(sock)
+
+    def handle_socks5(self, sock):
+        client = Client(sock, self.rtt)
+        try:
+            _, nmethods = client.read(2)
+            methods = client.read(nmethods)
+            method = 2 if 2 in methods else 0
+            sock.sendall(struct.pack('BB', 5, method))
+            if method == 2:
+                _, length = client.read(2)
+                client.read(length)
+                length, = client.read(1)
+                client.read(length)
+                sock.sendall(b'\x01\0')
+            _, cmd, _, atyp = client.read(4)
+            if atyp == 1:
+                host = socket.inet_ntoa(bytes(client.read(4)))
+            elif atyp == 3:
+                length, = client.read(1)
+                host = client.read(length).decode('idna')
+            else:
+                host = socket.inet_ntop(socket.AF_INET6,
+                                        bytes(client.read(16)))
+            port, = struct.unpack('>H', client.read(2))
+            if cmd == 3:
+                udp = listen(socket.SOCK_DGRAM)
+                bound = udp.getsockname()
+                sock.sendall(b'\x05\0\0\x01' + socket.inet_aton(bound[0])
+                             + struct.pack('>H', bound[1]))
+                relay_udp(client, udp)
+                return
+            dest = socket.create_connection((host, port))
+            bound = dest.getsockname()
+            sock.sendall(b'\x05\0\0\x01' + socket.inet_aton(bound[0])
+                         + struct.pack('>H', bound[1]))
+            relay(client, dest)
+        except (EOFError, socket.error):
+            reset_close(sock)
+
+    def handle_http(self, sock):
+        client = Client(sock, self.rtt)
+        try:
+            request = bytes(client.read_headers()).decode('iso-8859-1')
+            host, port = request.split(' ', 2)[1].rsplit(':', 1)
+            dest = socket.create_connection((host, int(port)))
+            sock.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            relay(client, dest)
+        except (EOFError, socket.error, ValueError):
+            reset_close(sock)
+
+
+def relay(client, dest):
+    """Copies data both ways until either side closes."""
+    sock = client.sock
+    dest.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        if client.buffer:
+            dest.sendall(client.buffer)
+        while True:
+            readable, _, _ = select.select([sock, dest], [], [])
+            for source in readable:
+                data = source.recv(65536)
+                if not data:
+                    # Pass the close on; a reset would lose data in flight
+                    other = dest if source is sock else sock
+                    other.close()
+                    return
+                (dest if source is sock else sock).sendall(data)
+    except socket.error:
+        pass
+    finally:
+        reset_close(dest)
+        reset_close(sock)
+
+
+def relay_udp(client, udp):
+    """Relays datagrams for a SOCKS5 UDP association until the client
+    closes the TCP connection."""
+    peer = None
+    try:
+        while True:
+            readable, _, _ = select.select([client.sock, udp], [], [])
+            if client.sock in readable:
+                if not client.sock.recv(1):
+                    return
+            if udp not in readable:
+                continue
+            data, source = udp.recvfrom(65536)
+            if peer is None or source == peer:
+                peer = source
+                header = bytearray(data[:4])
+                if header[3] != 1:
+                    continue
+                host = socket.inet_ntoa(data[4:8])
+                port, = struct.unpack('>H', data[8:10])
+                udp.sendto(data[10:], (host, port))
+            else:
+                udp.sendto(b'\0\0\0\x01' + socket.inet_aton(source[0])
+                           + struct.pack('>H', source[1]) + data, peer)
+    except socket.error:
+        pass
+    finally:
+        udp.close()
+        reset_close(client.sock)
+
+
+class SourceServer(object):
+    """Sends as many bytes as asked for by an 8 byte big-endian count."""
+
+    def __init__(self):
+        self.server = listen()
+        self.address = self.server.getsockname()
+        serve(self.server, self.handle)
+
+    def handle(self, sock):
+        try:
+            data = b''
+            while len(data) < 8:
+                received = sock.recv(8 - len(data))
+                if not received:
+                    return
+                data += received
+            remaining, = struct.unpack('>Q', data)
+            view = memoryview(CHUNK)
+            while remaining:
+                remaining -= sock.send(view[:remaining])
+            sock.recv(1)
+        except socket.error:
+            pass
+        finally:
+            reset_close(sock)
+
+
+class UDPSink(object):
+    """Counts the datagrams it receives."""
+
+    def __init__(self):
+        self.sock = listen(socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.address = self.sock.getsockname()
+        self.received = 0
+        th = threading.Thread(target=self.loop)
+        th.daemon = True
+        th.start()
+
+    def loop(self):
+        while True:
+            self.sock.recv(65536)
+            self.received += 1
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Forwarder(object):
+    """Forwards connections to dest with socks.relay()."""
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.server = listen()
+        self.address = self.server.getsockname()
+        serve(self.server, self.handle)
+
+    def handle(self, sock):
+        dest = socket.create_connection(self.dest)
+        try:
+            socks.relay(sock, dest)
+        except socket.error:
+            pass
+        finally:
+            reset_close(dest)
+            reset_close(sock)
+
+
+class SOCKSServerThread(object):
+    """Runs a socksserver.SOCKSServer on its own event loop thread."""
+
+    def __init__(self, upstream=None):
+        import asyncio
+        import socksserver
+        self.server = socksserver.SOCKSServer(upstream)
+        self.loop = asyncio.new_event_loop()
+        self.listener = self.loop.run_until_complete(
+            self.server.start(HOST, 0))
+        self.port = self.listener.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        import asyncio
+        self.loop.call_soon_threadsafe(self.listener.close)
+        asyncio.run_coroutine_threadsafe(self.server.close(),
+                                         self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def bench_connects(connect, duration):
+    latencies = []
+    start = clock()
+    deadline = start + duration
+    while clock() < deadline:
+        before = clock()
+        sock = connect()
+        latencies.append(clock() - before)
+        reset_close(sock)
+    elapsed = clock() - start
+    return {'connects_per_sec': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000}
+
+
+def bench_bulk(connect_all, count):
+    start = clock()
+    for _, sock, error in connect_all(count):
+        if error:
+            raise error
+        reset_close(sock)
+    return {'connects_per_sec': count / (clock() - start)}
+
+
+def bench_requests(opener, url, duration):
+    count = 0
+    start = clock()
+    deadline = start + duration
+    while clock() < deadline:
+        response = opener.open(url)
+        response.read()
+        response.close()
+        count += 1
+    return {'requests_per_sec': count / (clock() - start)}
+
+
+def bench_throughput(connect, size):
+    sock = connect()
+    start = clock()
+    sock.sendall(struct.pack('>Q', size))
+    buf = bytearray(65536)
+    remaining = size
+    while remaining:
+        received = sock.recv_into(buf)
+        if not received:
+            raise socks.GeneralProxyError('Tunnel closed early')
+        remaining -= received
+    elapsed = clock() - start
+    reset_close(sock)
+    return {'mb_per_sec': size / elapsed / 1e6}
+
+
+def bench_udp(proxy, sink, duration, batch):
+    sock = socks.socksocket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.set_proxy(*proxy)
+    sock.bind(('', 0))
+    payload = b'x' * 64
+    datagrams = [(payload, sink.address)] * batch
+    received_before = sink.received
+    sent = 0
+    start = clock()
+    deadline = start + duration
+    while clock() < deadline:
+        if batch > 1:
+            sent += sock.sendmany(datagrams)
+        else:
+            sock.sendto(payload, sink.address)
+            sent += 1
+    elapsed = clock() - start
+    time.sleep(0.2)  # Let the relay catch up
+    sock.close()
+    return {'sent_per_sec': sent / elapsed,
+            'delivered_per_sec': (sink.received - received_before) / elapsed}
+
+
+def run(rtt=0.0, duration=1.0, size=32 * 2 ** 20):
+    """Runs all benchmarks and returns a dict with the results."""
+    proxies = dict((proxy_type, StandInProxy(proxy_type, rtt))
+                   for proxy_type in (socks.SOCKS4, socks.SOCKS5, socks.HTTP))
+    source = SourceServer()
+    sink = UDPSink()
+    http = ThreadingHTTPServer((HOST, 0), HTTPHandler)
+    th = threading.Thread(target=http.serve_forever)
+    th.daemon = True
+    th.start()
+    url = 'http://%s:%d/' % http.server_address
+
+    variants = [('SOCKS4', socks.SOCKS4, False),
+                ('SOCKS5', socks.SOCKS5, False),
+                ('SOCKS5-pipelined', socks.SOCKS5, True),
+                ('HTTP', socks.HTTP, False)]
+    results = {}
+    for name, proxy_type, pipeline in variants:
+        proxy = (proxy_type, HOST, proxies[proxy_type].port)
+
+        def connect(proxy=proxy, pipeline=pipeline):
+            sock = socks.socksocket()
+            sock.set_proxy(*proxy, pipeline=pipeline)
+            sock.connect(source.address)
+            return sock
+
+        def create_connection(proxy=proxy, pipeline=pipeline):
+            return socks.create_connection(source.address, None, None,
+                                           *proxy, proxy_pipeline=pipeline)
+
+        results['socksocket.connect/' + name] = bench_connects(
+            connect, duration)
+        results['create_connection/' + name] = bench_connects(
+            create_connection, duration)
+        results['throughput/' + name] = bench_throughput(connect, size)
+
+        def create_connections(count, proxy=proxy, pipeline=pipeline):
+            return socks.create_connections([source.address] * count, None,
+                                            None, *proxy,
+                                            proxy_pipeline=pipeline)
+
+        results['create_connections/' + name] = bench_bulk(
+            create_connections, 256)
+
+        for pooled in (False, True):
+            if pipeline or pooled and sys.version_info[0] < 3:
+                continue
+            kwargs = {}
+            if pooled:
+                kwargs['pool'] = sockshandler.SocksiPyConnectionPool()
+            opener = urllib2.build_opener(
+                sockshandler.SocksiPyHandler(*proxy, **kwargs))
+            key = 'SocksiPyHandler%s/%s' % ('-pooled' if pooled else '', name)
+            results[key] = bench_requests(opener, url, duration)
+
+    proxy = (socks.SOCKS5, HOST, proxies[socks.SOCKS5].port)
+    results['udp.sendto/SOCKS5'] = bench_udp(proxy, sink, duration, 1)
+    results['udp.sendmany/SOCKS5'] = bench_udp(proxy, sink, duration, 64)
+
+    standby = socks.StandbyPool(size=4)
+    standby.warm(*proxy)
+    socks.set_standby_pool(standby)
+    try:
+        time.sleep(0.1 + 4 * rtt)  # Let it fill up
+
+        def connect():
+            sock = socks.socksocket()
+            sock.set_proxy(*proxy)
+            sock.connect(source.address)
+            return sock
+
+        result = bench_connects(connect, duration)
+        stats, = standby.stats()
+        result['hit_rate'] = stats['taken'] / float(
+            stats['taken'] + stats['missed'])
+        results['socksocket.connect/SOCKS5-standby'] = result
+    finally:
+        socks.set_standby_pool(None)
+        standby.close()
+
+    # The proxy by host name, resolved on every connect and from the cache
+    named = (socks.SOCKS5, 'localhost', proxies[socks.SOCKS5].port)
+    cache = socks.get_proxy_address_cache()
+    for name, address_cache in (('SOCKS5-by-name-uncached', None),
+                                ('SOCKS5-by-name', socks.ProxyAddressCache())):
+        socks.set_proxy_address_cache(address_cache)
+        try:
+            def connect():
+                sock = socks.socksocket()
+                sock.set_proxy(*named)
+                sock.connect(source.address)
+                return sock
+
+            results['socksocket.connect/' + name] = bench_connects(
+                connect, duration)
+        finally:
+            socks.set_proxy_address_cache(cache)
+
+    if ssl is not None and hasattr(ssl, 'MemoryBIO'):  # Python 3.5+
+        https = StandInProxy(socks.HTTPS, rtt)
+        named = (socks.HTTPS, 'localhost', https.port)
+        context = ssl.create_default_context(cafile=CERT)
+        cache = socks.get_proxy_tls_session_cache()
+        for name, session_cache in (('HTTPS-full', None),
+                                    ('HTTPS', socks.TLSSessionCache())):
+            socks.set_proxy_tls_session_cache(session_cache)
+            try:
+                def connect():
+                    sock = socks.socksocket()
+                    sock.set_proxy(*named, tls=context)
+                    sock.connect(source.address)
+                    return sock
+
+                result = bench_connects(connect, duration)
+                if session_cache:
+                    result['resumed'] = session_cache.resumed / float(
+                        session_cache.resumed + session_cache.full)
+                results['socksocket.connect/' + name] = result
+            finally:
+                socks.set_proxy_tls_session_cache(cache)
+
+    forwarder = Forwarder(source.address)
+
+    def connect():
+        return socket.create_connection(forwarder.address)
+
+    has_splice = socks._HAS_SPLICE
+    try:
+        for splice in (True, False):
+            if splice and not has_splice:
+                continue
+            socks._HAS_SPLICE = splice
+            key = 'relay.throughput/' + ('splice' if splice else 'copy')
+            results[key] = bench_throughput(connect, size)
+    finally:
+        socks._HAS_SPLICE = has_splice
+
+    if sys.version_info >= (3, 7):
+        for name, upstream in (('direct', None), ('SOCKS5-upstream', proxy)):
+            server = SOCKSServerThread(upstream)
+
+            def connect(port=server.port):
+                sock = socks.socksocket()
+                sock.set_proxy(socks.SOCKS5, HOST, port)
+                sock.connect(source.address)
+                return sock
+
+            results['socksserver.connect/' + name] = bench_connects(
+                connect, duration)
+            results['socksserver.throughput/' + name] = bench_throughput(
+                connect, size)
+            server.stop()
+
+    http.shutdown()
+    return {'pysocks': socks.__version__,
+            'python': sys.version.split()[0],
+            'platform': sys.platform,
+            'rtt_ms': rtt * 1000,
+            'duration': duration,
+            'results': results}
+
+
+def compare(report, baseline, tolerance):
+    """Prints the change of every metric against baseline. Returns whether
+    any of them got worse by more than tolerance."""
+    regressed = False
+    for name in sorted(report['results']):
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        for metric, value in sorted(report['results'][name].items()):
+            if not old.get(metric):
+                continue
+            change = value / old[metric] - 1
+            # Latencies should go down, everything else up
+            worse = change > tolerance if metric.endswith('_ms') \
+                else change < -tolerance
+            regressed = regressed or worse
+            print('%-40s %-18s %+7.1f%%%s' % (name, metric, change * 100,
+                                             '  REGRESSION' if worse else ''))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='PySocks performance benchmarks')
+    parser.add_argument('--rtt', type=float, default=0.0,
+                        help='round trip time to inject into handshakes, ms')
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='seconds to run each benchmark for')
+    parser.add_argument('--size', type=int, default=32,
+                        help='MiB to transfer for the throughput benchmarks')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='results saved earlier')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='change to report as a regression (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    report = run(args.rtt / 1000.0, args.duration, args.size * 2 ** 20)
+    for name, metrics in sorted(report['results'].items()):
+        print('%-40s %s' % (name, '  '.join(
+            '%s=%.2f' % item for item in sorted(metrics.items()))))
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        if compare(report, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,12 +2,19 @@
 The 3proxy binary is located in test/bin/3proxy
 """
 from unittest import TestCase
+import errno
+import json
+import select
 import socket
+import struct
 import os
 import signal
+import sys
+import tempfile
 from subprocess import Popen
 from threading import Thread
 import threading
+import time
 
 try:
     import urllib2 # py2
@@ -165,6 +172,368 @@ class PySocksTestCase(TestCase):
         data = sock.recv(2048)
         self.assert_proxy_response(data, content, address)
 
+    def test_socks5_proxy_object(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        sock = socks.socksocket()
+        sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT,
+                       username='user')
+        proxy = sock.proxy
+        self.assertIsInstance(proxy, socks.Proxy)
+        self.assertEqual((socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT,
+                          True, b'user', None), proxy)
+        # Shared by every socket set up with the same arguments
+        other = socks.create_connection(address, 5, None, *proxy)
+        other.close()
+        self.assertIs(proxy, other.proxy)
+        other = socks.socksocket()
+        other.set_proxy(proxy)
+        self.assertIs(proxy, other.proxy)
+        other.close()
+        sock.connect(address)
+        sock.sendall(self.build_http_request(*address))
+        data = sock.recv(2048)
+        sock.close()
+        self.assert_proxy_response(data, content, address)
+
+    def test_socks5_pipelined_proxy(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        sock = socks.socksocket()
+        sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT,
+                       pipeline=True)
+        sock.connect(address)
+        sock.sendall(self.build_http_request(*address))
+        data = sock.recv(2048)
+        self.assert_proxy_response(data, content, address)
+
+    def test_socks5_create_connection(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        # 'localhost' may resolve to several addresses, which are then
+        # raced against each other
+        sock = socks.create_connection(address, 5, None, socks.SOCKS5,
+                                       'localhost', SOCKS5_PROXY_PORT,
+                                       happy_eyeballs_delay=0.05)
+        sock.sendall(self.build_http_request(*address))
+        data = sock.recv(2048)
+        self.assert_proxy_response(data, content, address)
+
+    def test_socks5_create_connection_negotiation_fallback(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        # Takes the connection, then closes it without a reply
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(1)
+        broken = server.getsockname()
+
+        def run():
+            conn, _ = server.accept()
+            conn.close()
+        th = Thread(target=run)
+        th.start()
+        getaddrinfo = socks._proxy_getaddrinfo
+        # The broken address connects first and wins the race
+        socks._proxy_getaddrinfo = lambda *args: (
+            getaddrinfo(*broken) + getaddrinfo(PROXY_HOST_IP,
+                                               SOCKS5_PROXY_PORT))
+        events = []
+        socks.set_negotiation_hook(
+            lambda phase, start, end, proxy, dest, error: events.append(
+                (phase, error is None)))
+        try:
+            sock = socks.create_connection(address, 5, None, socks.SOCKS5,
+                                           'proxy.example', 1080,
+                                           happy_eyeballs_delay=5)
+        finally:
+            socks.set_negotiation_hook(None)
+            socks._proxy_getaddrinfo = getaddrinfo
+            th.join()
+            server.close()
+        sock.sendall(self.build_http_request(*address))
+        data = sock.recv(2048)
+        sock.close()
+        self.assert_proxy_response(data, content, address)
+        self.assertEqual([('connect', True), ('method', False),
+                          ('connect', True), ('method', True),
+                          ('request', True)], events)
+
+    def test_socks5_create_connections(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        refused = (TEST_SERVER_HOST_IP, 1)
+        results = list(socks.create_connections(
+            [address] * 3 + [refused], 5, None, socks.SOCKS5, PROXY_HOST_IP,
+            SOCKS5_PROXY_PORT, concurrency=2))
+        self.assertEqual(4, len(results))
+        for dest, sock, error in results:
+            if dest == refused:
+                self.assertIsNone(sock)
+                self.assertIsInstance(error, socks.SOCKS5Error)
+                continue
+            self.assertIsNone(error)
+            sock.sendall(self.build_http_request(*address))
+            data = sock.recv(2048)
+            sock.close()
+            self.assert_proxy_response(data, content, address)
+
+    def test_create_connections_options(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST_IP, TEST_SERVER_PORT)
+        before = socks.get_fast_open_stats()
+        pool = socks.ProxyPool([(socks.SOCKS5, PROXY_HOST_IP,
+                                 SOCKS5_PROXY_PORT)])
+        results = list(socks.create_connections(
+            [address] * 3, 5, None, pool, proxy_fast_open=True))
+        for dest, sock, error in results:
+            self.assertIsNone(error)
+            sock.sendall(self.build_http_request(*address))
+            data = sock.recv(2048)
+            sock.close()
+            self.assert_proxy_response(data, content, address)
+        after = socks.get_fast_open_stats()
+        if socks._TCP_FASTOPEN_CONNECT is not None:
+            self.assertEqual(before['attempted'] + 3, after['attempted'])
+        self.assertEqual(0, pool.stats()[0]['in_flight'])
+
+        # Without a proxy, the family is the destination's
+        server = socket.socket(socket.AF_INET6)
+        server.bind(('::1', 0))
+        server.listen(1)
+        ipv6 = server.getsockname()[:2]
+        try:
+            [(dest, sock, error)] = socks.create_connections([ipv6], 5)
+            self.assertIsNone(error)
+            self.assertEqual(socket.AF_INET6, sock.family)
+            sock.close()
+        finally:
+            server.close()
+
+    def test_proxy_chain(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        sock = socks.socksocket()
+        socks5 = (socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+        http = (socks.HTTP, PROXY_HOST_IP, HTTP_PROXY_PORT)
+        sock.set_proxy_chain([socks5, http, socks5], pipeline=True)
+        sock.connect(address)
+        self.assertEqual(3, len(sock.proxy_chain_times))
+        self.assertEqual(PROXY_HOST_IP, sock.proxy[1])
+        sock.sendall(self.build_http_request(*address))
+        data = sock.recv(2048)
+        self.assert_proxy_response(data, content, address)
+
+    def test_socks5_nonblocking_connect(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        sock = socks.socksocket()
+        sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+        sock.setblocking(False)
+        self.assertEqual(errno.EINPROGRESS, sock.connect_ex(address))
+        while not sock.continue_negotiation():
+            self.assertTrue(sock.wants_read or sock.wants_write)
+            select.select([sock] if sock.wants_read else [],
+                          [sock] if sock.wants_write else [], [], 5)
+        self.assertEqual(address, sock.get_peername())
+        sock.setblocking(True)
+        sock.sendall(self.build_http_request(*address))
+        data = sock.recv(2048)
+        self.assert_proxy_response(data, content, address)
+
+    def test_socks5_udp_sendmany(self):
+        echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        echo.bind((TEST_SERVER_HOST_IP, 0))
+        address = echo.getsockname()
+
+        def echo_thread():
+            for _ in range(4):
+                data, peer = echo.recvfrom(2048)
+                echo.sendto(data, peer)
+        th = Thread(target=echo_thread)
+        th.daemon = True
+        th.start()
+
+        sock = socks.socksocket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+        sock.settimeout(5)
+        datagrams = [(b'a1', address), (b'a2', address), (b'b', address),
+                     (b'ccc', address)]
+        self.assertEqual(4, sock.sendmany(datagrams))
+        received = []
+        while len(received) < 4:
+            received.extend(sock.recvmany(4 - len(received)))
+        self.assertEqual(sorted(datagrams), sorted(received))
+        sock.close()
+        echo.close()
+
+    def test_socks5_udp_header_cache(self):
+        echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        echo.bind((TEST_SERVER_HOST_IP, 0))
+        echo.settimeout(5)
+        address = echo.getsockname()
+        header = (b'\x00\x00\x00\x01' + socket.inet_aton(address[0])
+                  + struct.pack('>H', address[1]))
+
+        sock = socks.socksocket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+        sock.settimeout(5)
+        try:
+            for payload in (b'first', b'second'):
+                self.assertEqual(len(payload), sock.sendto(payload, address))
+                self.assertEqual(payload, echo.recvfrom(2048)[0])
+            # Encoded once for the destination
+            self.assertEqual({address: header}, sock._udp_headers)
+        finally:
+            sock.close()
+            echo.close()
+
+    def test_socks5_udp_recv_into(self):
+        echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        echo.bind((TEST_SERVER_HOST_IP, 0))
+        echo.settimeout(5)
+        address = echo.getsockname()
+
+        def echo_thread():
+            for _ in range(2):
+                data, peer = echo.recvfrom(2048)
+                echo.sendto(data, peer)
+        th = Thread(target=echo_thread)
+        th.start()
+
+        sock = socks.socksocket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+        sock.settimeout(5)
+        buffer = bytearray(16)
+        try:
+            # The relay's header is stripped
+            sock.sendto(b'first', address)
+            self.assertEqual((5, address), sock.recvfrom_into(buffer))
+            self.assertEqual(b'first', bytes(buffer[:5]))
+            # Truncated to nbytes, like any datagram
+            sock.sendto(b'second', address)
+            self.assertEqual(3, sock.recv_into(buffer, 3))
+            self.assertEqual(b'sec', bytes(buffer[:3]))
+            # Like the stdlib, without waiting for a datagram
+            self.assertRaises(ValueError, sock.recv_into, buffer, 17)
+            self.assertRaises(ValueError, sock.recvfrom_into, buffer, 17)
+        finally:
+            th.join()
+            sock.close()
+            echo.close()
+
+    def test_handshake_reply_with_tunnel_data(self):
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(3)
+        server.settimeout(5)
+        proxy_types = (socks.SOCKS4, socks.SOCKS5, socks.HTTP)
+        replies = {
+            socks.SOCKS4: b'\x00\x5a' + b'\x00' * 6,
+            # Bound to a name, so the reply's length depends on it
+            socks.SOCKS5: b'\x05\x00\x00\x03\x0bproxy.local\x00\x50',
+            socks.HTTP: b'HTTP/1.1 200 Connection established\r\n\r\n',
+        }
+
+        def serve():
+            # Each reply arrives together with the first tunnel bytes
+            for proxy_type in proxy_types:
+                conn, _ = server.accept()
+                conn.settimeout(5)
+                if proxy_type == socks.SOCKS5:
+                    conn.recv(3)
+                    conn.sendall(b'\x05\x00')
+                conn.recv(1024)
+                conn.sendall(replies[proxy_type] + b'tunnel')
+                conn.close()
+
+        th = Thread(target=serve)
+        th.start()
+        try:
+            for proxy_type in proxy_types:
+                sock = socks.socksocket()
+                sock.set_proxy(proxy_type, *server.getsockname())
+                sock.settimeout(5)
+                sock.connect(('example.com', 80))
+                # None of the tunnel's bytes went to the handshake
+                self.assertEqual(b'tunnel', sock.recv(6))
+                sock.close()
+        finally:
+            th.join()
+            server.close()
+
+    def test_proxy_pool(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        pool = socks.ProxyPool([(socks.SOCKS5, PROXY_HOST_IP, 1),
+                                (socks.SOCKS5, PROXY_HOST_IP,
+                                 SOCKS5_PROXY_PORT),
+                                (socks.HTTP, PROXY_HOST_IP, HTTP_PROXY_PORT)])
+        sock = socks.socksocket()
+        sock.set_proxy(pool)
+        self.assertRaises(socks.ProxyConnectionError, sock.connect, address)
+
+        # The failed proxy is avoided from now on
+        for _ in range(3):
+            sock = socks.create_connection(address, proxy_type=pool)
+            sock.sendall(self.build_http_request(*address))
+            data = sock.recv(2048)
+            self.assert_proxy_response(data, content, address)
+            sock.close()
+        stats = pool.stats()
+        self.assertEqual(1, stats[0]['failures'])
+        self.assertIsNotNone(stats[1]['latency'])
+        self.assertEqual([0, 0, 0], [s['in_flight'] for s in stats])
+
+    def test_proxy_pool_destination_refused(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        pool = socks.ProxyPool([(socks.SOCKS5, PROXY_HOST_IP, 1),
+                                (socks.SOCKS5, PROXY_HOST_IP,
+                                 SOCKS5_PROXY_PORT)])
+        self.assertRaises(socks.ProxyConnectionError,
+                          socks.create_connection, address, proxy_type=pool)
+
+        # The proxy replying that the destination refused isn't its failure
+        for _ in range(3):
+            self.assertRaises(socks.SOCKS5Error, socks.create_connection,
+                              (TEST_SERVER_HOST_IP, 1), proxy_type=pool)
+        sock = socks.create_connection(address, proxy_type=pool)
+        sock.sendall(self.build_http_request(*address))
+        data = sock.recv(2048)
+        self.assert_proxy_response(data, content, address)
+        sock.close()
+        stats = pool.stats()
+        self.assertEqual([1, 0], [s['failures'] for s in stats])
+
+    def test_socks5_negotiation_hook(self):
+        self.test_server.response['data'] = b'zzz'
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        proxy = (socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+        events = []
+
+        def hook(phase, start, end, proxy, dest, error):
+            self.assertLessEqual(start, end)
+            events.append((phase, proxy, dest, error))
+        sock = socks.socksocket()
+        sock.negotiation_hook = hook
+        sock.set_proxy(*proxy)
+        sock.connect(address)
+        sock.close()
+        self.assertEqual([('connect', proxy, address, None),
+                          ('method', proxy, address, None),
+                          ('request', proxy, address, None)], events)
+
     # 3-1/13
     def test_urllib2_http_handler(self):
         content = b'zzz'
@@ -210,6 +579,159 @@ class PySocksTestCase(TestCase):
         self.assertEqual(200, res.getcode())
         self.assertEqual(content, body)
 
+    @pytest.mark.skipif(sys.version_info < (3, 0),
+                        reason="connection pooling requires Python 3")
+    def test_urllib2_socks5_handler_pool(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        pool = sockshandler.SocksiPyConnectionPool()
+        opener = urllib2.build_opener(sockshandler.SocksiPyHandler(
+            socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT, pool=pool))
+        for _ in range(2):
+            res = opener.open(self.test_server.get_url())
+            body = res.read()
+            self.assertEqual(200, res.getcode())
+            self.assertEqual(content, body)
+        pool.clear()
+
+    @pytest.mark.skipif(sys.version_info < (3, 0),
+                        reason="connection pooling requires Python 3")
+    def test_urllib2_socks5_handler_pool_retry(self):
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(4)
+        server.settimeout(5)
+        url = 'http://%s:%d/' % server.getsockname()
+        ok = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+        # What the server does with each request, per connection
+        scripts = (('reply', 'drop'), ('reply', 'drop'), ('reply', 'stall'))
+        methods = []
+        stalled = threading.Event()
+
+        def serve():
+            for script in scripts:
+                conn, _ = server.accept()
+                conn.settimeout(5)
+                for action in script:
+                    methods.append(conn.recv(4096).split(b' ')[0])
+                    if action == 'reply':
+                        conn.sendall(ok)
+                    elif action == 'stall':
+                        stalled.wait(5)
+                conn.close()
+
+        th = Thread(target=serve)
+        th.start()
+        pool = sockshandler.SocksiPyConnectionPool()
+        opener = urllib2.build_opener(sockshandler.SocksiPyHandler(
+            socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT, pool=pool))
+        try:
+            self.assertEqual(b'ok', opener.open(url).read())
+            # Dropped after the kept-alive connection was reused: sent again
+            self.assertEqual(b'ok', opener.open(url).read())
+            # But not a POST, which the server might have handled
+            self.assertRaises((urllib2.URLError, socket.error),
+                              opener.open, url, b'data')
+            self.assertEqual(b'ok', opener.open(url).read())
+            # Nor a request which timed out
+            self.assertRaises(urllib2.URLError, opener.open, url, None, 0.5)
+            stalled.set()
+            th.join()
+            self.assertEqual([b'GET', b'GET', b'GET', b'POST', b'GET',
+                              b'GET'], methods)
+            self.assertEqual([], select.select([server], [], [], 0.2)[0])
+        finally:
+            stalled.set()
+            th.join()
+            pool.clear()
+            server.close()
+
+    @pytest.mark.skipif(sys.version_info < (3, 6),
+                        reason="requires ssl.SSLSession")
+    def test_urllib2_https_handler_tls_session(self):
+        import ssl
+        certfile = os.path.join(os.path.dirname(__file__), 'keycert.pem')
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(certfile)
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(2)
+        server.settimeout(5)
+
+        def serve():
+            for _ in range(2):
+                conn, _ = server.accept()
+                conn = server_context.wrap_socket(conn, server_side=True)
+                conn.settimeout(5)
+                reader = conn.makefile('rb')
+                while reader.readline() not in (b'\r\n', b''):
+                    pass
+                conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n'
+                             b'Connection: close\r\n\r\nzzz')
+                reader.close()
+                conn.close()
+
+        th = Thread(target=serve)
+        th.start()
+        handler = sockshandler.SocksiPyHandler(
+            socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT,
+            context=ssl.create_default_context(cafile=certfile))
+        opener = urllib2.build_opener(handler)
+        url = 'https://localhost:%d/' % server.getsockname()[1]
+        try:
+            for _ in range(2):
+                self.assertEqual(b'zzz', opener.open(url, timeout=5).read())
+        finally:
+            th.join()
+            server.close()
+        self.assertEqual(1, handler.tls_sessions.full)
+        self.assertEqual(1, handler.tls_sessions.resumed)
+
+    @pytest.mark.skipif(sys.version_info < (3, 5),
+                        reason="TLS layers need Python 3.5+")
+    def test_start_tls_pending(self):
+        import ssl
+        certfile = os.path.join(os.path.dirname(__file__), 'keycert.pem')
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(certfile)
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(1)
+        server.settimeout(5)
+        done = threading.Event()
+
+        def serve():
+            conn, _ = server.accept()
+            conn = server_context.wrap_socket(conn, server_side=True)
+            # Two TLS records, received together
+            conn.sendall(b'a' * 10)
+            conn.sendall(b'b' * 10)
+            done.wait(5)
+            conn.close()
+
+        th = Thread(target=serve)
+        th.start()
+        sock = socks.socksocket()
+        sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+        sock.settimeout(5)
+        try:
+            sock.connect(server.getsockname())
+            sock.start_tls(ssl.create_default_context(cafile=certfile),
+                           server_hostname='localhost')
+            time.sleep(0.2)
+            self.assertEqual(b'a' * 10, sock.recv(10))
+            # Decrypted in userspace, so the socket isn't readable
+            self.assertEqual(10, sock.pending())
+            self.assertEqual([], select.select([sock], [], [], 0)[0])
+            sock.setblocking(False)
+            self.assertEqual(b'b' * 10, sock.recv(10))
+            self.assertEqual(0, sock.pending())
+        finally:
+            done.set()
+            th.join()
+            sock.close()
+            server.close()
+
     # 4/13
     def test_http_ip_proxy(self):
         content = b'zzz'
@@ -246,6 +768,213 @@ class PySocksTestCase(TestCase):
         data = sock.recv(2048)
         self.assert_proxy_response(data, content, address)
 
+    def test_socks5_fast_open(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST_IP, TEST_SERVER_PORT)
+        before = socks.get_fast_open_stats()
+        sock = socks.socksocket()
+        sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT,
+                       fast_open=True)
+        sock.connect(address)
+        sock.sendall(self.build_http_request(*address))
+        data = sock.recv(2048)
+        sock.close()
+        self.assert_proxy_response(data, content, address)
+        after = socks.get_fast_open_stats()
+        if socks._TCP_FASTOPEN_CONNECT is not None:
+            self.assertEqual(before['attempted'] + 1, after['attempted'])
+        self.assertEqual(before['used'] + sock.fast_open_used, after['used'])
+
+    def test_socks5_fast_open_rejected(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST_IP, TEST_SERVER_PORT)
+        proxy = (socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+        cache = socks.CapabilityCache()
+        # As learnt when the proxy didn't take the data in a SYN
+        cache.set(proxy, 'fast_open', False)
+        socks.set_capability_cache(cache)
+        before = socks.get_fast_open_stats()
+        try:
+            sock = socks.socksocket()
+            sock.set_proxy(*proxy, fast_open=True)
+            sock.connect(address)
+            sock.sendall(self.build_http_request(*address))
+            data = sock.recv(2048)
+            sock.close()
+        finally:
+            socks.set_capability_cache(socks.CapabilityCache())
+        self.assert_proxy_response(data, content, address)
+        self.assertEqual(before, socks.get_fast_open_stats())
+
+    def test_socks5_fast_open_several_addresses(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST_IP, TEST_SERVER_PORT)
+        getaddrinfo = socks._proxy_getaddrinfo
+        # As when the proxy's name has an IPv4 and an IPv6 address
+        socks._proxy_getaddrinfo = lambda *args: getaddrinfo(*args) * 2
+        before = socks.get_fast_open_stats()
+        try:
+            sock = socks.create_connection(
+                address, proxy_type=socks.SOCKS5, proxy_addr=PROXY_HOST_IP,
+                proxy_port=SOCKS5_PROXY_PORT, proxy_fast_open=True)
+        finally:
+            socks._proxy_getaddrinfo = getaddrinfo
+        sock.sendall(self.build_http_request(*address))
+        data = sock.recv(2048)
+        sock.close()
+        self.assert_proxy_response(data, content, address)
+        after = socks.get_fast_open_stats()
+        if socks._TCP_FASTOPEN_CONNECT is not None:
+            # Not raced, which would have left Fast Open out
+            self.assertEqual(before['attempted'] + 1, after['attempted'])
+
+    def test_socks5_standby_pool(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST_IP, TEST_SERVER_PORT)
+        pool = socks.StandbyPool(size=1)
+        pool.warm(socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+        socks.set_standby_pool(pool)
+        try:
+            for _ in range(50):
+                if pool.stats()[0]['ready']:
+                    break
+                time.sleep(0.1)
+            sock = socks.socksocket()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+            sock.connect(address)
+            # Set again on the connection taken from the pool
+            options = [sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY),
+                       sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)]
+            sock.sendall(self.build_http_request(*address))
+            data = sock.recv(2048)
+            sock.close()
+        finally:
+            socks.set_standby_pool(None)
+            pool.close()
+        self.assertTrue(sock.standby_used)
+        self.assertTrue(all(options))
+        self.assert_proxy_response(data, content, address)
+
+    def test_socks5_standby_pool_closed_by_proxy(self):
+        # Closes the first connection it gets a request on, as if it timed
+        # out just after the pool checked it
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(5)
+        requests = []
+
+        def handle(conn):
+            try:
+                conn.recv(3)
+                conn.sendall(b'\x05\x00')
+                if not conn.recv(1024):
+                    return
+                requests.append(conn)
+                if len(requests) > 1:
+                    conn.sendall(b'\x05\x00\x00\x01\x7f\x00\x00\x01\x00\x50'
+                                 b'tunnel')
+            finally:
+                conn.close()
+
+        def run():
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.error:
+                    return
+                Thread(target=handle, args=(conn,)).start()
+        th = Thread(target=run)
+        th.daemon = True
+        th.start()
+        pool = socks.StandbyPool(size=1)
+        pool.warm(socks.SOCKS5, *server.getsockname())
+        socks.set_standby_pool(pool)
+        try:
+            for _ in range(50):
+                if pool.stats()[0]['ready']:
+                    break
+                time.sleep(0.1)
+            sock = socks.socksocket()
+            sock.set_proxy(socks.SOCKS5, *server.getsockname())
+            sock.connect(('example.com', 80))
+            data = sock.recv(6)
+            sock.close()
+        finally:
+            socks.set_standby_pool(None)
+            pool.close()
+            server.close()
+        # Connected again, greeting included
+        self.assertFalse(sock.standby_used)
+        self.assertEqual(2, len(requests))
+        self.assertEqual(b'tunnel', data)
+
+    def test_socks5_local_dns_cache(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        cache = socks.DNSCache()
+        socks.set_dns_cache(cache)
+        try:
+            for _ in range(2):
+                sock = socks.socksocket()
+                sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP,
+                               SOCKS5_PROXY_PORT, rdns=False)
+                sock.connect(address)
+                sock.sendall(self.build_http_request(*address))
+                data = sock.recv(2048)
+                sock.close()
+                self.assert_proxy_response(data, content, address)
+        finally:
+            socks.set_dns_cache(None)
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(1, cache.hits)
+
+    def test_socks5_proxy_address_cache(self):
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        # Refresh on every hit
+        cache = socks.ProxyAddressCache(refresh=0.0)
+        socks.set_proxy_address_cache(cache)
+        try:
+            for _ in range(2):
+                sock = socks.socksocket()
+                sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP,
+                               SOCKS5_PROXY_PORT)
+                sock.connect(address)
+                sock.sendall(self.build_http_request(*address))
+                data = sock.recv(2048)
+                sock.close()
+                self.assert_proxy_response(data, content, address)
+            self.assertEqual(1, cache.misses)
+            self.assertEqual(1, cache.hits)
+            self.assertEqual(1, cache.refreshes)
+
+            # Failing to connect forgets the address
+            for _ in range(2):
+                sock = socks.socksocket()
+                sock.set_proxy(socks.SOCKS5, PROXY_HOST_IP, 1)
+                self.assertRaises(socks.ProxyConnectionError, sock.connect,
+                                  address)
+            self.assertEqual(3, cache.misses)
+        finally:
+            socks.set_proxy_address_cache(socks.ProxyAddressCache())
+
+        # By default, nothing is resolved in the background
+        cache = socks.ProxyAddressCache(ttl=0.1)
+        for _ in range(2):
+            cache.getaddrinfo(PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+        time.sleep(0.1)
+        cache.getaddrinfo(PROXY_HOST_IP, SOCKS5_PROXY_PORT)
+        self.assertEqual(0, cache.refreshes)
+        self.assertEqual(2, cache.misses)
+
     # 7/13
     def test_socks5_proxy_connect_timeout(self):
         """Test timeout during connecting to the proxy server"""
@@ -407,3 +1136,560 @@ class PySocksTestCase(TestCase):
         # (addr, scopeid, flowinfo, port)
         ipv6_tuple = ("::1", 1234, 0, 0)
         self.assertRaises(socket.error, sock.connect, ipv6_tuple)
+
+    def open_connection_request(self, proxy_type, proxy_port, rdns=True):
+        import asyncio
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        loop = asyncio.new_event_loop()
+        try:
+            reader, writer = loop.run_until_complete(socks.open_connection(
+                address, proxy_type, PROXY_HOST_IP, proxy_port, rdns))
+            writer.write(self.build_http_request(*address))
+            data = loop.run_until_complete(reader.read(2048))
+            writer.close()
+        finally:
+            loop.close()
+        self.assert_proxy_response(data, content, address)
+
+    @pytest.mark.skipif(sys.version_info < (3, 7),
+                        reason="asyncio support requires Python 3.7+")
+    def test_http_open_connection(self):
+        self.open_connection_request(socks.HTTP, HTTP_PROXY_PORT)
+
+    @pytest.mark.skipif(sys.version_info < (3, 7),
+                        reason="asyncio support requires Python 3.7+")
+    def test_socks4_open_connection(self):
+        self.open_connection_request(socks.SOCKS4, SOCKS4_PROXY_PORT)
+
+    @pytest.mark.skipif(sys.version_info < (3, 7),
+                        reason="asyncio support requires Python 3.7+")
+    def test_socks5_open_connection(self):
+        self.open_connection_request(socks.SOCKS5, SOCKS5_PROXY_PORT)
+
+    @pytest.mark.skipif(sys.version_info < (3, 7),
+                        reason="asyncio support requires Python 3.7+")
+    def test_open_connection_local_dns(self):
+        lookups = socks._gethostbyname, socks._getaddrinfo
+
+        def no_blocking(lookup):
+            def check(host, *args):
+                if host == TEST_SERVER_HOST:
+                    raise AssertionError("Blocking lookup on the event loop")
+                return lookup(host, *args)
+            return check
+        socks._gethostbyname = no_blocking(lookups[0])
+        socks._getaddrinfo = no_blocking(lookups[1])
+        try:
+            for proxy_type, proxy_port in ((socks.SOCKS4, SOCKS4_PROXY_PORT),
+                                           (socks.SOCKS5, SOCKS5_PROXY_PORT),
+                                           (socks.HTTP, HTTP_PROXY_PORT)):
+                self.open_connection_request(proxy_type, proxy_port,
+                                             rdns=False)
+        finally:
+            socks._gethostbyname, socks._getaddrinfo = lookups
+
+    @pytest.mark.skipif(sys.version_info < (3, 7),
+                        reason="asyncio support requires Python 3.7+")
+    def test_http_open_connection_local_dns_request(self):
+        import asyncio
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(2)
+        server.settimeout(5)
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        requests = []
+
+        def serve():
+            for _ in range(2):
+                conn, _ = server.accept()
+                conn.settimeout(5)
+                requests.append(conn.recv(4096))
+                conn.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+                conn.close()
+
+        th = Thread(target=serve)
+        th.start()
+        loop = asyncio.new_event_loop()
+        try:
+            sock = socks.socksocket()
+            sock.set_proxy(socks.HTTP, *server.getsockname(), rdns=False)
+            sock.settimeout(5)
+            sock.connect(address)
+            sock.close()
+            _, writer = loop.run_until_complete(socks.open_connection(
+                address, socks.HTTP, *server.getsockname(),
+                proxy_rdns=False))
+            writer.close()
+        finally:
+            loop.close()
+            th.join()
+            server.close()
+        # The same request: to the address, with the name in Host
+        self.assertEqual(requests[0], requests[1])
+        self.assertIn(b'\r\nHost: %s\r\n' % TEST_SERVER_HOST.encode(),
+                      requests[1])
+
+    @pytest.mark.skipif(sys.version_info < (3, 7),
+                        reason="asyncio support requires Python 3.7+")
+    def test_socksserver(self):
+        import asyncio
+        import socksserver
+        content = b'zzz'
+        self.test_server.response['data'] = content
+        address = (TEST_SERVER_HOST, TEST_SERVER_PORT)
+        server = socksserver.SOCKSServer(
+            upstream=(socks.SOCKS5, PROXY_HOST_IP, SOCKS5_PROXY_PORT))
+        loop = asyncio.new_event_loop()
+        listener = loop.run_until_complete(server.start('127.0.0.1', 0))
+        port = listener.sockets[0].getsockname()[1]
+        th = Thread(target=loop.run_forever)
+        th.daemon = True
+        th.start()
+        try:
+            for proxy_type in (socks.SOCKS4, socks.SOCKS5):
+                sock = socks.socksocket()
+                sock.set_proxy(proxy_type, '127.0.0.1', port)
+                sock.settimeout(5)
+                sock.connect(address)
+                sock.sendall(self.build_http_request(*address))
+                data = sock.recv(2048)
+                sock.close()
+                self.assert_proxy_response(data, content, address)
+        finally:
+            loop.call_soon_threadsafe(listener.close)
+            asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            th.join()
+            loop.close()
+
+    @pytest.mark.skipif(sys.version_info < (3, 7),
+                        reason="asyncio support requires Python 3.7+")
+    def test_socksserver_udp_upstream(self):
+        import asyncio
+        import socksserver
+        # Stand-in upstream SOCKS5 proxy whose relay echoes datagrams
+        upstream = socket.socket()
+        upstream.bind((TEST_SERVER_HOST_IP, 0))
+        upstream.listen(1)
+        upstream.settimeout(5)
+        upstream_relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        upstream_relay.bind((TEST_SERVER_HOST_IP, 0))
+        upstream_relay.settimeout(5)
+        received, injected = threading.Event(), threading.Event()
+        associated = []
+
+        def upstream_thread():
+            conn, _ = upstream.accept()
+            conn.settimeout(5)
+            conn.recv(3)
+            conn.sendall(b'\x05\x00')
+            # The port comes last, whatever the address type
+            associated.append(struct.unpack('>H', conn.recv(262)[-2:])[0])
+            conn.sendall(b'\x05\x00\x00\x01' + socket.inet_aton(
+                TEST_SERVER_HOST_IP) + struct.pack(
+                    '>H', upstream_relay.getsockname()[1]))
+            data, peer = upstream_relay.recvfrom(2048)
+            associated.append(peer[1])
+            received.set()
+            injected.wait(5)
+            upstream_relay.sendto(data, peer)
+            conn.recv(1)  # Until the association ends
+            conn.close()
+        th = Thread(target=upstream_thread)
+        th.start()
+
+        server = socksserver.SOCKSServer(
+            upstream=(socks.SOCKS5, TEST_SERVER_HOST_IP,
+                      upstream.getsockname()[1]))
+        loop = asyncio.new_event_loop()
+        listener = loop.run_until_complete(server.start('127.0.0.1', 0))
+        port = listener.sockets[0].getsockname()[1]
+        loop_th = Thread(target=loop.run_forever)
+        loop_th.daemon = True
+        loop_th.start()
+        sock = socks.socksocket(socket.AF_INET, socket.SOCK_DGRAM)
+        stranger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.set_proxy(socks.SOCKS5, '127.0.0.1', port)
+            sock.settimeout(5)
+            address = ('127.0.0.1', 9)
+            sock.sendto(b'ping', address)
+            self.assertTrue(received.wait(5))
+            # Datagrams from anywhere but the upstream's relay are dropped
+            relay = socks._orig_socket.getpeername(sock)
+            stranger.sendto(b'\x00\x00\x00\x01' + socket.inet_aton(
+                '127.0.0.1') + struct.pack('>H', 9) + b'evil', relay)
+            time.sleep(0.1)
+            injected.set()
+            self.assertEqual((b'ping', address), sock.recvfrom(2048))
+            # The upstream was told the port of the server's relay, not its
+            # own port
+            self.assertEqual(relay[1], associated[0])
+            self.assertEqual(relay[1], associated[1])
+            self.assertNotEqual(upstream.getsockname()[1], associated[0])
+        finally:
+            injected.set()
+            sock.close()
+            stranger.close()
+            th.join()
+            upstream.close()
+            upstream_relay.close()
+            loop.call_soon_threadsafe(listener.close)
+            asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            loop_th.join()
+            loop.close()
+
+    def relay_roundtrip(self, run):
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(2)
+        pairs = []
+        for _ in range(2):
+            client = socket.create_connection(server.getsockname())
+            pairs.append((client, server.accept()[0]))
+        server.close()
+        (a, a_remote), (b, b_remote) = pairs
+        result = []
+        th = Thread(target=lambda: result.append(run(a_remote, b_remote)))
+        th.start()
+        try:
+            payload = os.urandom(1024 * 1024)
+            writer = Thread(target=lambda: (a.sendall(payload),
+                                            a.shutdown(socket.SHUT_WR)))
+            writer.start()
+            data = b''
+            while True:
+                chunk = b.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            writer.join()
+            self.assertEqual(payload, data)
+            b.sendall(b'back')
+            b.shutdown(socket.SHUT_WR)
+            self.assertEqual(b'back', a.recv(4))
+            self.assertEqual(b'', a.recv(4))
+            th.join()
+            self.assertEqual([(len(payload), 4)], result)
+        finally:
+            for sock in (a, a_remote, b, b_remote):
+                sock.close()
+
+    def test_relay(self):
+        self.relay_roundtrip(socks.relay)
+
+    @pytest.mark.skipif(sys.version_info < (3, 7),
+                        reason="asyncio support requires Python 3.7+")
+    def test_relay_asyncio(self):
+        import asyncio
+        import asyncsocks
+
+        def run(sock_a, sock_b):
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(
+                    asyncsocks.relay(sock_a, sock_b))
+            finally:
+                loop.close()
+        self.relay_roundtrip(run)
+
+    def test_http_proxy_auth_retry(self):
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(2)
+        requests = []
+
+        def read_request(conn):
+            data = b''
+            while not data.endswith(b'\r\n\r\n'):
+                data += conn.recv(1)
+            requests.append(data)
+
+        def serve():
+            conn, _ = server.accept()
+            read_request(conn)
+            conn.sendall(b'HTTP/1.1 407 Proxy Authentication Required\r\n'
+                         b'Proxy-Authenticate: Basic realm="test"\r\n'
+                         b'Content-Length: 6\r\n\r\ndenied')
+            read_request(conn)
+            conn.sendall(b'HTTP/1.1 200 Connection established\r\n'
+                         b'Via: 1.1 test\r\n\r\ntunnel')
+            conn.close()
+
+        th = Thread(target=serve)
+        th.start()
+        sock = socks.socksocket()
+        try:
+            sock.set_proxy(socks.HTTP, *server.getsockname(), username='user')
+            sock.settimeout(5)
+            sock.connect(('example.com', 80))
+            self.assertEqual(b'tunnel', sock.recv(6))
+        finally:
+            sock.close()
+            th.join()
+            server.close()
+        self.assertEqual(2, len(requests))
+        self.assertNotIn(b'Proxy-Authorization', requests[0])
+        self.assertIn(b'Proxy-Authorization: basic dXNlcjo=\r\n', requests[1])
+
+    def test_http_proxy_auth_retry_new_connection(self):
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(2)
+        server.settimeout(5)
+        requests = []
+
+        def serve():
+            for response in (b'HTTP/1.1 407 Proxy Authentication Required\r\n'
+                             b'Proxy-Authenticate: Basic realm="test"\r\n'
+                             b'Connection: close\r\n\r\n',
+                             b'HTTP/1.1 200 Connection established\r\n'
+                             b'\r\ntunnel'):
+                conn, _ = server.accept()
+                conn.settimeout(5)
+                data = b''
+                while not data.endswith(b'\r\n\r\n'):
+                    data += conn.recv(1)
+                requests.append(data)
+                conn.sendall(response)
+                conn.close()
+
+        th = Thread(target=serve)
+        th.start()
+        try:
+            # The proxy closes the connection after asking for credentials,
+            # so they are sent on a new one
+            sock = socks.create_connection(
+                ('example.com', 80), 5, None, socks.HTTP,
+                *server.getsockname(), proxy_username='user')
+            self.assertEqual(b'tunnel', sock.recv(6))
+            sock.close()
+        finally:
+            th.join()
+            server.close()
+        self.assertEqual(2, len(requests))
+        self.assertNotIn(b'Proxy-Authorization', requests[0])
+        self.assertIn(b'Proxy-Authorization: basic dXNlcjo=\r\n', requests[1])
+
+    def test_http_proxy_split_headers(self):
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(2)
+        server.settimeout(5)
+
+        def serve():
+            for _ in range(2):
+                conn, _ = server.accept()
+                conn.settimeout(5)
+                data = b''
+                while not data.endswith(b'\r\n\r\n'):
+                    data += conn.recv(1)
+                # Longer than a peek, with the blank line split in two
+                conn.sendall(b'HTTP/1.1 200 Connection established\r\n'
+                             b'Via: ' + b'x' * 3000 + b'\r\n\r')
+                time.sleep(0.1)
+                conn.sendall(b'\ntunnel')
+                conn.close()
+
+        th = Thread(target=serve)
+        th.start()
+        try:
+            sock = socks.create_connection(
+                ('example.com', 80), 5, None, socks.HTTP,
+                *server.getsockname())
+            self.assertEqual(b'tunnel', sock.recv(6))
+            sock.close()
+            results = list(socks.create_connections(
+                [('example.com', 80)], 5, None, socks.HTTP,
+                *server.getsockname()))
+            _, sock, error = results[0]
+            self.assertIsNone(error)
+            self.assertEqual(b'tunnel', sock.recv(6))
+            sock.close()
+        finally:
+            th.join()
+            server.close()
+
+    def test_http_proxy_auth_retry_once(self):
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(3)
+        server.settimeout(5)
+        requests = []
+
+        def serve():
+            # Asks for credentials and closes, even when given them
+            for _ in range(2):
+                conn, _ = server.accept()
+                conn.settimeout(5)
+                data = b''
+                while not data.endswith(b'\r\n\r\n'):
+                    data += conn.recv(1)
+                requests.append(data)
+                conn.sendall(b'HTTP/1.1 407 Proxy Authentication Required\r\n'
+                             b'Connection: close\r\n\r\n')
+                conn.close()
+
+        th = Thread(target=serve)
+        th.start()
+        # Nothing learnt is remembered for the retry
+        socks.set_capability_cache(socks.CapabilityCache(ttl=0))
+        try:
+            self.assertRaises(socks.HTTPError, socks.create_connection,
+                              ('example.com', 80), 5, None, socks.HTTP,
+                              *server.getsockname(), proxy_username='user')
+        finally:
+            socks.set_capability_cache(socks.CapabilityCache())
+            th.join()
+            server.close()
+        self.assertEqual(2, len(requests))
+        self.assertIn(b'Proxy-Authorization: basic dXNlcjo=\r\n', requests[1])
+
+    def test_socks5_capability_cache(self):
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(3)
+        server.settimeout(5)
+        greetings = []
+
+        def recv_exactly(conn, n):
+            data = b''
+            while len(data) < n:
+                d = conn.recv(n - len(data))
+                if not d:
+                    raise EOFError
+                data += d
+            return data
+
+        def serve():
+            # A proxy that only does "no authentication"
+            for _ in range(3):
+                conn, _ = server.accept()
+                conn.settimeout(5)
+                greeting = recv_exactly(conn, 2)
+                greeting += recv_exactly(conn, ord(greeting[1:2]))
+                greetings.append(greeting)
+                if b'\x00' not in greeting[2:]:
+                    conn.sendall(b'\x05\xff')
+                    while conn.recv(4096):
+                        pass  # Pipelined data
+                    conn.close()
+                    continue
+                conn.sendall(b'\x05\x00')
+                request = recv_exactly(conn, 5)
+                recv_exactly(conn, ord(request[4:5]) + 2)
+                conn.sendall(b'\x05\x00\x00\x01\x7f\x00\x00\x01\x00\x50')
+                conn.sendall(b'tunnel')
+                conn.close()
+
+        th = Thread(target=serve)
+        th.start()
+        path = os.path.join(tempfile.mkdtemp(), 'capabilities.json')
+        cache = socks.CapabilityCache(path=path, save_delay=0.1)
+        socks.set_capability_cache(cache)
+        proxy = (socks.SOCKS5,) + server.getsockname()
+        try:
+            for _ in range(2):
+                sock = socks.create_connection(
+                    ('example.com', 80), 5, None, *proxy,
+                    proxy_username='user', proxy_password='pass',
+                    proxy_pipeline=True)
+                self.assertEqual(b'tunnel', sock.recv(6))
+                sock.close()
+        finally:
+            socks.set_capability_cache(socks.CapabilityCache())
+            th.join()
+            server.close()
+        # The first pipelined greeting offered username/password only, and
+        # had to be repeated in lock-step; the second offered what worked.
+        self.assertEqual([b'\x05\x01\x02', b'\x05\x02\x00\x02',
+                          b'\x05\x01\x00'], greetings)
+        # Saved in the background
+        for _ in range(50):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+        self.assertEqual(0x00, socks.CapabilityCache(path=path).get(
+            proxy, 'auth_method'))
+
+    def test_capability_cache_concurrent_save(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'capabilities.json')
+        # Only the saves below, not one in the background
+        cache = socks.CapabilityCache(path=path, save_delay=60)
+
+        def learn(port):
+            for value in range(50):
+                cache.set((socks.SOCKS5, 'proxy.example', port), 'n', value)
+                cache.save()
+        threads = [Thread(target=learn, args=(port,)) for port in range(8)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        # Every save wrote a file of its own and replaced the cache with it
+        self.assertEqual(['capabilities.json'], os.listdir(directory))
+        with open(path) as f:
+            self.assertTrue(json.load(f))
+
+    @pytest.mark.skipif(sys.version_info < (3, 6),
+                        reason="requires ssl.SSLSession")
+    def test_https_proxy_tls_session(self):
+        import ssl
+        certfile = os.path.join(os.path.dirname(__file__), 'keycert.pem')
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(certfile)
+        server = socket.socket()
+        server.bind((TEST_SERVER_HOST_IP, 0))
+        server.listen(2)
+        server.settimeout(5)
+        requests = []
+
+        def serve():
+            # An HTTPS proxy whose tunnels echo a line
+            for _ in range(2):
+                conn, _ = server.accept()
+                conn = server_context.wrap_socket(conn, server_side=True)
+                conn.settimeout(5)
+                reader = conn.makefile('rb')
+                requests.append(reader.readline())
+                while reader.readline() != b'\r\n':
+                    pass
+                conn.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+                conn.sendall(reader.readline())
+                reader.close()
+                conn.close()
+
+        th = Thread(target=serve)
+        th.start()
+        cache = socks.TLSSessionCache()
+        socks.set_proxy_tls_session_cache(cache)
+        context = ssl.create_default_context(cafile=certfile)
+        https_proxy = (socks.HTTPS, 'localhost', server.getsockname()[1])
+        try:
+            sock = socks.create_connection(('example.com', 80), 5, None,
+                                           *https_proxy, proxy_tls=context)
+            sock.sendall(b'tunnel\n')
+            self.assertEqual(b'tunnel\n', sock.recv(7))
+            sock.close()
+            # As the last hop of a chain, with its own context
+            sock = socks.socksocket()
+            sock.settimeout(5)
+            sock.set_proxy_chain([(socks.SOCKS5, PROXY_HOST_IP,
+                                   SOCKS5_PROXY_PORT), https_proxy],
+                                 tls=[None, context])
+            sock.connect(('example.com', 80))
+            sock.sendall(b'tunnel\n')
+            self.assertEqual(b'tunnel\n', sock.recv(7))
+            sock.close()
+        finally:
+            socks.set_proxy_tls_session_cache(socks.TLSSessionCache())
+            th.join()
+            server.close()
+        self.assertEqual([b'CONNECT example.com:80 HTTP/1.1\r\n'] * 2,
+                         requests)
+        self.assertEqual(1, cache.full)
+        self.assertEqual(1, cache.resumed)